@@ -0,0 +1,250 @@
+# In-process stand-ins for Zookeeper and Kafka brokers, for benchmarking
+# without a cluster. Both serve a synthetic storm-kafka layout, can add a
+# fixed latency to every round trip, and count the round trips made.
+
+import time
+import heapq
+import threading
+from collections import namedtuple
+
+import simplejson as json
+from kafka.common import OffsetResponse
+from kazoo.exceptions import NoNodeError, NodeExistsError
+
+FakeStat = namedtuple('FakeStat', ['version'])
+
+class FakeAsyncResult(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.value = None
+        self.exception = None
+
+    def complete(self, fn):
+        try:
+            self.value = fn()
+        except Exception, e:
+            self.exception = e
+        self.event.set()
+        for callback in self.callbacks:
+            callback(self)
+
+    def get(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def rawlink(self, callback):
+        if self.event.is_set():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+class _Delayer(threading.Thread):
+    '''
+    Completes asynchronous results once their latency has passed, like
+    replies arriving from a real ensemble, so pipelined reads overlap.
+    '''
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pending = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def schedule(self, delay, fn):
+        result = FakeAsyncResult()
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.pending, (time.time() + delay, self.sequence, result, fn))
+            self.condition.notify()
+        return result
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                due, sequence, result, fn = self.pending[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+            result.complete(fn)
+
+class FakeZookeeper(object):
+    '''
+    Serves the subset of KazooClient used by ZkClient, SpoutCache and
+    ShardCoordinator from an in-memory tree. Children watches fire when a
+    child is created or deleted; other watches are accepted and never fire.
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.nodes = {}             # Path -> data
+        self.children = {}          # Path -> set of child names
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+        self.child_watches = {}     # Path -> list of watch functions
+        self.delayer = _Delayer()
+        self.delayer.start()
+
+    def add_node(self, path, data):
+        self.nodes[path] = data
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            parent = '/'.join(parts[:i]) or '/'
+            child = parts[i]
+            self.children.setdefault(parent, set()).add(child)
+            self.nodes.setdefault(parent, '')
+
+    def _count(self, nbytes=0):
+        with self.lock:
+            self.round_trips += 1
+            self.bytes_read += nbytes
+
+    def _get_children(self, path):
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        return sorted(self.children.get(path, ()))
+
+    def _get(self, path):
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        data = self.nodes[path]
+        self._count(len(data))
+        return data, FakeStat(0)
+
+    def get_children(self, path, watch=None):
+        self._count()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        children = self._get_children(path)
+        if watch is not None:
+            self.child_watches.setdefault(path, []).append(watch)
+        return children
+
+    def _fire_child_watches(self, path):
+        for watch in self.child_watches.pop(path, []):
+            watch(None)
+
+    def create(self, path, value='', ephemeral=False, makepath=False):
+        self._count()
+        if path in self.nodes:
+            raise NodeExistsError(path)
+        parent = path.rsplit('/', 1)[0] or '/'
+        if parent not in self.nodes and not makepath:
+            raise NoNodeError(parent)
+        self.add_node(path, value)
+        self._fire_child_watches(parent)
+        return path
+
+    def set(self, path, value):
+        self._count()
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        self.nodes[path] = value
+
+    def delete(self, path):
+        '''
+        Removes a node, as its session expiring would for an ephemeral one.
+        '''
+        self._count()
+        if path not in self.nodes:
+            raise NoNodeError(path)
+        del self.nodes[path]
+        parent, child = path.rsplit('/', 1)
+        parent = parent or '/'
+        self.children[parent].discard(child)
+        self._fire_child_watches(parent)
+
+    def get(self, path, watch=None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self._get(path)
+
+    def get_children_async(self, path, watch=None):
+        self._count()
+        return self.delayer.schedule(self.latency, lambda: self._get_children(path))
+
+    def get_async(self, path, watch=None):
+        return self.delayer.schedule(self.latency, lambda: self._get(path))
+
+    def add_listener(self, listener):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+def populate_spouts(zk, spout_root, topology, num_partitions, num_brokers,
+                    partitions_per_spout=50, topic='bench'):
+    '''
+    Writes storm-kafka Spout nodes for num_partitions partitions of one
+    topic, spread round-robin over num_brokers brokers.
+    '''
+    for partition in range(num_partitions):
+        spout = 'spout%d' % (partition // partitions_per_spout)
+        zk.add_node('/'.join([spout_root, spout, 'partition_%d' % partition]),
+                    json.dumps({'topology': {'id': topology + '-1', 'name': topology},
+                                'offset': partition * 100,
+                                'partition': partition,
+                                'broker': {'host': 'broker%d' % (partition % num_brokers),
+                                           'port': 9092},
+                                'topic': topic}))
+
+def populate_brokers(zk, broker_root, num_partitions, num_brokers, topic='bench'):
+    '''
+    Registers num_brokers brokers, and the partitions that populate_spouts
+    assigns to them, in the Kafka 0.7 layout under broker_root.
+    '''
+    for b in range(num_brokers):
+        zk.add_node('/'.join([broker_root, 'ids', str(b)]), 'broker%d-0:broker%d:9092' % (b, b))
+        zk.add_node('/'.join([broker_root, 'topics', topic, str(b)]), str(num_partitions))
+
+class FakeKafkaCluster(object):
+    '''
+    Answers offset requests for any partition. Offsets grow by
+    messages_per_request every time a partition is asked for its latest
+    offset, so successive refreshes see traffic.
+    '''
+    def __init__(self, latency=0.0, messages_per_request=10):
+        self.latency = latency
+        self.messages_per_request = messages_per_request
+        self.round_trips = 0
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def client_factory(self, hosts, timeout=None):
+        return FakeKafkaClient(self, hosts)
+
+class FakeKafkaClient(object):
+    def __init__(self, cluster, hosts):
+        self.cluster = cluster
+        self.hosts = hosts
+
+    def send_offset_request(self, payloads, fail_on_error=True):
+        cluster = self.cluster
+        if cluster.latency > 0:
+            time.sleep(cluster.latency)
+
+        responses = []
+        with cluster.lock:
+            cluster.round_trips += 1
+            for p in payloads:
+                key = (self.hosts, p.topic, p.partition)
+                if p.time == -1:
+                    offset = cluster.latest.get(key, p.partition * 100 + 1000)
+                    offset += cluster.messages_per_request
+                    cluster.latest[key] = offset
+                else:
+                    offset = p.partition * 100
+                responses.append(OffsetResponse(p.topic, p.partition, 0, [offset]))
+        return responses
+
+    def close(self):
+        pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Measures each stage of a refresh, from the Zookeeper Spout tree walk to
+# rendering, against in-process stand-ins for Zookeeper and Kafka brokers.
+#
+# For every partition count, reports the median wall time of each stage
+# over --ticks refreshes, the round trips made to Zookeeper and Kafka, the
+# growth in live objects, and the peak RSS of the process so far.
+
+import argparse
+import gc
+import resource
+import time
+
+from fakes import FakeZookeeper, FakeKafkaCluster, populate_spouts, populate_brokers
+
+from stormkafkamon.zkclient import ZkClient
+from stormkafkamon.brokerpool import BrokerPool
+from stormkafkamon.brokers import BrokerRegistry
+from stormkafkamon.fetcher import OffsetFetcher
+from stormkafkamon.processor import process
+from stormkafkamon.summary_aggregator import SummaryAggregator
+from stormkafkamon.capture import CaptureWriter, RecordingFetcher, recording_source
+
+SPOUT_ROOT = '/kafkastorm'
+BROKER_ROOT = '/brokers'
+TOPOLOGY = 'bench'
+STAGES = ['zk', 'offsets', 'aggregate', 'render']
+
+
+def read_args():
+    parser = argparse.ArgumentParser(description='Benchmark a refresh against fake Zookeeper and Kafka')
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='Comma separated partition counts')
+    parser.add_argument('--brokers', type=int, default=8, help='Number of fake Kafka brokers')
+    parser.add_argument('--zk_latency', type=float, default=0.0, help='Seconds added to each Zookeeper round trip')
+    parser.add_argument('--kafka_latency', type=float, default=0.0, help='Seconds added to each Kafka round trip')
+    parser.add_argument('--ticks', type=int, default=3, help='Refreshes per partition count')
+    parser.add_argument('--zk_pipelined', action='store_const', const=True, help='Use the pipelined Spout tree walk')
+    parser.add_argument('--validate', action='store_const', const=True,
+                        help='Check partitions against a broker registry')
+    parser.add_argument('--record', type=str, metavar='FILE',
+                        help='Record the refreshes of the last partition count to a capture file, for replay.py')
+    parser.add_argument('--batch_size', type=int, default=OffsetFetcher.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max_inflight', type=int, default=OffsetFetcher.DEFAULT_MAX_INFLIGHT)
+    return parser.parse_args()
+
+
+def measure(fn):
+    '''
+    Returns the result of fn, the seconds it took, and the number of live
+    objects it left behind.
+    '''
+    gc.collect()
+    objects = len(gc.get_objects())
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+    return result, elapsed, len(gc.get_objects()) - objects
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(size, options, writer=None):
+    zk = FakeZookeeper(options.zk_latency)
+    populate_spouts(zk, SPOUT_ROOT, TOPOLOGY, size, options.brokers)
+    populate_brokers(zk, BROKER_ROOT, size, options.brokers)
+    cluster = FakeKafkaCluster(options.kafka_latency)
+
+    zc = ZkClient('localhost', 2181)
+    zc.client = zk
+    pool = BrokerPool(client_factory=cluster.client_factory)
+    fetcher = OffsetFetcher(pool, options.batch_size, options.max_inflight)
+    aggregator = SummaryAggregator(TOPOLOGY, 'fake')
+    registry = BrokerRegistry(zc, BROKER_ROOT) if options.validate else None
+    get_spouts = lambda: zc.spouts(SPOUT_ROOT, TOPOLOGY, bool(options.zk_pipelined))
+    if writer is not None:
+        get_spouts = recording_source(get_spouts, writer)
+        fetcher = RecordingFetcher(fetcher, writer)
+
+    times = dict((s, []) for s in STAGES)
+    objects = dict((s, []) for s in STAGES)
+    zk_trips = []
+    kafka_trips = []
+
+    for tick in range(options.ticks):
+        zk_before = zk.round_trips
+        kafka_before = cluster.round_trips
+
+        spouts, t, o = measure(get_spouts)
+        times['zk'].append(t)
+        objects['zk'].append(o)
+
+        summary, t, o = measure(lambda: process(spouts, fetcher, registry))
+        times['offsets'].append(t)
+        objects['offsets'].append(o)
+
+        _, t, o = measure(lambda: aggregator.add_summary(summary, time.time()))
+        times['aggregate'].append(t)
+        objects['aggregate'].append(o)
+
+        _, t, o = measure(lambda: (aggregator.get_header_lines(), aggregator.get_partition_data_lines()))
+        times['render'].append(t)
+        objects['render'].append(o)
+
+        zk_trips.append(zk.round_trips - zk_before)
+        kafka_trips.append(cluster.round_trips - kafka_before)
+
+    pool.close()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%9d %s %8d %9d %10dKB' % (size,
+                                     ' '.join('%9.1fms %9d' % (median(times[s]) * 1000, median(objects[s]))
+                                              for s in STAGES),
+                                     median(zk_trips), median(kafka_trips), peak_rss)
+
+
+def main():
+    options = read_args()
+
+    print '%9s %s %8s %9s %12s' % ('Parts', ' '.join('%11s %9s' % (s, 'objects') for s in STAGES),
+                                   'ZK RTs', 'Kafka RTs', 'Peak RSS')
+    sizes = [int(s) for s in options.sizes.split(',')]
+    for size in sizes[:-1]:
+        run(size, options)
+
+    writer = CaptureWriter(options.record) if options.record is not None else None
+    run(sizes[-1], options, writer)
+    if writer is not None:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Replays a capture file recorded with --record through process(), the
+# SummaryAggregator and the renderers, as fast as they go, to measure their
+# throughput on real data shapes without Zookeeper or Kafka.
+#
+# Reports the median and worst wall time of each stage over all recorded
+# refreshes, and how many refreshes per second the whole pipeline managed.
+
+import argparse
+import time
+
+from stormkafkamon.capture import Replay, CaptureError
+from stormkafkamon.processor import process, split_summary, Totals
+from stormkafkamon.zkclient import TopologyFilter
+from stormkafkamon.summary_aggregator import SummaryAggregator
+from stormkafkamon.exporter import render_metrics, render_json
+
+STAGES = ['offsets', 'aggregate', 'render', 'export']
+
+
+def read_args():
+    parser = argparse.ArgumentParser(description='Benchmark aggregation and rendering on a recorded capture')
+    parser.add_argument('capture', help='Capture file written by --record')
+    parser.add_argument('--topology', default='all', help='Topologies to aggregate, as for --topology (default: all)')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='Multiple of the recorded pace to replay at, or 0 for as fast as possible (default: 0)')
+    return parser.parse_args()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    options = read_args()
+    topologies = TopologyFilter.of(options.topology)
+    replay = Replay(options.capture, options.speed)
+    aggregators = {}
+    empty = Totals().summary(())
+    times = dict((s, []) for s in STAGES)
+    partitions = 0
+
+    start = time.time()
+    while True:
+        try:
+            spouts = replay.get_spouts()
+        except CaptureError:
+            break
+
+        t = time.time()
+        summary = process(spouts, replay.fetcher)
+        times['offsets'].append(time.time() - t)
+        partitions = max(partitions, summary.num_partitions)
+
+        t = time.time()
+        summaries = split_summary(summary, topologies)
+        for name in summaries:
+            if name not in aggregators:
+                aggregators[name] = SummaryAggregator(name, 'replay')
+        for name, aggregator in aggregators.items():
+            aggregator.add_summary(summaries.get(name, empty), replay.clock())
+        times['aggregate'].append(time.time() - t)
+
+        t = time.time()
+        for aggregator in aggregators.values():
+            aggregator.get_header_lines()
+            aggregator.get_partition_data_lines()
+        times['render'].append(time.time() - t)
+
+        t = time.time()
+        views = [(name, summaries.get(name, empty), aggregators[name]) for name in sorted(aggregators)]
+        render_metrics(topologies, views, 0.0, time.time())
+        render_json(views, 0.0, time.time(), topologies.single() is not None)
+        times['export'].append(time.time() - t)
+    elapsed = time.time() - start
+
+    ticks = len(times['offsets'])
+    if ticks == 0:
+        print 'No refreshes in %s' % options.capture
+        return 1
+
+    print '%d refreshes of up to %d partitions in %.2fs, %.1f refreshes/s' % (ticks, partitions, elapsed,
+                                                                           ticks / elapsed)
+    print '%10s %10s %10s' % ('Stage', 'Median', 'Worst')
+    for s in STAGES:
+        print '%10s %8.1fms %8.1fms' % (s, median(times[s]) * 1000, max(times[s]) * 1000)
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Runs several sharded monitor instances in one process, coordinating
+# through a local Zookeeper (or the in-process fake with --fake_zk), with
+# fake Kafka brokers, and checks that every instance sees every partition
+# while fetching only its own slice, before and after one of them leaves.
+#
+# For every refresh, reports how many partitions each instance owns, how
+# many offset requests it made, the stale and unknown partitions in its
+# merged summary, and how long the refresh took.
+
+import argparse
+import time
+
+from fakes import FakeZookeeper, FakeKafkaCluster
+
+from stormkafkamon.zkclient import ZkClient, ZkKafkaSpout
+from stormkafkamon.brokerpool import BrokerPool
+from stormkafkamon.fetcher import OffsetFetcher
+from stormkafkamon.processor import process
+from stormkafkamon.sharding import ShardCoordinator, ShardedFetcher
+
+
+def read_args():
+    parser = argparse.ArgumentParser(description='Run sharded monitor instances against one Zookeeper')
+    parser.add_argument('--zserver', default='localhost', help='Zookeeper host (default: localhost)')
+    parser.add_argument('--zport', type=int, default=2181, help='Zookeeper port (default: 2181)')
+    parser.add_argument('--fake_zk', action='store_const', const=True, help='Use the in-process fake Zookeeper')
+    parser.add_argument('--root', default='/stormkafkamon-shards', help='Scratch coordination path')
+    parser.add_argument('--instances', type=int, default=3, help='Number of instances')
+    parser.add_argument('--partitions', type=int, default=10000, help='Number of partitions')
+    parser.add_argument('--brokers', type=int, default=8, help='Number of fake Kafka brokers')
+    parser.add_argument('--rounds', type=int, default=3, help='Refreshes before and after an instance leaves')
+    return parser.parse_args()
+
+
+def make_spouts(num_partitions, num_brokers, partitions_per_spout=50):
+    spouts = []
+    for s in range(0, num_partitions, partitions_per_spout):
+        spouts.append(ZkKafkaSpout('spout%d' % (s // partitions_per_spout),
+                                   [{'topology': {'id': 'bench-1', 'name': 'bench'},
+                                     'offset': p * 100,
+                                     'partition': p,
+                                     'broker': {'host': 'broker%d' % (p % num_brokers), 'port': 9092},
+                                     'topic': 'bench'}
+                                    for p in range(s, min(num_partitions, s + partitions_per_spout))]))
+    return tuple(spouts)
+
+
+class Instance(object):
+    def __init__(self, name, zc, cluster, root):
+        self.name = name
+        self.zc = zc
+        self.cluster = cluster
+        self.coordinator = ShardCoordinator(zc, root, name)
+        self.fetcher = ShardedFetcher(OffsetFetcher(BrokerPool(client_factory=cluster.client_factory)),
+                                      self.coordinator)
+
+    def refresh(self, spouts):
+        before = self.cluster.round_trips
+        start = time.time()
+        summary = process(spouts, self.fetcher)
+        elapsed = time.time() - start
+
+        owned = sum(1 for s in spouts for p in s.partitions
+                    if self.coordinator.owns(p['broker']['host'], p['topic'], p['partition']))
+        print '%-10s %8d %10d %8d %6d %6d %8.1fms' % (self.name, owned, self.cluster.round_trips - before,
+                                                     summary.num_partitions, summary.num_stale,
+                                                     summary.num_unknown, elapsed * 1000)
+        return summary
+
+
+def connect(options, fake):
+    zc = ZkClient(options.zserver, options.zport)
+    if fake is not None:
+        zc.client = fake
+    zc.start()
+    return zc
+
+
+def rounds(instances, spouts, n):
+    print '%-10s %8s %10s %8s %6s %6s %10s' % ('Instance', 'Owned', 'Kafka RTs', 'Parts', 'Stale', 'Unkn', 'Time')
+    for i in range(n):
+        summaries = [instance.refresh(spouts) for instance in instances]
+        print
+    return summaries
+
+
+def main():
+    options = read_args()
+    fake = FakeZookeeper() if options.fake_zk else None
+    cluster = FakeKafkaCluster()
+    spouts = make_spouts(options.partitions, options.brokers)
+
+    instances = [Instance('shard%d' % i, connect(options, fake), cluster, options.root)
+                 for i in range(options.instances)]
+    try:
+        summaries = rounds(instances, spouts, options.rounds)
+        complete = all(s.num_partitions == options.partitions and s.num_unknown == 0 for s in summaries)
+        print 'All instances see every partition: %s' % complete
+        print
+
+        leaving = instances.pop()
+        print '%s leaves' % leaving.name
+        if fake is not None:
+            fake.delete(leaving.coordinator.node)
+        else:
+            leaving.zc.stop()
+        summaries = rounds(instances, spouts, options.rounds)
+        complete = all(s.num_partitions == options.partitions and s.num_unknown == 0 for s in summaries)
+        print 'All instances see every partition: %s' % complete
+    finally:
+        if fake is None:
+            instances[0].zc.client.delete(options.root, recursive=True)
+        for instance in instances:
+            instance.zc.stop()
+
+
+if __name__ == '__main__':
+    main()
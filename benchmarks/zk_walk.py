@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Compares serial and pipelined walks of the Kafka Spout tree in Zookeeper.
+# A synthetic Spout tree is written under a scratch root on the given
+# Zookeeper, walked both ways, and removed again.
+
+import argparse
+import time
+
+import simplejson as json
+
+from stormkafkamon.zkclient import ZkClient
+
+
+def read_args():
+    parser = argparse.ArgumentParser(description='Benchmark Zookeeper Spout tree walks')
+    parser.add_argument('--zserver', default='localhost', help='Zookeeper host (default: localhost)')
+    parser.add_argument('--zport', type=int, default=2181, help='Zookeeper port (default: 2181)')
+    parser.add_argument('--root', default='/stormkafkamon-bench', help='Scratch path for the synthetic tree')
+    parser.add_argument('--spouts', type=int, default=20, help='Number of Spout tasks')
+    parser.add_argument('--partitions', type=int, default=25, help='Partitions per Spout task')
+    parser.add_argument('--rounds', type=int, default=5, help='Walks per mode')
+    return parser.parse_args()
+
+
+def populate(zc, root, num_spouts, num_partitions):
+    zc.client.ensure_path(root)
+    for s in range(num_spouts):
+        spout = ZkClient._zjoin([root, 'spout%d' % s])
+        zc.client.ensure_path(spout)
+        for p in range(num_partitions):
+            partition = s * num_partitions + p
+            zc.client.create(ZkClient._zjoin([spout, 'partition_%d' % partition]),
+                             json.dumps({'topology': {'id': 'bench-1', 'name': 'bench'},
+                                         'offset': partition * 1000,
+                                         'partition': partition,
+                                         'broker': {'host': 'localhost', 'port': 9092},
+                                         'topic': 'bench'}))
+
+
+def timed_walk(zc, root, pipelined, rounds):
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        zc.spouts(root, 'bench', pipelined)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    options = read_args()
+
+    zc = ZkClient(options.zserver, options.zport)
+    zc.start()
+
+    try:
+        populate(zc, options.root, options.spouts, options.partitions)
+        serial = timed_walk(zc, options.root, False, options.rounds)
+        pipelined = timed_walk(zc, options.root, True, options.rounds)
+    finally:
+        zc.client.delete(options.root, recursive=True)
+        zc.stop()
+
+    print 'Znodes:     %d' % (options.spouts * options.partitions)
+    print 'Serial:     %8.1fms' % (serial * 1000)
+    print 'Pipelined:  %8.1fms' % (pipelined * 1000)
+    print 'Speedup:    %8.1fx' % (serial / pipelined)
+
+
+if __name__ == '__main__':
+    main()
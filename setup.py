@@ -23,11 +23,14 @@ setuptools.setup(
     zip_safe = True,
     verbose = False,
     install_requires = install_requires,
+    extras_require = {'numpy': ['numpy']},
     dependency_links = ['https://github.com/mumrah/kafka-python/tarball/9599215bf28b65a29908b8644dcaa6f3614a425d#egg=kafka-python'],
     entry_points={
         'console_scripts': [
             'skmon = stormkafkamon.monitor:main',
-            'sktop = stormkafkamon.monitor:top'
+            'sktop = stormkafkamon.monitor:top',
+            'skexport = stormkafkamon.monitor:daemon',
+            'skq = stormkafkamon.client:main'
         ]
     },
 )
@@ -0,0 +1,292 @@
+# Evaluates alert rules on every refresh of a SummaryAggregator, looking
+# only at the partitions whose offsets changed, and hands the alerts that
+# start firing or are resolved to a command, a webhook or a file.
+
+import heapq
+import logging
+import os
+import subprocess
+import threading
+import time
+import urllib2
+import Queue
+from collections import namedtuple
+
+import simplejson as json
+
+logger = logging.getLogger(__name__)
+
+class AlertError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+FIRING = 'firing'
+RESOLVED = 'resolved'
+
+Rule = namedtuple('Rule',
+    [
+        'name',             # Name reported with each alert
+        'metric',           # One of PARTITION_METRICS or TOPOLOGY_METRICS
+        'op',               # '>' or '<'
+        'threshold',        # Value the metric must pass to fire
+        'for_seconds',      # Seconds it must stay past threshold before firing
+        'clear',            # Value the metric must pass back over to resolve
+        'command',          # Shell command given each batch of alerts, or None
+        'webhook',          # URL each batch of alerts is POSTed to, or None
+        'file'              # File each alert is appended to as a JSON line, or None
+    ])
+
+# Metrics of a single partition, from the row of a PartitionColumns. Rates
+# are over the last refresh.
+PARTITION_METRICS = {
+    'delta': lambda a, row: a.partitions.delta[row],
+    'depth': lambda a, row: a.partitions.depth[row],
+    # Messages the Spout is ahead of the oldest one Kafka still holds; near
+    # 0, retention is about to delete messages it has not read.
+    'headroom': lambda a, row: a.partitions.current[row] - a.partitions.earliest[row],
+    'added_rate': lambda a, row: a.partitions.added_at(row) / a.seconds_between_updates,
+    'removed_rate': lambda a, row: a.partitions.removed_at(row) / a.seconds_between_updates,
+}
+RATE_METRICS = set(['added_rate', 'removed_rate'])
+
+# Metrics of a whole topology. Rates are over the last minute.
+TOPOLOGY_METRICS = {
+    'total_delta': lambda a: a.prev_summary.total_delta,
+    'total_depth': lambda a: a.prev_summary.total_depth,
+    'stale_partitions': lambda a: a.prev_summary.num_stale + a.prev_summary.num_unknown,
+    'added_rate': lambda a: a.added_averages[60].current_value(),
+    'removed_rate': lambda a: a.removed_averages[60].current_value(),
+}
+
+OPS = {
+    '>': lambda value, threshold: value > threshold,
+    '<': lambda value, threshold: value < threshold,
+}
+
+def load_rules(path):
+    '''
+    Reads a list of Rules from a JSON file holding a list of objects, for
+    example:
+
+        [{"name": "lagging", "metric": "delta", "op": ">", "threshold": 100000,
+          "for": 60, "clear": 50000, "command": "notify-lag"}]
+
+    "scope" is "partition" (the default) or "topology". "for" defaults to
+    0, and "clear" to the threshold. At least one of "command", "webhook"
+    and "file" must be given.
+    '''
+    try:
+        with open(path) as f:
+            specs = json.load(f)
+    except (IOError, ValueError), e:
+        raise AlertError('Cannot read rules from %s: %s' % (path, e))
+
+    rules = []
+    for spec in specs:
+        name = spec.get('name', spec.get('metric'))
+        scope = spec.get('scope', 'partition')
+        metric = spec.get('metric')
+        if scope == 'topology':
+            metrics = TOPOLOGY_METRICS
+            if metric in ('delta', 'depth'):
+                metric = 'total_' + metric
+        elif scope == 'partition':
+            metrics = PARTITION_METRICS
+        else:
+            raise AlertError('Rule %s: scope must be partition or topology' % name)
+        if metric not in metrics:
+            raise AlertError('Rule %s: metric must be one of %s' % (name, ', '.join(sorted(metrics))))
+        if spec.get('op') not in OPS:
+            raise AlertError('Rule %s: op must be > or <' % name)
+        if 'threshold' not in spec:
+            raise AlertError('Rule %s: threshold is required' % name)
+        if not (spec.get('command') or spec.get('webhook') or spec.get('file')):
+            raise AlertError('Rule %s: command, webhook or file is required' % name)
+
+        rule = Rule(name=name, metric=metric, op=spec['op'], threshold=spec['threshold'],
+                    for_seconds=float(spec.get('for', 0)), clear=spec.get('clear', spec['threshold']),
+                    command=spec.get('command'), webhook=spec.get('webhook'), file=spec.get('file'))
+        rules.append((scope, rule))
+    return rules
+
+class AlertDispatcher(threading.Thread):
+    '''
+    Delivers batches of alerts on a thread of its own, so that a slow
+    command or webhook never holds up a refresh. Each rule's alerts from
+    one refresh make one batch: one run of its command, given the alerts
+    as a JSON list on stdin, and one POST of that list to its webhook.
+    '''
+    WEBHOOK_TIMEOUT = 5.0
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue.Queue()
+
+    def dispatch(self, rule, alerts):
+        self.queue.put((rule, alerts))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            rule, alerts = item
+            try:
+                self.deliver(rule, alerts)
+            except Exception, e:
+                logger.warning('Delivering alerts of rule %s failed: %s', rule.name, e)
+
+    def deliver(self, rule, alerts):
+        body = json.dumps(alerts)
+        if rule.file is not None:
+            with open(rule.file, 'a') as f:
+                for alert in alerts:
+                    f.write(json.dumps(alert) + '\n')
+        if rule.command is not None:
+            env = dict(os.environ)
+            env['STORMKAFKAMON_RULE'] = rule.name
+            env['STORMKAFKAMON_ALERTS'] = str(len(alerts))
+            p = subprocess.Popen(rule.command, shell=True, stdin=subprocess.PIPE, env=env)
+            p.communicate(body)
+        if rule.webhook is not None:
+            request = urllib2.Request(rule.webhook, body, {'Content-Type': 'application/json'})
+            urllib2.urlopen(request, timeout=AlertDispatcher.WEBHOOK_TIMEOUT).close()
+
+class _RuleState(object):
+    def __init__(self, rule):
+        self.rule = rule
+        self.test = OPS[rule.op]
+        self.pending = {}           # Key -> time the metric passed the threshold
+        self.deadlines = []         # Heap of (time due to fire, key, pending time)
+        self.firing = {}            # Key -> last value seen while firing
+
+    def observe(self, key, value, now, alerts):
+        '''
+        Moves key along pending, firing and resolved for a new value of
+        the metric.
+        '''
+        if key in self.firing:
+            # Only passing back over clear resolves, so a value wavering
+            # around the threshold does not fire again and again.
+            if not self.test(value, self.rule.clear):
+                del self.firing[key]
+                alerts.append((RESOLVED, key, value))
+            else:
+                self.firing[key] = value
+        elif self.test(value, self.rule.threshold):
+            if key not in self.pending:
+                self.pending[key] = now
+                heapq.heappush(self.deadlines, (now + self.rule.for_seconds, key, now))
+        else:
+            self.pending.pop(key, None)
+
+    def forget(self, key, alerts):
+        self.pending.pop(key, None)
+        if key in self.firing:
+            alerts.append((RESOLVED, key, self.firing.pop(key)))
+
+    def fire_due(self, now, value_of, alerts):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, key, since = heapq.heappop(self.deadlines)
+            # Skip deadlines of a pending spell that has since ended.
+            if self.pending.get(key) == since:
+                del self.pending[key]
+                value = value_of(key)
+                self.firing[key] = value
+                alerts.append((FIRING, key, value))
+
+class AlertEngine(object):
+    '''
+    Evaluates rules, as returned by load_rules(), against one topology's
+    SummaryAggregator after each of its refreshes.
+
+    A partition rule is evaluated only for the rows whose offsets changed,
+    as other rows have the same values as before. Rate rules also take the
+    rows that changed the refresh before, whose rates have just dropped to
+    0. Rows that have been past a threshold for long enough are found from
+    a heap of deadlines, not by looking at every pending row. When the set
+    of partitions itself changes, every row is evaluated again.
+    '''
+    def __init__(self, rules, topology, dispatcher):
+        self.topology = topology
+        self.dispatcher = dispatcher
+        self.partition_rules = [_RuleState(r) for scope, r in rules if scope == 'partition']
+        self.topology_rules = [_RuleState(r) for scope, r in rules if scope == 'topology']
+        self.present = None
+        self.last_changed = set()
+
+    def firing(self):
+        '''
+        Returns a list of (rule name, number of alerts firing).
+        '''
+        return [(s.rule.name, len(s.firing)) for s in self.partition_rules + self.topology_rules if s.firing]
+
+    def _alert(self, aggregator, state, status, key, value, now):
+        alert = {'rule': state.rule.name, 'state': status, 'topology': self.topology,
+                 'metric': state.rule.metric, 'op': state.rule.op, 'threshold': state.rule.threshold,
+                 'value': value, 'time': now}
+        if key is not None:
+            alert['broker'], alert['topic'], alert['partition'] = aggregator.partitions.keys[key]
+        return alert
+
+    def evaluate(self, aggregator, now):
+        '''
+        Evaluates every rule after aggregator has taken a summary at now,
+        in seconds, and dispatches the alerts that started firing or were
+        resolved.
+        '''
+        wall = time.time()
+        c = aggregator.partitions
+        rows = None
+        if c.present is not self.present:
+            self.present = c.present
+            changed = set(c.rows())
+            rows = changed
+        else:
+            changed = c.changed_rows()
+        rate_rows = changed | self.last_changed
+        self.last_changed = changed
+        rates_known = bool(aggregator.seconds_between_updates)
+
+        for state in self.partition_rules:
+            alerts = []
+            metric = PARTITION_METRICS[state.rule.metric]
+            value_of = lambda row: metric(aggregator, row)
+            if state.rule.metric in RATE_METRICS:
+                if rates_known:
+                    for row in rate_rows:
+                        state.observe(row, value_of(row), now, alerts)
+            else:
+                for row in changed:
+                    state.observe(row, value_of(row), now, alerts)
+            if rows is not None:
+                # Rows gone from the summary are resolved.
+                for row in set(state.pending) | set(state.firing):
+                    if row not in rows:
+                        state.forget(row, alerts)
+            if rates_known or state.rule.metric not in RATE_METRICS:
+                state.fire_due(now, value_of, alerts)
+            self._dispatch(aggregator, state, alerts, wall)
+
+        for state in self.topology_rules:
+            alerts = []
+            metric = TOPOLOGY_METRICS[state.rule.metric]
+            value = metric(aggregator)
+            # Rates are -1 until known.
+            if state.rule.metric in RATE_METRICS and value < 0:
+                continue
+            state.observe(None, value, now, alerts)
+            state.fire_due(now, lambda key: value, alerts)
+            self._dispatch(aggregator, state, alerts, wall)
+
+    def _dispatch(self, aggregator, state, alerts, wall):
+        if alerts:
+            self.dispatcher.dispatch(state.rule, [self._alert(aggregator, state, status, key, value, wall)
+                                                  for status, key, value in alerts])
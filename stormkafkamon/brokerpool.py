@@ -0,0 +1,233 @@
+# Long-lived Kafka broker connections, shared between refreshes.
+
+import socket
+import select
+import threading
+from kafka.client import KafkaClient
+
+from clock import monotonic
+
+class BrokerPoolError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+class _PooledClient(object):
+    def __init__(self, client):
+        self.client = client
+        self.last_used = monotonic()
+        self.leased = False
+
+def _peer_closed(client):
+    '''
+    Returns whether any socket of an idle KafkaClient can be read from. A
+    broker sends nothing unasked, so a readable socket has been closed or
+    reset by it, or holds the late answer to a request given up on, and
+    either way the connection cannot be used. Clients whose sockets cannot
+    be found, such as fakes, count as open.
+    '''
+    socks = [s for s in (getattr(c, '_sock', None) for c in getattr(client, 'conns', {}).values())
+             if s is not None]
+    if not socks:
+        return False
+    try:
+        return bool(select.select(socks, [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+def _close(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+class BrokerPool(object):
+    '''
+    Keeps one KafkaClient per (host, port), so that a refresh costs one
+    connection per broker rather than one per partition. Connections are
+    reused across refreshes, and replaced when they fail, sit idle for
+    longer than max_idle seconds, or were closed by the broker while idle,
+    which is checked before each reuse without blocking. Socket operations
+    on each connection give up after timeout seconds.
+
+    The pool may be shared between threads. A connection is leased to one
+    caller at a time, from get() until release() or discard(). One asked
+    for while still leased, as when a worker stuck on it was given up on,
+    is replaced in the pool by a new connection, and closed once released.
+
+    client_factory is called as client_factory(hosts, timeout=timeout) to
+    open a connection, and defaults to KafkaClient. If resolver is given,
+    host names are passed through it, an AddressCache's resolve() for
+    instance, and the connection opened to the address it returns.
+    '''
+    DEFAULT_MAX_IDLE = 300.0
+    DEFAULT_TIMEOUT = 10.0
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE, timeout=DEFAULT_TIMEOUT, client_factory=KafkaClient,
+                 resolver=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.client_factory = client_factory
+        self.resolver = resolver
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def _connect(self, host, port):
+        try:
+            address = self.resolver(host) if self.resolver is not None else host
+            return self.client_factory(address + ':' + str(port), timeout=self.timeout)
+        except socket.gaierror, e:
+            raise BrokerPoolError('Failed to contact Kafka broker %s (%s)' %
+                                  (host, str(e)))
+
+    def _healthy(self, pooled):
+        return (monotonic() - pooled.last_used) < self.max_idle
+
+    def get(self, host, port):
+        '''
+        Returns a connected KafkaClient for the broker at host:port, leased
+        to the caller until it is released or discarded.
+        '''
+        key = (host, int(port))
+        idle = None
+        reused = None
+        with self.lock:
+            pooled = self.clients.get(key)
+            if pooled is not None and not pooled.leased:
+                if self._healthy(pooled):
+                    pooled.leased = True
+                    pooled.last_used = monotonic()
+                    reused = pooled.client
+                else:
+                    idle = self.clients.pop(key)
+        if reused is not None:
+            if not _peer_closed(reused):
+                return reused
+            self.discard(host, port, reused)
+        if idle is not None:
+            _close(idle.client)
+
+        pooled = _PooledClient(self._connect(host, port))
+        pooled.leased = True
+        with self.lock:
+            replaced = self.clients.get(key)
+            self.clients[key] = pooled
+        # A replaced connection still leased is closed when released.
+        if replaced is not None and not replaced.leased:
+            _close(replaced.client)
+        return pooled.client
+
+    def release(self, host, port, client):
+        '''
+        Returns a client leased by get() to the pool, or closes it if it
+        has been replaced there since.
+        '''
+        with self.lock:
+            pooled = self.clients.get((host, int(port)))
+            if pooled is not None and pooled.client is client:
+                pooled.leased = False
+                pooled.last_used = monotonic()
+                return
+        _close(client)
+
+    def discard(self, host, port, client=None):
+        '''
+        Closes and forgets the connection to host:port, if there is one,
+        or only client, if given, whether or not it is still pooled.
+        '''
+        with self.lock:
+            pooled = self.clients.get((host, int(port)))
+            if pooled is not None and (client is None or pooled.client is client):
+                del self.clients[(host, int(port))]
+                client = pooled.client
+        if client is not None:
+            _close(client)
+
+    def _call(self, host, port, fn):
+        client = self.get(host, port)
+        try:
+            result = fn(client)
+        except:
+            self.discard(host, port, client)
+            raise
+        self.release(host, port, client)
+        return result
+
+    def call(self, host, port, fn, retry=True):
+        '''
+        Calls fn with a client for host:port. If the call fails the
+        connection is thrown away and, if retry is set, the call retried
+        once on a fresh one. Callers with retries of their own unset it.
+        '''
+        if retry:
+            try:
+                return self._call(host, port, fn)
+            except BrokerPoolError:
+                raise
+            except Exception:
+                pass
+
+        try:
+            return self._call(host, port, fn)
+        except BrokerPoolError:
+            raise
+        except Exception, e:
+            raise BrokerPoolError('Request to Kafka broker %s:%s failed (%s)' %
+                                  (host, port, str(e)))
+
+    def close(self):
+        with self.lock:
+            keys = self.clients.keys()
+        for host, port in keys:
+            self.discard(host, port)
+
+class CircuitBreaker(object):
+    '''
+    Tracks consecutive failures per broker. Once a broker has failed
+    threshold times in a row it is skipped for cooldown seconds, after
+    which one attempt is let through: success closes the circuit again,
+    failure opens it for another cooldown.
+    '''
+    DEFAULT_THRESHOLD = 3
+    DEFAULT_COOLDOWN = 30.0
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, cooldown=DEFAULT_COOLDOWN, clock=monotonic):
+        self.threshold = max(1, int(threshold))
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = {}          # Broker -> consecutive failures
+        self.open_until = {}        # Broker -> time it may be tried again
+        self.lock = threading.Lock()
+
+    def allow(self, broker):
+        with self.lock:
+            until = self.open_until.get(broker)
+            if until is None:
+                return True
+            if self.clock() < until:
+                return False
+            # Let one attempt through, and keep others out until it is done.
+            self.open_until[broker] = self.clock() + self.cooldown
+            return True
+
+    def retry_in(self, broker):
+        '''
+        Returns the seconds until broker will be tried again.
+        '''
+        with self.lock:
+            until = self.open_until.get(broker)
+        return max(0.0, until - self.clock()) if until is not None else 0.0
+
+    def success(self, broker):
+        with self.lock:
+            self.failures.pop(broker, None)
+            self.open_until.pop(broker, None)
+
+    def failure(self, broker):
+        with self.lock:
+            n = self.failures.get(broker, 0) + 1
+            self.failures[broker] = n
+            if n >= self.threshold:
+                self.open_until[broker] = self.clock() + self.cooldown
@@ -0,0 +1,157 @@
+# Keeps the Kafka broker and topic layout registered in Zookeeper, and the
+# resolved addresses of broker hosts, so that refreshes look them up in
+# memory instead of asking Zookeeper and DNS every time.
+
+import socket
+import threading
+
+from kazoo.exceptions import NoNodeError
+
+from zkclient import ZkClient, ZkMirror, ZkKafkaBroker, ZkError
+from clock import monotonic
+
+class AddressCache(object):
+    '''
+    Resolves host names to addresses, remembering each answer for ttl
+    seconds. Failed lookups are not remembered.
+    '''
+    DEFAULT_TTL = 300.0
+
+    def __init__(self, ttl=DEFAULT_TTL, resolver=socket.gethostbyname, clock=monotonic):
+        self.ttl = ttl
+        self.resolver = resolver
+        self.clock = clock
+        self.addresses = {}         # Host -> (address, expiry)
+        self.lock = threading.Lock()
+
+    def resolve(self, host):
+        '''
+        Returns the address of host. Raises socket.gaierror if it cannot be
+        resolved.
+        '''
+        now = self.clock()
+        with self.lock:
+            cached = self.addresses.get(host)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        address = self.resolver(host)
+        with self.lock:
+            self.addresses[host] = (address, now + self.ttl)
+        return address
+
+class BrokerRegistry(ZkMirror):
+    '''
+    Mirrors broker_root/ids and broker_root/topics in memory. Watches on
+    every node read mark the copy stale when anything changes, and it is
+    read again, in one pipelined pass, on the next lookup after that. Until
+    then lookups cost no Zookeeper round trips.
+
+    The layout is that of Kafka 0.7: broker_root/ids/<id> holds
+    "creator:host:port", and broker_root/topics/<topic>/<id> holds the
+    number of partitions of the topic on that broker.
+    '''
+    DEFAULT_BROKER_ROOT = '/brokers'
+
+    def __init__(self, zc, broker_root=DEFAULT_BROKER_ROOT):
+        self.client = zc.client
+        self.stats = zc.stats
+        self.broker_root = broker_root
+        self.lock = threading.Lock()
+
+        self.brokers = {}           # Broker id -> ZkKafkaBroker
+        self.addresses = {}         # (host, port) -> broker id
+        self.topics = {}            # Topic -> {broker id: number of partitions}
+
+        self._follow_session(self.client)
+
+    def _watch(self, event):
+        self.stale = True
+
+    def _read_children(self, paths):
+        pending = [(p, self.client.get_children_async(p, watch=self._watch)) for p in paths]
+        self.stats.count('zk_reads', len(pending))
+        return [(p, result.get()) for p, result in pending]
+
+    def _read_data(self, paths):
+        pending = [(p, self.client.get_async(p, watch=self._watch)) for p in paths]
+        self.stats.count('zk_reads', len(pending))
+        data = []
+        for p, result in pending:
+            d = result.get()[0]
+            self.stats.count('zk_bytes', len(d))
+            data.append((p, d))
+        return data
+
+    def reload(self):
+        '''
+        Reads the broker and topic trees again and re-arms every watch.
+        '''
+        self.stale = False
+        with self.reading():
+            brokers, addresses, layout = self._read_layout()
+
+        with self.lock:
+            self.brokers = brokers
+            self.addresses = addresses
+            self.topics = layout
+
+    def _read_layout(self):
+        id_root = ZkClient._zjoin([self.broker_root, 'ids'])
+        t_root = ZkClient._zjoin([self.broker_root, 'topics'])
+
+        try:
+            (_, ids), (_, topics) = self._read_children([id_root, t_root])
+
+            brokers = {}
+            addresses = {}
+            for path, n in self._read_data([ZkClient._zjoin([id_root, i]) for i in ids]):
+                b = ZkKafkaBroker(path.rsplit('/', 1)[1], n.split(':')[1], int(n.split(':')[2]))
+                brokers[b.id] = b
+                addresses[(b.host, b.port)] = b.id
+
+            layout = dict((t, {}) for t in topics)
+            nodes = []
+            for path, children in self._read_children([ZkClient._zjoin([t_root, t]) for t in topics]):
+                nodes.extend(ZkClient._zjoin([path, c]) for c in children)
+            for path, n in self._read_data(nodes):
+                t, b = path.rsplit('/', 2)[1:]
+                layout[t][b] = int(n)
+        except NoNodeError:
+            # A node vanished between reads; the watch on its parent has
+            # fired too.
+            raise ZkError('Broker nodes do not exist in Zookeeper')
+        return brokers, addresses, layout
+
+    def _current(self):
+        if self.stale:
+            self.reload()
+
+    def broker(self, host, port):
+        '''
+        Returns the ZkKafkaBroker registered at host:port, or None.
+        '''
+        self._current()
+        with self.lock:
+            b = self.addresses.get((host, int(port)))
+            return self.brokers.get(b) if b is not None else None
+
+    def validate(self, host, port, topic, partition):
+        '''
+        Returns None if the broker at host:port holds partition of topic,
+        or otherwise a description of why not.
+        '''
+        self._current()
+        with self.lock:
+            b = self.addresses.get((host, int(port)))
+            if b is None:
+                return 'broker %s:%s is not registered' % (host, port)
+            layout = self.topics.get(topic)
+            if layout is None:
+                return 'topic %s does not exist' % topic
+            n = layout.get(b)
+            if n is None:
+                return 'topic %s is not on broker %s' % (topic, b)
+            if not 0 <= int(partition) < n:
+                return 'topic %s has %d partitions on broker %s' % (topic, n, b)
+        return None
@@ -0,0 +1,246 @@
+# Records the Spouts read from Zookeeper and the offsets fetched from Kafka
+# during refreshes to a capture file, and replays them later in place of
+# Zookeeper and Kafka, at the recorded pace or faster.
+
+import sys
+import zlib
+import time
+import struct
+import hashlib
+import simplejson as json
+
+from zkclient import ZkKafkaSpout
+from fetcher import PartitionOffsets
+from clock import monotonic
+
+class CaptureError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+# A capture file is MAGIC followed by frames, each a FRAME header of type,
+# clock.monotonic() time when recorded and payload length, then the payload.
+MAGIC = 'SKC1'
+FRAME = struct.Struct('<cdI')
+
+SPOUTS = 'S'            # zlib compressed JSON list of [spout id, partitions]
+SAME_SPOUTS = 'R'       # The same Spouts as the previous SPOUTS frame; no payload
+OFFSETS = 'O'           # zlib compressed offsets, see encode_offsets()
+
+# Offsets payloads are a length prefixed JSON list of strings, a length
+# prefixed JSON dict of errors, then one OFFSET per partition with hosts
+# and topics given as indexes into the strings.
+LENGTH = struct.Struct('<I')
+OFFSET = struct.Struct('<IIiiqq')       # Host, topic, port, partition, earliest, latest
+
+def encode_offsets(results, errors):
+    strings = {}
+
+    def index(s):
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings)
+        return i
+
+    packed = [OFFSET.pack(index(host), index(topic), port, partition, o.earliest, o.latest)
+              for (host, port, topic, partition), o in results.iteritems()]
+    errors = [[host, port, topic, partition, error]
+              for (host, port, topic, partition), error in errors.iteritems()]
+
+    table = json.dumps(sorted(strings, key=strings.get))
+    errors = json.dumps(errors)
+    return zlib.compress(LENGTH.pack(len(table)) + table + LENGTH.pack(len(errors)) + errors + ''.join(packed))
+
+def decode_offsets(payload):
+    data = zlib.decompress(payload)
+    n = LENGTH.unpack_from(data, 0)[0]
+    strings = json.loads(data[LENGTH.size:LENGTH.size + n])
+    pos = LENGTH.size + n
+    n = LENGTH.unpack_from(data, pos)[0]
+    errors = dict(((host, port, topic, partition), error)
+                  for host, port, topic, partition, error in json.loads(data[pos + LENGTH.size:pos + LENGTH.size + n]))
+    pos += LENGTH.size + n
+
+    results = {}
+    for offset in xrange(pos, len(data), OFFSET.size):
+        host, topic, port, partition, earliest, latest = OFFSET.unpack_from(data, offset)
+        results[(strings[host], port, strings[topic], partition)] = PartitionOffsets(earliest, latest)
+    return results, errors
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.last_spouts = None
+        self.last_digest = None     # Of the JSON of the last SPOUTS frame
+
+    def _write(self, frame_type, payload=''):
+        self.f.write(FRAME.pack(frame_type, monotonic(), len(payload)))
+        self.f.write(payload)
+
+    def spouts(self, spouts):
+        # Spouts read afresh every refresh are new objects even when
+        # nothing changed, so they are compared by what would be written.
+        # Those from a SpoutCache are the same tuple until something
+        # changes in Zookeeper, and are not even serialized again.
+        if spouts is self.last_spouts:
+            self._write(SAME_SPOUTS)
+        else:
+            data = json.dumps([[s.id, s.partitions] for s in spouts], sort_keys=True)
+            digest = hashlib.sha1(data).digest()
+            if digest == self.last_digest:
+                self._write(SAME_SPOUTS)
+            else:
+                self._write(SPOUTS, zlib.compress(data))
+                self.last_digest = digest
+            self.last_spouts = spouts
+        self.f.flush()
+
+    def offsets(self, results, errors):
+        self._write(OFFSETS, encode_offsets(results, errors))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def read_frames(path):
+    '''
+    Generates the (type, time, payload) of every frame in a capture file.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('%s is not a capture file' % path)
+        while True:
+            header = f.read(FRAME.size)
+            if len(header) < FRAME.size:
+                # A capture cut short by a crash ends at its last whole frame.
+                return
+            frame_type, when, n = FRAME.unpack(header)
+            payload = f.read(n)
+            if len(payload) < n:
+                return
+            yield frame_type, when, payload
+
+def recording_source(get_spouts, writer):
+    '''
+    Wraps a function returning Spouts so that every result is recorded.
+    '''
+    def get():
+        spouts = get_spouts()
+        writer.spouts(spouts)
+        return spouts
+    return get
+
+class RecordingFetcher(object):
+    '''
+    Wraps a fetcher so that every result of fetch() is recorded.
+    '''
+    def __init__(self, fetcher, writer):
+        self.fetcher = fetcher
+        self.writer = writer
+        self.batch_size = fetcher.batch_size
+        self.max_inflight = fetcher.max_inflight
+
+    def fetch(self, work, positions=None):
+        results, errors = self.fetcher.fetch(work, positions)
+        self.writer.offsets(results, errors)
+        return results, errors
+
+    def last_known(self, key):
+        return self.fetcher.last_known(key)
+
+class Replay(object):
+    '''
+    Plays a capture file back. get_spouts() returns the Spouts of the next
+    recorded refresh, waiting until it is due at speed times the recorded
+    pace, or not at all if speed is 0, and fetcher answers fetch() with the
+    offsets recorded during that refresh. clock() returns the recorded time
+    of the refresh being replayed, for timing rates as they were recorded.
+
+    Once the capture is exhausted, get_spouts() raises CaptureError.
+    '''
+    def __init__(self, path, speed=1.0):
+        self.frames = read_frames(path)
+        self.speed = speed
+        self.pending = None         # Frame read ahead of its refresh
+        self.spouts = ()
+        self.offsets = []           # Offsets payloads of the current refresh
+        self.decoded = None         # Their (results, errors), once needed
+        self.now = None
+        self.start = None           # (recorded time, monotonic()) of the first refresh
+        self.fetcher = _ReplayFetcher(self)
+
+    def _next(self):
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            return frame
+        return next(self.frames, None)
+
+    def get_spouts(self):
+        frame = self._next()
+        while frame is not None and frame[0] not in (SPOUTS, SAME_SPOUTS):
+            frame = self._next()
+        if frame is None:
+            raise CaptureError('End of capture')
+
+        frame_type, when, payload = frame
+        if frame_type == SPOUTS:
+            self.spouts = tuple(ZkKafkaSpout._make(s) for s in json.loads(zlib.decompress(payload)))
+
+        self.offsets = []
+        self.decoded = None
+        frame = self._next()
+        while frame is not None and frame[0] == OFFSETS:
+            self.offsets.append(frame[2])
+            frame = self._next()
+        self.pending = frame
+
+        if self.start is None:
+            self.start = (when, monotonic())
+        elif self.speed > 0:
+            wait = self.start[1] + (when - self.start[0]) / self.speed - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+        self.now = when
+        return self.spouts
+
+    def clock(self):
+        return self.now
+
+class _ReplayFetcher(object):
+    # However the recorded refresh was split into fetches, each fetch()
+    # is answered from all the offsets recorded during it.
+    batch_size = sys.maxint
+    max_inflight = 1
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.known = {}
+
+    def fetch(self, work, positions=None):
+        replay = self.replay
+        if replay.decoded is None:
+            replay.decoded = ({}, {})
+            for payload in replay.offsets:
+                results, errors = decode_offsets(payload)
+                replay.decoded[0].update(results)
+                replay.decoded[1].update(errors)
+        recorded_results, recorded_errors = replay.decoded
+
+        results = {}
+        errors = {}
+        for (host, port), topic_partitions in work.items():
+            for topic, partition in topic_partitions:
+                key = (host, port, topic, partition)
+                if key in recorded_results:
+                    results[key] = recorded_results[key]
+                else:
+                    errors[key] = recorded_errors.get(key, 'not in capture')
+        self.known.update(results)
+        return results, errors
+
+    def last_known(self, key):
+        return self.known.get(key)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# skq: answers an skmon command line from a resident skexport, queried
+# over a UNIX socket, and falls back to running skmon itself when none
+# answers. Only the standard library modules it needs are imported before
+# falling back, so an answered query starts and exits in milliseconds.
+
+import os
+import sys
+import stat
+import struct
+import socket
+
+
+def default_socket():
+    '''
+    Returns the socket path in $XDG_RUNTIME_DIR, a directory only its
+    user can write to, or else one in /tmp named after the user.
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'stormkafkamon.sock')
+    return '/tmp/stormkafkamon-%d.sock' % os.getuid()
+
+DEFAULT_SOCKET = default_socket()
+SOCKET_ENV = 'STORMKAFKAMON_SOCKET'
+TIMEOUT = 5.0
+
+# A reply is a status line, ANSWERED and skmon's exit status or DECLINED and
+# why, followed by the output of the command line.
+ANSWERED = 'ok'
+DECLINED = 'declined'
+
+PEERCRED = struct.Struct('3i')          # Pid, uid and gid of the listening process
+# Python 2 does not name the option, so its value on Linux is used; other
+# platforms have no such option.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17 if sys.platform.startswith('linux') else None)
+
+
+def encode_args(args):
+    return '\0'.join(args)
+
+
+def decode_args(data):
+    return data.split('\0') if data else []
+
+
+def socket_path(args):
+    '''
+    Returns the socket given by --socket in args, or else by the
+    STORMKAFKAMON_SOCKET environment variable, or DEFAULT_SOCKET.
+    '''
+    for i, arg in enumerate(args):
+        if arg.startswith('--socket='):
+            return arg[len('--socket='):]
+        if arg == '--socket' and i + 1 < len(args) and not args[i + 1].startswith('-'):
+            return args[i + 1]
+    return os.environ.get(SOCKET_ENV, DEFAULT_SOCKET)
+
+
+def query(path, args, timeout=TIMEOUT):
+    '''
+    Sends the command line args to the skexport listening on path, and
+    returns the output and exit status it answered with, or None if none
+    is listening, it does not answer within timeout seconds, or it
+    declined.
+
+    Only a socket owned by, and listened on by, this user is trusted, so
+    that another user cannot answer in place of skexport. Who listens is
+    only known where SO_PEERCRED is, as on Linux; elsewhere the owner of
+    the path is all that is checked.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    chunks = []
+    try:
+        s.connect(path)
+        if SO_PEERCRED is not None:
+            # The path may have been replaced since it was checked.
+            creds = s.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, PEERCRED.size)
+            if PEERCRED.unpack(creds)[1] != os.getuid():
+                return None
+        s.sendall(encode_args(args))
+        s.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        s.close()
+
+    status, _, body = ''.join(chunks).partition('\n')
+    status = status.split()
+    if not status or status[0] != ANSWERED:
+        return None
+    return body, int(status[1]) if len(status) > 1 else 0
+
+
+def main():
+    args = sys.argv[1:]
+    answer = query(socket_path(args), args)
+    if answer is not None:
+        sys.stdout.write(answer[0])
+        return answer[1]
+
+    from monitor import main as direct
+    return direct()
+
+if __name__ == '__main__':
+    sys.exit(main())
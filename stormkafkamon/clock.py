@@ -0,0 +1,85 @@
+# Monotonic clock, for timing intervals that must not jump when the wall
+# clock is adjusted.
+
+import sys
+import time
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# The value of CLOCK_MONOTONIC differs between platforms, by the prefix of
+# sys.platform.
+_CLOCK_MONOTONIC = [
+    ('linux', 1),
+    ('darwin', 6),
+    ('freebsd', 4),
+    ('dragonfly', 4),
+    ('openbsd', 3),
+    ('netbsd', 3),
+    ('sunos', 4),
+]
+
+def _clock_id():
+    for prefix, clock_id in _CLOCK_MONOTONIC:
+        if sys.platform.startswith(prefix):
+            return clock_id
+    return None
+
+def _clock_gettime():
+    for name in ['rt', 'c']:
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            return ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            pass
+    return None
+
+def _wall_clock(reason):
+    '''
+    Returns time.time in place of a monotonic clock, logging why the first
+    time it is read, by which time logging has been set up.
+    '''
+    warned = []
+
+    def monotonic():
+        if not warned:
+            warned.append(True)
+            logger.warning('No monotonic clock (%s); timing by the wall clock, which may jump', reason)
+        return time.time()
+    return monotonic
+
+def _gettime_monotonic():
+    '''
+    Returns a monotonic clock from clock_gettime(), or one from _wall_clock()
+    if this platform has none, or it fails when tried.
+    '''
+    clock_id = _clock_id()
+    if clock_id is None:
+        return _wall_clock('CLOCK_MONOTONIC is not known on %s' % sys.platform)
+    gettime = _clock_gettime()
+    if gettime is None:
+        return _wall_clock('clock_gettime() not found')
+    gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    if gettime(clock_id, ctypes.byref(_Timespec())) != 0:
+        return _wall_clock('clock_gettime() failed with errno %d' % ctypes.get_errno())
+
+    def monotonic():
+        '''
+        Returns seconds since an arbitrary fixed point, as a float.
+        '''
+        t = _Timespec()
+        gettime(clock_id, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec / 1000000000.0
+    return monotonic
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = _gettime_monotonic()
@@ -0,0 +1,233 @@
+# Estimates how many seconds behind its topic a Spout is, and when it will
+# catch up, from straight lines fitted to the latest offset and the delta
+# over a sliding window.
+
+from collections import deque, namedtuple
+
+DEFAULT_WINDOW = 300
+
+CAUGHT_UP = 'caught up'
+CATCHING_UP = 'catching up'
+FALLING_BEHIND = 'falling behind'
+UNKNOWN = 'unknown'
+
+LagEstimate = namedtuple('LagEstimate',
+    [
+        'time_lag',         # Seconds of production the delta amounts to, or None
+        'eta',              # Seconds until the delta reaches 0, or None
+        'state'             # CAUGHT_UP, CATCHING_UP, FALLING_BEHIND or UNKNOWN
+    ])
+
+NO_ESTIMATE = LagEstimate(None, None, UNKNOWN)
+
+def _slope(ts, ys):
+    '''
+    Returns the least-squares slope of ys against ts, or None if there are
+    fewer than two distinct times.
+    '''
+    n = len(ts)
+    if n < 2:
+        return None
+    t0 = ts[0]
+    y0 = ys[0]
+    st = sty = stt = sy = 0.0
+    for t, y in zip(ts, ys):
+        t -= t0
+        y -= y0
+        st += t
+        sy += y
+        stt += t * t
+        sty += t * y
+    d = n * stt - st * st
+    if d <= 0:
+        return None
+    return (n * sty - st * sy) / d
+
+def estimate(delta, added_rate, delta_slope):
+    '''
+    Returns the LagEstimate for a delta, given the rate messages are added
+    at and the rate the delta grows at, either of which may be None if not
+    known.
+    '''
+    if delta <= 0:
+        return LagEstimate(0.0, 0.0, CAUGHT_UP)
+    if delta_slope is None:
+        return NO_ESTIMATE
+
+    time_lag = delta / added_rate if added_rate else None
+    if delta_slope < 0:
+        return LagEstimate(time_lag, delta / -delta_slope, CATCHING_UP)
+    # A delta that holds steady is never worked off either.
+    return LagEstimate(time_lag, None, FALLING_BEHIND)
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    if seconds < 86400:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dd%02dh' % (seconds // 86400, seconds % 86400 // 3600)
+
+def format_eta(e):
+    '''
+    Returns the catch-up ETA of a LagEstimate as shown in a column.
+    '''
+    if e.state == FALLING_BEHIND:
+        return 'behind'
+    if e.state == UNKNOWN:
+        return '?'
+    return format_duration(e.eta)
+
+class SlidingRegression(object):
+    '''
+    Least-squares line through the (time, value) samples of the last
+    interval seconds. Running sums over the samples in a deque are kept,
+    so adding, expiring and reading the slope are all amortized O(1).
+    Times and values are taken relative to the first sample ever added,
+    which keeps the sums of squares small enough to stay precise.
+    '''
+    def __init__(self, interval):
+        self.interval = float(interval)
+        self.samples = deque()
+        self.origin = None
+        self.n = 0
+        self.st = self.sy = self.stt = self.sty = 0.0
+
+    def add(self, t, y):
+        if self.origin is None:
+            self.origin = (t, y)
+        t -= self.origin[0]
+        y -= self.origin[1]
+        self.samples.append((t, y))
+        self.n += 1
+        self.st += t
+        self.sy += y
+        self.stt += t * t
+        self.sty += t * y
+
+        while t - self.samples[0][0] > self.interval:
+            ot, oy = self.samples.popleft()
+            self.n -= 1
+            self.st -= ot
+            self.sy -= oy
+            self.stt -= ot * ot
+            self.sty -= ot * oy
+
+    def slope(self):
+        if self.n < 2:
+            return None
+        d = self.n * self.stt - self.st * self.st
+        # Sums left over from expired samples are not exactly zero.
+        if d <= 1e-9 * self.n * self.stt:
+            return None
+        return (self.n * self.sty - self.st * self.sy) / d
+
+class LagEstimator(object):
+    '''
+    Lag estimates for a SummaryAggregator, over the last window seconds.
+
+    For the totals and the rollup groups, a SlidingRegression of the
+    produced count and of the delta is added to on every refresh. For
+    single partitions, which are too many to fit on every refresh, up to
+    SAMPLES of the columns' latest and delta arrays are kept over the
+    window, and lines are fitted through them only for the rows asked
+    about. PartitionColumns replaces its arrays rather than modifying
+    them, so they are kept without copying.
+    '''
+    SAMPLES = 10
+
+    def __init__(self, columns, window=DEFAULT_WINDOW):
+        self.columns = columns
+        self.window = window
+        self.samples = deque()      # (time, latest, delta) arrays
+        self.now = None
+        self.produced = SlidingRegression(window)
+        self.total_produced = 0
+        self.delta = SlidingRegression(window)
+        self.groups = {}            # (dimension, name) -> (produced, delta) SlidingRegressions
+
+    def update(self, time, rollups):
+        c = self.columns
+        self.now = time
+        if not self.samples or time - self.samples[-1][0] >= float(self.window) / LagEstimator.SAMPLES:
+            self.samples.append((time, c.latest, c.delta))
+        while time - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+        # Cumulative, like the groups' produced, so partitions appearing or
+        # having their offsets read at last do not count as produced.
+        self.total_produced += c.added
+        self.produced.add(time, self.total_produced)
+        self.delta.add(time, c.sums[2])
+
+        groups = {}
+        for dimension, named in rollups.groups.iteritems():
+            for name, g in named.iteritems():
+                key = (dimension, name)
+                r = self.groups.get(key)
+                if r is None:
+                    r = (SlidingRegression(self.window), SlidingRegression(self.window))
+                r[0].add(time, g.produced)
+                r[1].add(time, g.delta)
+                groups[key] = r
+        self.groups = groups
+
+    def estimate_totals(self):
+        return estimate(self.columns.sums[2], self.produced.slope(), self.delta.slope())
+
+    def estimate_group(self, dimension, g):
+        r = self.groups.get((dimension, g.name))
+        if r is None:
+            return NO_ESTIMATE
+        return estimate(g.delta, r[0].slope(), r[1].slope())
+
+    def estimate_row(self, row):
+        c = self.columns
+        if c.delta[row] <= 0:
+            return estimate(c.delta[row], None, None)
+        ts = []
+        latest = []
+        delta = []
+        for t, l, d in self.samples:
+            # Rows added since a sample have no value in it.
+            if row < len(l):
+                ts.append(t)
+                latest.append(l[row])
+                delta.append(d[row])
+        if self.samples and self.samples[-1][0] != self.now:
+            ts.append(self.now)
+            latest.append(c.latest[row])
+            delta.append(c.delta[row])
+        return estimate(c.delta[row], _slope(ts, latest), _slope(ts, delta))
+
+class HistoryEstimator(object):
+    '''
+    Lag estimates from the records of a HistoryStore, for output made from
+    a single refresh.
+    '''
+    def __init__(self, history, window=DEFAULT_WINDOW):
+        self.history = history
+        self.window = window
+
+    def _estimate(self, records, now, latest, delta):
+        ts = [r[0] for r in records] + [now]
+        latests = [r[2] for r in records] + [latest]
+        deltas = [r[2] - r[3] for r in records] + [delta]
+        return estimate(delta, _slope(ts, latests), _slope(ts, deltas))
+
+    def estimate_totals(self, summary, now):
+        # The records hold what was produced between them, not offsets, so
+        # production is fitted to their running sums alone.
+        records = list(self.history.totals_since(now - self.window))
+        ts = [r[0] for r in records]
+        produced = [r[4] for r in records]
+        deltas = [r[3] for r in records] + [summary.total_delta]
+        return estimate(summary.total_delta, _slope(ts, produced), _slope(ts + [now], deltas))
+
+    def estimate_partition(self, p, now):
+        records = list(self.history.partition_records((p.broker, p.topic, p.partition), now - self.window))
+        return self._estimate(records, now, p.latest, p.delta)
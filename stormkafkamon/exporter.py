@@ -0,0 +1,260 @@
+# Refreshes a PartitionsSummary in the background and serves the latest one
+# over HTTP, as Prometheus text on /metrics and as JSON on /json. Timing
+# stats for the refreshes are served as JSON on /stats.
+
+import time
+import logging
+import threading
+import simplejson as json
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from clock import monotonic
+from processor import process, split_summary, Totals, STATUS_UNKNOWN, STATUS_INVALID
+from zkclient import TopologyFilter
+from summary_aggregator import SummaryAggregator
+from stats import Stats, dump as dump_stats
+
+logger = logging.getLogger(__name__)
+
+class Snapshot(object):
+    '''
+    One refresh, already rendered into the bodies served to clients, so
+    that answering a request is a lookup rather than a computation.
+    '''
+    def __init__(self, summary, taken, taken_wall, duration, metrics, json_body):
+        self.summary = summary
+        self.taken = taken              # clock.monotonic() when taken
+        self.taken_wall = taken_wall    # time.time() when taken
+        self.duration = duration        # Seconds the refresh took
+        self.metrics = metrics
+        self.json = json_body
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join('%s="%s"' % (k, _escape(labels[k])) for k in sorted(labels)) + '}'
+
+def render_metrics(topologies, views, duration, taken_wall):
+    '''
+    Returns the Prometheus text exposition of the summaries in views, a
+    list of (topology, PartitionsSummary, SummaryAggregator), without the
+    metrics that depend on the time of the scrape. Metrics of the refresh
+    as a whole are labelled with topologies, the TopologyFilter used.
+    '''
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in samples:
+            lines.append('%s%s %s' % (name, labels, value))
+
+    topologies = [(_labels(topology=topology), summary, aggregator)
+                  for topology, summary, aggregator in views]
+    gauge('stormkafkamon_total_depth', 'Messages held by Kafka across all partitions.',
+          [(t, summary.total_depth) for t, summary, aggregator in topologies])
+    gauge('stormkafkamon_total_lag', 'Messages not yet consumed across all partitions.',
+          [(t, summary.total_delta) for t, summary, aggregator in topologies])
+    gauge('stormkafkamon_partitions', 'Number of partitions consumed.',
+          [(t, summary.num_partitions) for t, summary, aggregator in topologies])
+    gauge('stormkafkamon_brokers', 'Number of Kafka brokers.',
+          [(t, summary.num_brokers) for t, summary, aggregator in topologies])
+    gauge('stormkafkamon_stale_partitions', 'Partitions showing broker offsets from an earlier refresh.',
+          [(t, summary.num_stale) for t, summary, aggregator in topologies])
+    gauge('stormkafkamon_unknown_partitions',
+          'Partitions whose broker offsets have never been read, or that Kafka does not have.',
+          [(t, summary.num_unknown) for t, summary, aggregator in topologies])
+
+    # Partitions without broker offsets have no lag or depth to report.
+    rows = [(p, _labels(topology=topology, broker=p.broker, topic=p.topic,
+                        partition=p.partition, spout=p.spout))
+            for topology, summary, aggregator in views
+            for p in summary.partitions if p.status != STATUS_UNKNOWN and p.status != STATUS_INVALID]
+    gauge('stormkafkamon_partition_lag', 'Messages not yet consumed by the Spout.',
+          [(labels, p.delta) for p, labels in rows])
+    gauge('stormkafkamon_partition_depth', 'Messages held by Kafka for the partition.',
+          [(labels, p.depth) for p, labels in rows])
+    gauge('stormkafkamon_partition_earliest_offset', 'Earliest offset held by Kafka.',
+          [(labels, p.earliest) for p, labels in rows])
+    gauge('stormkafkamon_partition_latest_offset', 'Latest offset held by Kafka.',
+          [(labels, p.latest) for p, labels in rows])
+    gauge('stormkafkamon_partition_current_offset', 'Offset committed by the Spout.',
+          [(labels, p.current) for p, labels in rows])
+
+    rates = [(topology, aggregator.window_rates()) for topology, summary, aggregator in views]
+    gauge('stormkafkamon_added_per_second', 'Messages added per second over a window, -1 until known.',
+          [(_labels(topology=topology, window=i), added)
+           for topology, windows in rates for i, added, removed in windows])
+    gauge('stormkafkamon_removed_per_second', 'Messages consumed per second over a window, -1 until known.',
+          [(_labels(topology=topology, window=i), removed)
+           for topology, windows in rates for i, added, removed in windows])
+
+    t = _labels(topology=topologies)
+    gauge('stormkafkamon_refresh_duration_seconds', 'Seconds taken by the last refresh.',
+          [(t, '%.6f' % duration)])
+    gauge('stormkafkamon_snapshot_timestamp_seconds', 'Unix time of the last refresh.',
+          [(t, '%.3f' % taken_wall)])
+
+    return '\n'.join(lines) + '\n'
+
+def render_scrape_metrics(topologies, snapshot, errors):
+    '''
+    Returns the Prometheus text for metrics that change between scrapes of
+    the same snapshot.
+    '''
+    t = _labels(topology=topologies)
+    return ('# HELP stormkafkamon_snapshot_age_seconds Seconds since the last refresh.\n'
+            '# TYPE stormkafkamon_snapshot_age_seconds gauge\n'
+            'stormkafkamon_snapshot_age_seconds%s %.3f\n'
+            '# HELP stormkafkamon_refresh_errors_total Refreshes that failed.\n'
+            '# TYPE stormkafkamon_refresh_errors_total counter\n'
+            'stormkafkamon_refresh_errors_total%s %d\n' % (t, monotonic() - snapshot.taken, t, errors))
+
+def _topology_json(topology, summary, aggregator):
+    rates = aggregator.window_rates()
+    return {
+        'topology': topology,
+        'total_depth': summary.total_depth,
+        'total_delta': summary.total_delta,
+        'num_partitions': summary.num_partitions,
+        'num_brokers': summary.num_brokers,
+        'num_stale': summary.num_stale,
+        'num_unknown': summary.num_unknown,
+        'added_per_second': dict((str(i), added) for i, added, removed in rates),
+        'removed_per_second': dict((str(i), removed) for i, added, removed in rates),
+        'partitions': [p._asdict() for p in summary.partitions],
+    }
+
+def render_json(views, duration, taken_wall, single):
+    '''
+    Returns the JSON body for the summaries in views. If single is set,
+    only one topology is monitored and its summary is the whole body, as
+    it was before several could be; otherwise the body holds a list of
+    them under 'topologies'.
+    '''
+    if single:
+        body = _topology_json(*views[0])
+    else:
+        body = {'topologies': [_topology_json(*v) for v in views]}
+    body['timestamp'] = taken_wall
+    body['refresh_duration'] = duration
+    return json.dumps(body)
+
+class SnapshotRefresher(threading.Thread):
+    '''
+    Calls get_spouts and process() every interval seconds and publishes
+    the result as the current Snapshot, with one aggregator per topology
+    selected by topologies, made by aggregator_factory(topology,
+    zookeeper). A failed refresh leaves the previous snapshot in place.
+
+    Aggregators are given the time of each refresh by clock, which a replay
+    replaces with the recorded one.
+    '''
+    def __init__(self, get_spouts, fetcher, topologies, zookeeper, interval,
+                 stats=None, stats_file=None, registry=None, aggregator_factory=SummaryAggregator,
+                 clock=monotonic):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_spouts = get_spouts
+        self.fetcher = fetcher
+        self.topologies = TopologyFilter.of(topologies)
+        self.zookeeper = zookeeper
+        self.interval = interval
+        self.aggregator_factory = aggregator_factory
+        self.aggregators = dict((t, aggregator_factory(t, zookeeper)) for t in self.topologies.named())
+        self.snapshot = None
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.stats = stats if stats is not None else Stats()
+        self.stats_file = stats_file
+        self.registry = registry
+        self.clock = clock
+
+    def refresh(self):
+        start = monotonic()
+        with self.stats.phase('zk'):
+            spouts = self.get_spouts()
+        with self.stats.phase('offsets'):
+            summary = process(spouts, self.fetcher, self.registry)
+        taken = monotonic()
+        taken_wall = time.time()
+        duration = taken - start
+
+        with self.stats.phase('aggregate'):
+            summaries = split_summary(summary, self.topologies)
+            for t in summaries:
+                if t not in self.aggregators:
+                    self.aggregators[t] = self.aggregator_factory(t, self.zookeeper)
+            empty = Totals().summary(())
+            when = self.clock()
+            views = []
+            for t in sorted(self.aggregators):
+                s = summaries.get(t, empty)
+                self.aggregators[t].add_summary(s, when)
+                views.append((t, s, self.aggregators[t]))
+        with self.stats.phase('render'):
+            self.snapshot = Snapshot(summary, taken, taken_wall, duration,
+                render_metrics(self.topologies, views, duration, taken_wall),
+                render_json(views, duration, taken_wall, self.topologies.single() is not None))
+
+        if self.stats_file is not None:
+            dump_stats(self.stats, self.stats_file)
+
+    def run(self):
+        deadline = monotonic()
+        while not self.stopping.is_set():
+            try:
+                self.refresh()
+            except Exception, e:
+                self.errors += 1
+                logger.warning('Refresh failed: %s', e)
+
+            deadline = max(deadline + self.interval, monotonic())
+            self.stopping.wait(max(0.0, deadline - monotonic()))
+
+    def stop(self):
+        self.stopping.set()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        refresher = self.server.refresher
+        snapshot = refresher.snapshot
+        path = self.path.split('?', 1)[0]
+
+        if path == '/stats':
+            self._send(json.dumps(refresher.stats.as_dict()), 'application/json')
+            return
+        if path not in ('/metrics', '/json'):
+            self.send_error(404)
+            return
+        if snapshot is None:
+            self.send_error(503, 'No snapshot taken yet')
+            return
+
+        if path == '/metrics':
+            body = snapshot.metrics + render_scrape_metrics(refresher.topologies, snapshot, refresher.errors)
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = snapshot.json
+            content_type = 'application/json'
+
+        self._send(body, content_type)
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, refresher):
+        HTTPServer.__init__(self, address, _Handler)
+        self.refresher = refresher
@@ -0,0 +1,282 @@
+# Fetches earliest and latest partition offsets from Kafka brokers, batching
+# every partition led by a broker into as few requests as possible.
+
+import time
+import threading
+from Queue import Queue, Empty
+from collections import namedtuple
+from kafka.common import OffsetRequest
+
+from brokerpool import BrokerPoolError, CircuitBreaker
+from clock import monotonic
+from stats import Stats
+
+EARLIEST = -2
+LATEST = -1
+
+PartitionOffsets = namedtuple('PartitionOffsets',
+    [
+        'earliest',         # Earliest offset within partition on broker
+        'latest'            # Latest offset within partition on broker
+    ])
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class OffsetFetcher(object):
+    '''
+    Fetches offsets for many partitions at once. Each broker receives one
+    request for the earliest offsets and one for the latest offsets of up
+    to batch_size partitions.
+
+    Up to max_inflight brokers are queried in parallel, each from its own
+    worker thread. A broker that has not answered all its batches within
+    timeout seconds has its remaining partitions reported as errors.
+
+    A request that fails is retried up to retries times on a fresh
+    connection, backing off from backoff seconds, within the broker's
+    deadline; the pool does not retry on its own as well. Brokers that keep
+    failing are skipped for a while by breaker, a CircuitBreaker.
+
+    The latency of every request is recorded per broker in stats.
+    '''
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_MAX_INFLIGHT = 8
+    DEFAULT_TIMEOUT = 10.0
+    DEFAULT_RETRIES = 2
+    DEFAULT_BACKOFF = 0.1
+    ABANDON_GRACE = 1.0
+
+    def __init__(self, pool, batch_size=DEFAULT_BATCH_SIZE,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, timeout=DEFAULT_TIMEOUT, stats=None,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, breaker=None):
+        self.pool = pool
+        self.stats = stats if stats is not None else Stats()
+        self.batch_size = max(1, int(batch_size))
+        self.max_inflight = max(1, int(max_inflight))
+        self.timeout = timeout
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.known = {}             # (host, port, topic, partition) -> last PartitionOffsets
+        self.lock = threading.Lock()    # Held over giving up on a broker and breaker updates
+
+    def _send(self, host, port, topic_partitions, when):
+        '''
+        Sends one batched offset request and returns a tuple of a dict,
+        (topic, partition) -> offset, and a dict of (topic, partition) ->
+        error description for partitions without a usable answer.
+        '''
+        requests = [OffsetRequest(t, p, when, 1) for t, p in topic_partitions]
+
+        def request(k):
+            responses = k.send_offset_request(requests, fail_on_error=False)
+            # A connection that fails mid-session is answered with the
+            # exception in place of responses, rather than raising it.
+            for r in responses:
+                if isinstance(r, Exception):
+                    raise r
+            return responses
+
+        start = monotonic()
+        try:
+            responses = self.pool.call(host, port, request, retry=False)
+        finally:
+            self.stats.record_rpc('%s:%s' % (host, port), monotonic() - start)
+
+        offsets = {}
+        errors = {}
+        wanted = set(topic_partitions)
+
+        # Responses are matched on (topic, partition) rather than position,
+        # since brokers are free to answer in any order.
+        for r in responses:
+            key = (getattr(r, 'topic', None), getattr(r, 'partition', None))
+            if key not in wanted:
+                continue
+            if getattr(r, 'error', 0):
+                errors[key] = 'error code %d' % r.error
+            elif not r.offsets:
+                errors[key] = 'no offsets returned'
+            else:
+                offsets[key] = r.offsets[0]
+
+        for key in wanted:
+            if key not in offsets and key not in errors:
+                errors[key] = 'no response'
+
+        return offsets, errors
+
+    def _send_with_retries(self, host, port, batch, when, deadline):
+        '''
+        Calls _send, retrying up to self.retries times after a failure with
+        an exponentially growing pause, as long as the pause ends before
+        deadline. No attempt is started after deadline.
+        '''
+        delay = self.backoff
+        attempt = 0
+        while True:
+            if monotonic() >= deadline:
+                raise BrokerPoolError('Request to Kafka broker %s:%s timed out after %.1fs' %
+                                      (host, port, self.timeout))
+            try:
+                return self._send(host, port, batch, when)
+            except BrokerPoolError:
+                attempt += 1
+                if attempt > self.retries or monotonic() + delay >= deadline:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    def fetch_broker(self, host, port, topic_partitions, abandoned=()):
+        '''
+        Returns a tuple of a dict, (topic, partition) -> PartitionOffsets,
+        and a dict of (topic, partition) -> error description, for all
+        given partitions on a single broker.
+
+        The broker counts as failed for the circuit breaker if it could not
+        be reached for any batch. Once fetch() has given up on the broker,
+        which it adds to abandoned, no more batches are sent and the
+        breaker is left to fetch().
+        '''
+        results = {}
+        errors = {}
+        topic_partitions = sorted(set(topic_partitions))
+        deadline = monotonic() + self.timeout
+        reached = False
+
+        for batch in _chunks(topic_partitions, self.batch_size):
+            if (host, port) in abandoned:
+                break
+            if monotonic() > deadline:
+                for key in batch:
+                    errors[key] = 'timed out after %.1fs' % self.timeout
+                continue
+
+            try:
+                earliest, e_errors = self._send_with_retries(host, port, batch, EARLIEST, deadline)
+                latest, l_errors = self._send_with_retries(host, port, batch, LATEST, deadline)
+            except BrokerPoolError, e:
+                for key in batch:
+                    errors[key] = str(e)
+                continue
+
+            reached = True
+            for key in batch:
+                if key in earliest and key in latest:
+                    results[key] = PartitionOffsets(earliest[key], latest[key])
+                else:
+                    errors[key] = e_errors.get(key) or l_errors.get(key)
+
+        with self.lock:
+            if (host, port) in abandoned:
+                pass
+            elif reached:
+                self.breaker.success((host, port))
+            elif topic_partitions:
+                self.breaker.failure((host, port))
+
+        return results, errors
+
+    def _worker(self, queue, done, started, abandoned):
+        while True:
+            try:
+                host, port, topic_partitions = queue.get_nowait()
+            except Empty:
+                return
+
+            started[(host, port)] = monotonic()
+            b_results, b_errors = self.fetch_broker(host, port, topic_partitions, abandoned)
+            done.put((host, port, b_results, b_errors))
+
+    def _start_worker(self, queue, done, started, abandoned):
+        w = threading.Thread(target=self._worker, args=(queue, done, started, abandoned))
+        w.daemon = True
+        w.start()
+
+    def fetch(self, work, positions=None):
+        '''
+        Takes a dict of (host, port) -> iterable of (topic, partition), and
+        returns a tuple of a dict, (host, port, topic, partition) ->
+        PartitionOffsets, and a dict of (host, port, topic, partition) ->
+        error description. positions, the offsets the Spouts are at by
+        (host, port, topic, partition), is for fetchers wrapping this one,
+        and is not used here.
+
+        Brokers whose circuit is open are not asked at all. A broker still
+        busy ABANDON_GRACE seconds after its deadline is given up on, and
+        its partitions reported as errors, so fetch() never waits on a
+        broker for much longer than timeout. Its connection is thrown
+        away, so that no later fetch shares it with the stuck worker.
+        '''
+        results = {}
+        errors = {}
+
+        def fail(host, port, topic_partitions, error):
+            for topic, partition in topic_partitions:
+                errors[(host, port, topic, partition)] = error
+
+        queue = Queue()
+        pending = {}
+        for (host, port), topic_partitions in work.items():
+            if not self.breaker.allow((host, port)):
+                fail(host, port, topic_partitions, 'skipped after repeated failures, retrying in %.0fs' %
+                     self.breaker.retry_in((host, port)))
+                continue
+            pending[(host, port)] = topic_partitions
+            queue.put((host, port, topic_partitions))
+
+        done = Queue()
+        started = {}                # (host, port) -> time its fetch began
+        abandoned = set()           # Brokers given up on
+        for i in range(min(self.max_inflight, len(pending))):
+            self._start_worker(queue, done, started, abandoned)
+
+        limit = self.timeout + OffsetFetcher.ABANDON_GRACE
+        while pending:
+            now = monotonic()
+            waits = []
+            for broker, t in started.items():
+                if broker not in pending:
+                    continue
+                if now >= t + limit:
+                    fail(broker[0], broker[1], pending.pop(broker), 'no answer after %.1fs' % limit)
+                    with self.lock:
+                        abandoned.add(broker)
+                        self.breaker.failure(broker)
+                    self.pool.discard(*broker)
+                    # The stuck worker keeps its thread, so replace it.
+                    if not queue.empty():
+                        self._start_worker(queue, done, started, abandoned)
+                else:
+                    waits.append(t + limit - now)
+            if not pending:
+                break
+
+            # Wake at least every ABANDON_GRACE seconds to check on brokers
+            # that started after this pass.
+            try:
+                host, port, b_results, b_errors = done.get(timeout=min(waits + [OffsetFetcher.ABANDON_GRACE]))
+            except Empty:
+                continue
+
+            # Ignore late answers from brokers already given up on.
+            if pending.pop((host, port), None) is None:
+                continue
+            for (topic, partition), offsets in b_results.items():
+                results[(host, port, topic, partition)] = offsets
+            for (topic, partition), error in b_errors.items():
+                errors[(host, port, topic, partition)] = error
+
+        for key, offsets in results.items():
+            self.known[key] = offsets
+
+        return results, errors
+
+    def last_known(self, key):
+        '''
+        Returns the PartitionOffsets last fetched for (host, port, topic,
+        partition), or None if there have been none.
+        '''
+        return self.known.get(key)
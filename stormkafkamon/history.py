@@ -0,0 +1,416 @@
+# Keeps a history of offsets on disk, in memory-mapped files of fixed-size
+# rings, so that rates over long windows survive restarts and take no
+# Python objects to hold.
+
+import os
+import mmap
+import fcntl
+import errno
+import struct
+import urllib
+import simplejson as json
+
+class RingFile(object):
+    '''
+    A file holding any number of rings of records, RECORDs unless another
+    struct is given, each with room for capacity records, mapped into
+    memory. Appending overwrites the oldest record of a full ring. Records
+    are read straight out of the mapping, without copying the file.
+
+    A file created earlier keeps the capacity it was created with.
+
+    Only one process may write to a file. Others open it read-only, and
+    refresh() maps the rings the writer has added since.
+    '''
+    MAGIC = 'SKR1'
+    HEADER = struct.Struct('<4sIII')        # Magic, capacity, number of rings, unused
+    COUNT = struct.Struct('<Q')             # Records ever appended to a ring
+    RECORD = struct.Struct('<dqqq')         # Time, earliest, latest, current
+
+    def __init__(self, path, capacity, writable=True, record=RECORD):
+        self.path = path
+        self.writable = writable
+        self.capacity = capacity
+        self.record_struct = record
+        self.num_rings = 0
+        self.ring_size = RingFile.COUNT.size + capacity * record.size
+        self.f = None
+        self.mm = None
+
+        if not writable:
+            self.refresh()
+            return
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= RingFile.HEADER.size
+        self.f = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            self._read_header()
+        else:
+            self.f.write(RingFile.HEADER.pack(RingFile.MAGIC, capacity, 0, 0))
+            self.f.flush()
+        self._map()
+
+    def _read_header(self):
+        # Read past the file's buffer, which would keep the first header read.
+        os.lseek(self.f.fileno(), 0, os.SEEK_SET)
+        magic, capacity, num_rings, _ = RingFile.HEADER.unpack(os.read(self.f.fileno(), RingFile.HEADER.size))
+        if magic != RingFile.MAGIC:
+            self.close()
+            raise IOError('%s is not a history file' % self.path)
+        self.capacity = capacity
+        self.num_rings = num_rings
+        self.ring_size = RingFile.COUNT.size + capacity * self.record_struct.size
+
+    def _size(self):
+        return RingFile.HEADER.size + self.num_rings * self.ring_size
+
+    def _map(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        size = self._size()
+        if self.writable:
+            # Never shrink the file under a reader's mapping.
+            if os.fstat(self.f.fileno()).st_size < size:
+                self.f.truncate(size)
+            self.mm = mmap.mmap(self.f.fileno(), size)
+        elif self.num_rings:
+            self.mm = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def refresh(self):
+        '''
+        Maps the rings the writer has added to a read-only file since it
+        was last mapped. Returns whether there were any.
+        '''
+        if self.f is None:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) < RingFile.HEADER.size:
+                return False
+            self.f = open(self.path, 'rb')
+        elif self.mm is not None and RingFile.HEADER.unpack_from(self.mm, 0)[2] == self.num_rings:
+            return False
+
+        num_rings = self.num_rings
+        self._read_header()
+        if self.num_rings == num_rings:
+            return False
+        # The writer grows the file before it counts new rings in the
+        # header, so the file is at least this long.
+        self._map()
+        return True
+
+    def _base(self, ring):
+        return RingFile.HEADER.size + ring * self.ring_size
+
+    def add_rings(self, n=1):
+        '''
+        Adds n empty rings to the end of the file and returns the number of
+        the first.
+        '''
+        first = self.num_rings
+        self.num_rings += n
+        self._map()
+        RingFile.HEADER.pack_into(self.mm, 0, RingFile.MAGIC, self.capacity, self.num_rings, 0)
+        return first
+
+    def append(self, ring, *values):
+        base = self._base(ring)
+        count = RingFile.COUNT.unpack_from(self.mm, base)[0]
+        slot = count % self.capacity
+        record = self.record_struct
+        record.pack_into(self.mm, base + RingFile.COUNT.size + slot * record.size, *values)
+        # The count is bumped last, so a record is only seen once complete.
+        RingFile.COUNT.pack_into(self.mm, base, count + 1)
+
+    def __len__(self):
+        return self.num_rings
+
+    def length(self, ring):
+        return min(RingFile.COUNT.unpack_from(self.mm, self._base(ring))[0], self.capacity)
+
+    def record(self, ring, i):
+        '''
+        Returns the i-th oldest record held by ring as a tuple, of (time,
+        earliest, latest, current) for a RECORD.
+        '''
+        base = self._base(ring)
+        count = RingFile.COUNT.unpack_from(self.mm, base)[0]
+        n = min(count, self.capacity)
+        slot = (count - n + i) % self.capacity
+        record = self.record_struct
+        return record.unpack_from(self.mm, base + RingFile.COUNT.size + slot * record.size)
+
+    def last(self, ring):
+        n = self.length(ring)
+        return self.record(ring, n - 1) if n else None
+
+    def find(self, ring, since):
+        '''
+        Returns the index of the oldest record of ring taken at or after
+        since, by binary search, or the length of the ring if there is none.
+        '''
+        lo, hi = 0, self.length(ring)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(ring, mid)[0] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, ring, since=None):
+        '''
+        Generates the records of ring taken at or after since, oldest first.
+        '''
+        start = self.find(ring, since) if since is not None else 0
+        for i in xrange(start, self.length(ring)):
+            yield self.record(ring, i)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        if self.f is not None:
+            self.f.close()
+
+# Time, messages added and consumed since the record before, total delta,
+# and messages added and consumed since the ring was created.
+INTERVAL = struct.Struct('<dqqqqq')
+
+def _rate(first, last, added, removed):
+    '''
+    Returns the rates of growth of the values at indices added and removed
+    between two records, or None if they were not taken at different times.
+    '''
+    if first is None or last is None or last[0] <= first[0]:
+        return None
+    seconds = last[0] - first[0]
+    return (last[added] - first[added]) / seconds, (last[removed] - first[removed]) / seconds
+
+class HistoryStore(object):
+    '''
+    Offset history of one topology, in directory. What was added to and
+    consumed from all partitions between records goes to one ring of
+    INTERVALs, covering TOTALS_SPAN seconds, and the offsets of each
+    (broker, topic, partition) to a ring of its own, covering
+    PARTITIONS_SPAN seconds. A record is kept at most every resolution
+    seconds, which decides how many records the rings hold when they are
+    first created.
+
+    The intervals count only partitions present, with broker offsets, at
+    both ends, as PartitionColumns does, so a partition appearing or
+    disappearing adds nothing. Summing the offsets instead would count the
+    whole of its offset as produced or lost.
+
+    The partition rings share one file, numbered in the order partitions
+    were first seen. The file "index" lists their keys in that order.
+
+    One process at a time writes to a directory, holding an exclusive lock
+    on its "lock" file. A store opened on a directory another process
+    writes to, or with writable unset, only reads, following what the
+    writer adds, and record() does nothing. Only a writable store creates
+    the directory; read-only, a missing one is an empty history until a
+    writer creates it.
+    '''
+    DEFAULT_RESOLUTION = 10.0
+    TOTALS_SPAN = 86400
+    PARTITIONS_SPAN = 3600
+
+    def __init__(self, directory, resolution=DEFAULT_RESOLUTION, writable=True):
+        self.lock = None
+        if writable:
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.lock = open(os.path.join(directory, 'lock'), 'a')
+            try:
+                fcntl.flock(self.lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self.lock.close()
+                self.lock = None
+        self.writable = self.lock is not None
+
+        self.resolution = resolution
+        self.totals = RingFile(os.path.join(directory, 'intervals'),
+                               int(HistoryStore.TOTALS_SPAN / resolution) + 1, self.writable, INTERVAL)
+        self.partitions = RingFile(os.path.join(directory, 'partitions'),
+                                   int(HistoryStore.PARTITIONS_SPAN / resolution) + 1, self.writable)
+        if self.writable and len(self.totals) == 0:
+            self.totals.add_rings()
+
+        self.index_path = os.path.join(directory, 'index')
+        self.index_mtime = None
+        self._load_index()
+
+        last = self.last_totals()
+        self.last_write = last[0] if last is not None else None
+        self.cumulative = (last[4], last[5]) if last is not None else (0, 0)
+        self.pending = (0, 0)       # Added and consumed since the last record
+
+    @staticmethod
+    def directory_for(root, topology):
+        return os.path.join(root, urllib.quote(topology, safe=''))
+
+    def _load_index(self):
+        keys = []
+        if os.path.exists(self.index_path):
+            self.index_mtime = os.path.getmtime(self.index_path)
+            with open(self.index_path) as f:
+                keys = [tuple(k) if k is not None else None for k in json.load(f)]
+        # Rings added after the index was last written have no key.
+        keys = keys[:len(self.partitions)]
+        self.unkeyed = len(self.partitions) - len(keys)
+        keys.extend([None] * self.unkeyed)
+        self.keys = keys
+        self.rings = dict((k, i) for i, k in enumerate(keys) if k is not None)
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.keys, f)
+        os.rename(tmp, self.index_path)
+
+    def _follow(self):
+        '''
+        Brings a read-only store up to date with the rings and index its
+        writer has added.
+        '''
+        if self.writable:
+            return
+        self.totals.refresh()
+        if self.partitions.refresh() or \
+                (self.unkeyed and os.path.exists(self.index_path) and
+                 os.path.getmtime(self.index_path) != self.index_mtime):
+            self._load_index()
+
+    def record(self, columns, added, removed, when):
+        '''
+        Appends the offsets held by a PartitionColumns, taken at wall clock
+        time when, and the messages added and removed since the last call,
+        unless the last record is less than resolution seconds older or the
+        store is read-only. What is not recorded is carried into the next
+        record. Returns whether they were recorded.
+        '''
+        if not self.writable:
+            return False
+        self.pending = (self.pending[0] + added, self.pending[1] + removed)
+        if self.last_write is not None and 0 <= when - self.last_write < self.resolution:
+            return False
+
+        added, removed = self.pending
+        self.cumulative = (self.cumulative[0] + added, self.cumulative[1] + removed)
+        self.totals.append(0, when, added, removed, columns.sums[2], *self.cumulative)
+        self.pending = (0, 0)
+
+        unknown = columns.unknown
+        rows = [row for row in columns.rows() if row not in unknown]
+        new = [columns.keys[row] for row in rows if columns.keys[row] not in self.rings]
+        if new:
+            first = self.partitions.add_rings(len(new))
+            for i, key in enumerate(new):
+                self.rings[key] = first + i
+            self.keys.extend(new)
+            self._save_index()
+
+        for row in rows:
+            self.partitions.append(self.rings[columns.keys[row]], when, columns.earliest[row],
+                                   columns.latest[row], columns.current[row])
+
+        self.last_write = when
+        return True
+
+    def since_last(self, columns):
+        '''
+        Returns the messages added to and consumed from the partitions of a
+        PartitionColumns since each was last recorded, as a tuple, such as
+        over a restart. Partitions never recorded, or without broker offsets
+        now, count as 0.
+        '''
+        self._follow()
+        added = removed = 0
+        unknown = columns.unknown
+        for row in columns.rows():
+            ring = self.rings.get(columns.keys[row])
+            if ring is None or row in unknown:
+                continue
+            last = self.partitions.last(ring)
+            if last is not None:
+                added += columns.latest[row] - last[2]
+                removed += columns.current[row] - last[3]
+        return added, removed
+
+    def last_totals(self):
+        self._follow()
+        if len(self.totals) == 0:
+            return None
+        return self.totals.last(0)
+
+    def totals_since(self, since):
+        self._follow()
+        if len(self.totals) == 0:
+            return iter(())
+        return self.totals.records(0, since)
+
+    def _covered_rate(self, ring_file, ring, window, now, added, removed):
+        '''
+        Returns the rates over the window seconds before now from a ring,
+        of the values at indices added and removed, or None unless it holds
+        a record from no later than a resolution step after the start of
+        the window.
+        '''
+        since = now - window
+        i = ring_file.find(ring, since)
+        n = ring_file.length(ring)
+        if i >= n:
+            return None
+        first = ring_file.record(ring, i)
+        # A record before since means the window is covered from record i.
+        if i == 0 and first[0] - since > self.resolution:
+            return None
+        return _rate(first, ring_file.record(ring, n - 1), added, removed)
+
+    def rate(self, window, now):
+        '''
+        Returns the rates at which messages were added and consumed over
+        the window seconds before wall clock time now, as a tuple, or None
+        if the history does not cover the window. They are the sums of the
+        intervals recorded since the first record in the window, which the
+        running sums held by every record give without reading the rest.
+        '''
+        self._follow()
+        if len(self.totals) == 0:
+            return None
+        return self._covered_rate(self.totals, 0, window, now, 4, 5)
+
+    def partition_records(self, key, since=None):
+        '''
+        Generates the records of partition key, a (broker, topic, partition)
+        tuple, taken at or after since.
+        '''
+        self._follow()
+        ring = self.rings.get(key)
+        if ring is None:
+            return iter(())
+        return self.partitions.records(ring, since)
+
+    def partition_rate(self, key, window, now):
+        '''
+        As rate(), for a single partition.
+        '''
+        self._follow()
+        ring = self.rings.get(key)
+        if ring is None:
+            return None
+        return self._covered_rate(self.partitions, ring, window, now, 2, 3)
+
+    def close(self):
+        self.totals.close()
+        self.partitions.close()
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
@@ -1,16 +1,43 @@
 #!/usr/bin/env python
 
 import argparse
+import logging
 import sys
+import csv
 import curses
+import threading
 import time
-import datetime
+from cStringIO import StringIO
 
+import simplejson as json
 from prettytable import PrettyTable
-
-from zkclient import ZkClient, ZkError
-from processor import process, ProcessorError
+from kazoo.exceptions import KazooException
+
+from zkclient import ZkClient, ZkError, TopologyFilter
+from processor import process, process_iter, split_summary, ProcessorError, PartitionState, Totals, \
+    NullHandler
+from brokerpool import BrokerPool, CircuitBreaker
+from brokers import AddressCache, BrokerRegistry
+from fetcher import OffsetFetcher
 from summary_aggregator import SummaryAggregator
+from history import HistoryStore
+from estimator import HistoryEstimator, NO_ESTIMATE, DEFAULT_WINDOW as ETA_WINDOW, format_duration, format_eta
+from spoutcache import SpoutCache
+from clock import monotonic
+from exporter import SnapshotRefresher, ExporterServer
+from stats import Stats, dump as dump_stats
+from renderer import PartitionView, RollupView, Screen
+from rollups import RunningRollups, DIMENSIONS as ROLLUP_DIMENSIONS, DEFAULT_TOP as ROLLUP_TOP
+from scheduler import PollScheduler, ScheduledFetcher
+from alerts import AlertEngine, AlertDispatcher, AlertError, load_rules
+from sharding import ShardCoordinator, ShardedFetcher
+from capture import CaptureWriter, Replay, RecordingFetcher, CaptureError, recording_source
+from resident import ResidentServer, ResidentError, QueryDeclined
+from client import DEFAULT_SOCKET
+
+logger = logging.getLogger(__name__)
+# sktop draws over stderr, so nothing is logged there unless configured.
+logger.addHandler(NullHandler())
 
 
 def sizeof_fmt(num):
@@ -25,37 +52,172 @@ def null_fmt(num):
     return num
 
 
-def display(summary, friendly=False):
+STREAM_FLUSH_ROWS = 1000
+
+
+def _totals_row(totals, topology=''):
+    return ['TOTAL', '', '', '', '', totals.total_depth, '', '', totals.total_delta, '', topology]
+
+
+def _totals_record(totals, **extra):
+    record = {'total_depth': totals.total_depth,
+              'total_delta': totals.total_delta,
+              'num_partitions': totals.num_partitions,
+              'num_brokers': len(totals.brokers),
+              'num_stale': totals.num_stale,
+              'num_unknown': totals.num_unknown}
+    record.update(extra)
+    return json.dumps(record) + '\n'
+
+
+def _rollup_records(rollups, topology):
+    for dimension in ROLLUP_DIMENSIONS:
+        for name in rollups.names(dimension):
+            yield _totals_record(rollups.totals(dimension, name), type='rollup', dimension=dimension,
+                                 name=name, topology=topology,
+                                 laggiest=[p._asdict() for p in rollups.laggiest(dimension, name)])
+
+
+def display_stream(partitions, fmt, out=sys.stdout, top=ROLLUP_TOP):
+    '''
+    Writes each PartitionState from partitions as soon as it arrives, as
+    NDJSON or CSV, followed by a totals record for each topology, if there
+    is more than one, and one for them all. NDJSON also gets a rollup
+    record for each topic, Spout and broker of each topology, with its top
+    laggiest partitions. Only running totals are kept, so memory does not
+    grow with the number of partitions.
+    '''
+    totals = Totals()
+    topology_totals = {}
+    topology_rollups = {}
+
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(PartitionState._fields)
+
+    for i, p in enumerate(partitions):
+        totals.add(p)
+        t = topology_totals.get(p.topology)
+        if t is None:
+            t = topology_totals[p.topology] = Totals()
+        t.add(p)
+        if fmt != 'csv' and top:
+            r = topology_rollups.get(p.topology)
+            if r is None:
+                r = topology_rollups[p.topology] = RunningRollups(top)
+            r.add(p)
+
+        if fmt == 'csv':
+            writer.writerow(p)
+        else:
+            row = p._asdict()
+            row['type'] = 'partition'
+            out.write(json.dumps(row) + '\n')
+
+        if i % STREAM_FLUSH_ROWS == STREAM_FLUSH_ROWS - 1:
+            out.flush()
+
+    for topology in sorted(topology_rollups):
+        for record in _rollup_records(topology_rollups[topology], topology):
+            out.write(record)
+
+    if len(topology_totals) > 1:
+        for topology in sorted(topology_totals):
+            if fmt == 'csv':
+                writer.writerow(_totals_row(topology_totals[topology], topology))
+            else:
+                out.write(_totals_record(topology_totals[topology], type='topology_totals', topology=topology))
+
+    if fmt == 'csv':
+        writer.writerow(_totals_row(totals))
+    else:
+        out.write(_totals_record(totals, type='totals'))
+    out.flush()
+    return totals
+
+
+def display_rollups(partitions, friendly=False, top=ROLLUP_TOP, out=sys.stdout):
+    '''
+    Displays a table of the totals per topic, Spout and broker of
+    partitions, with the top laggiest partitions of each.
+    '''
+    if friendly:
+        fmt = sizeof_fmt
+    else:
+        fmt = null_fmt
+
+    rollups = RunningRollups(top)
+    for p in partitions:
+        rollups.add(p)
+
+    for dimension in ROLLUP_DIMENSIONS:
+        table = PrettyTable([dimension.capitalize(), 'Partitions', 'Depth', 'Delta', 'Laggiest'])
+        for name in rollups.names(dimension):
+            t = rollups.totals(dimension, name)
+            laggiest = ', '.join('%s/%s/%d (%s)' % (p.broker, p.topic, p.partition, fmt(p.delta))
+                                 for p in rollups.laggiest(dimension, name))
+            table.add_row([name, t.num_partitions, fmt(t.total_depth), fmt(t.total_delta), laggiest])
+        print >>out
+        print >>out, table.get_string()
+
+
+def display(summary, friendly=False, top=ROLLUP_TOP, estimator=None, out=sys.stdout):
+    '''
+    Displays summary as a table. Time lag and catch-up ETA are estimated
+    by estimator, a HistoryEstimator, if given; a single refresh has no
+    rates to estimate them from otherwise.
+    '''
     if friendly:
         fmt = sizeof_fmt
     else:
         fmt = null_fmt
 
+    now = time.time()
+    estimate = lambda p: estimator.estimate_partition(p, now) if estimator is not None else NO_ESTIMATE
+
     table = PrettyTable(['Broker', 'Topic', 'Partition', 'Earliest', 'Latest',
-                        'Depth', 'Spout', 'Current', 'Delta'])
+                        'Depth', 'Spout', 'Current', 'Delta', 'Time Lag', 'ETA', 'Status'])
     table.align['broker'] = 'l'
 
     for p in summary.partitions:
+        e = estimate(p)
         table.add_row([p.broker, p.topic, p.partition, p.earliest, p.latest,
-                      fmt(p.depth), p.spout, p.current, fmt(p.delta)])
-    print table.get_string(sortby='Broker')
-    print
-    print 'Number of brokers:       %d' % summary.num_brokers
-    print 'Number of partitions:    %d' % summary.num_partitions
-    print 'Total broker depth:      %s' % fmt(summary.total_depth)
-    print 'Total delta:             %s' % fmt(summary.total_delta)
-
-
-def curses_display(window, lines, start_x, start_y):
-    height, width = window.getmaxyx()
-
-    for i, line in enumerate(lines):
-        y = start_y + i
-
-        if y < height:
-            window.move(y, start_x)
-            window.addstr(line[:(width - 1)])
-            window.clrtoeol()
+                      fmt(p.depth), p.spout, p.current, fmt(p.delta),
+                      format_duration(e.time_lag), format_eta(e), p.status])
+    print >>out, table.get_string(sortby='Broker')
+    print >>out
+    print >>out, 'Number of brokers:       %d' % summary.num_brokers
+    print >>out, 'Number of partitions:    %d' % summary.num_partitions
+    print >>out, 'Total broker depth:      %s' % fmt(summary.total_depth)
+    print >>out, 'Total delta:             %s' % fmt(summary.total_delta)
+    if estimator is not None:
+        e = estimator.estimate_totals(summary, now)
+        print >>out, 'Time lag:                %s' % format_duration(e.time_lag)
+        print >>out, 'Catch-up ETA:            %s (%s)' % (format_eta(e), e.state)
+    if summary.num_stale or summary.num_unknown:
+        print >>out, 'Stale partitions:        %d' % summary.num_stale
+        print >>out, 'Unknown partitions:      %d' % summary.num_unknown
+    if top:
+        display_rollups(summary.partitions, friendly, top, out)
+
+
+def display_topologies(summary, topologies, friendly=False, top=ROLLUP_TOP, make_estimator=lambda t: None,
+                       out=sys.stdout):
+    '''
+    Displays summary as one table per topology, unless topologies, a
+    TopologyFilter, selects just one. make_estimator(topology) returns the
+    HistoryEstimator of a topology, or None.
+    '''
+    single = topologies.single()
+    if single is not None:
+        display(summary, friendly, top, make_estimator(single), out)
+        return
+
+    summaries = split_summary(summary, topologies)
+    for topology in sorted(summaries):
+        print >>out, 'Topology: %s' % topology
+        display(summaries[topology], friendly, top, make_estimator(topology), out)
+        print >>out
 
 
 ######################################################################
@@ -67,97 +229,642 @@ def true_or_false_option(option):
         return True
 
 
-def read_args():
-    parser = argparse.ArgumentParser(description='Show complete state of Storm-Kafka consumers')
+class QueryArgumentParser(argparse.ArgumentParser):
+    '''
+    Parses the command line of an skq query inside skexport, declining the
+    query instead of printing usage or help and exiting.
+    '''
+    def print_usage(self, file=None):
+        pass
+
+    def print_help(self, file=None):
+        pass
+
+    def exit(self, status=0, message=None):
+        raise QueryDeclined(message.strip() if message else 'exited')
+
+
+def read_args(args=None, parser_class=argparse.ArgumentParser):
+    parser = parser_class(description='Show complete state of Storm-Kafka consumers')
     parser.add_argument('--zserver', default='localhost', help='Zookeeper host (default: localhost)')
     parser.add_argument('--zport', type=int, default=2181, help='Zookeeper port (default: 2181)')
-    parser.add_argument('--topology', type=str, required=True, help='Storm Topology')
+    parser.add_argument('--topology', type=str,
+                        help='Storm Topology, a comma separated list of them, or "all"')
+    parser.add_argument('--topology_regex', type=str, help='Also monitor every Storm Topology matching this regex')
     parser.add_argument('--spoutroot', type=str, required=True, help='Root path for Kafka Spout data in Zookeeper')
+    parser.add_argument('--brokerroot', type=str, default=BrokerRegistry.DEFAULT_BROKER_ROOT,
+                        help='Root path for Kafka broker data in Zookeeper (default: %s)' % BrokerRegistry.DEFAULT_BROKER_ROOT)
+    parser.add_argument('--validate', action='store_const', const=True,
+                        help='Check every Spout partition against the topics registered by the Kafka brokers')
+    parser.add_argument('--zk_pipelined', action='store_const', const=True,
+                        help='Read Spout data from Zookeeper with pipelined asynchronous requests')
+    parser.add_argument('--zk_watch', action='store_const', const=True,
+                        help='Keep Spout data cached and updated by Zookeeper watches between refreshes, '
+                             'which only pays off for sktop and skexport')
+    parser.add_argument('--format', choices=['table', 'ndjson', 'csv'], default='table',
+                        help='Output format of skmon; ndjson and csv are streamed as partitions are read (default: table)')
     parser.add_argument('--friendly', action='store_const', const=True, help='Show friendlier data')
+    parser.add_argument('--rollup_top', type=int, default=ROLLUP_TOP,
+                        help='Laggiest partitions shown per topic, Spout and broker; 0 leaves out the '
+                             'rollups from skmon output (default: %d)' % ROLLUP_TOP)
     parser.add_argument('--update_interval', type=float, default=3.0, help='Interval between updates in seconds')
-    return parser.parse_args()
+    parser.add_argument('--adaptive', action='store_const', const=True,
+                        help='Poll each partition between --min_interval and --max_interval seconds, '
+                             'faster while its delta is changing, at the refreshes every --update_interval '
+                             '(sktop only)')
+    parser.add_argument('--min_interval', type=float, default=0.5, help='Shortest adaptive poll interval (default: 0.5)')
+    parser.add_argument('--max_interval', type=float, default=30.0, help='Longest adaptive poll interval (default: 30.0)')
+    parser.add_argument('--history_dir', type=str,
+                        help='Keep offset history in this directory, so rates survive restarts and cover '
+                             'the last hour and day (sktop and skexport)')
+    parser.add_argument('--history_resolution', type=float, default=HistoryStore.DEFAULT_RESOLUTION,
+                        help='Seconds between history records (default: %.1f)' % HistoryStore.DEFAULT_RESOLUTION)
+    parser.add_argument('--eta_window', type=float, default=ETA_WINDOW,
+                        help='Seconds of offsets that time lag and catch-up ETA are estimated from '
+                             '(default: %d)' % ETA_WINDOW)
+    parser.add_argument('--batch_size', type=int, default=OffsetFetcher.DEFAULT_BATCH_SIZE,
+                        help='Maximum partitions per offset request (default: %d)' % OffsetFetcher.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max_inflight', '--max-inflight', type=int, default=OffsetFetcher.DEFAULT_MAX_INFLIGHT,
+                        help='Maximum brokers queried in parallel (default: %d)' % OffsetFetcher.DEFAULT_MAX_INFLIGHT)
+    parser.add_argument('--stats', action='store_const', const=True,
+                        help='Time each phase of a refresh and show it (toggle with "s" in sktop)')
+    parser.add_argument('--stats_file', type=str, help='Write timing stats as JSON to this file after each refresh')
+    parser.add_argument('--listen', default='127.0.0.1', help='Address for skexport to listen on (default: 127.0.0.1)')
+    parser.add_argument('--http_port', type=int, default=9310, help='Port for skexport to listen on (default: 9310)')
+    parser.add_argument('--log_level', choices=['debug', 'info', 'warning', 'error'], default='warning',
+                        help='Least severe messages skexport logs to stderr (default: warning)')
+    parser.add_argument('--socket', nargs='?', const=DEFAULT_SOCKET, metavar='PATH',
+                        help='Answer skq queries on this UNIX socket (skexport), or query the skexport '
+                             'listening on it (skq) (default: %s)' % DEFAULT_SOCKET)
+    parser.add_argument('--max_age', type=float, default=30.0,
+                        help='Seconds old the summary of skexport may be for skq to answer from it (default: 30.0)')
+    parser.add_argument('--broker_timeout', type=float, default=OffsetFetcher.DEFAULT_TIMEOUT,
+                        help='Seconds allowed for each broker to answer (default: %.1f)' % OffsetFetcher.DEFAULT_TIMEOUT)
+    parser.add_argument('--broker_retries', type=int, default=OffsetFetcher.DEFAULT_RETRIES,
+                        help='Retries of a failed offset request (default: %d)' % OffsetFetcher.DEFAULT_RETRIES)
+    parser.add_argument('--breaker_threshold', type=int, default=CircuitBreaker.DEFAULT_THRESHOLD,
+                        help='Consecutive failures after which a broker is skipped (default: %d)' %
+                             CircuitBreaker.DEFAULT_THRESHOLD)
+    parser.add_argument('--breaker_cooldown', type=float, default=CircuitBreaker.DEFAULT_COOLDOWN,
+                        help='Seconds a failing broker is skipped for (default: %.1f)' % CircuitBreaker.DEFAULT_COOLDOWN)
+    parser.add_argument('--shard_path', type=str,
+                        help='Share fetching broker offsets with the other instances registered under this '
+                             'Zookeeper path, each fetching a slice of the partitions')
+    parser.add_argument('--shard_max_age', type=float, default=ShardedFetcher.DEFAULT_MAX_AGE,
+                        help='Seconds after which offsets published by another instance are ignored '
+                             '(default: %.1f)' % ShardedFetcher.DEFAULT_MAX_AGE)
+    parser.add_argument('--rules', type=str, metavar='FILE',
+                        help='Evaluate the alert rules in this JSON file on every refresh (sktop and skexport)')
+    parser.add_argument('--record', type=str, metavar='FILE',
+                        help='Record the Spouts and offsets read by every refresh to a capture file')
+    parser.add_argument('--replay', type=str, metavar='FILE',
+                        help='Replay a capture file instead of reading Zookeeper and Kafka')
+    parser.add_argument('--replay_speed', type=float, default=1.0,
+                        help='Multiple of the recorded pace to replay at, or 0 for as fast as possible (default: 1.0)')
+    parser.add_argument('--dns_ttl', type=float, default=AddressCache.DEFAULT_TTL,
+                        help='Seconds to remember resolved broker addresses (default: %.1f)' % AddressCache.DEFAULT_TTL)
+    options = parser.parse_args(args)
+
+    if options.topology is None and options.topology_regex is None:
+        parser.error('--topology or --topology_regex is required')
+    if options.record is not None and options.replay is not None:
+        parser.error('--record and --replay cannot be used together')
+    names = options.topology.split(',') if options.topology is not None else []
+    options.topologies = TopologyFilter([n for n in names if n], options.topology_regex)
+    return options
+
+
+def open_capture(options):
+    '''
+    Opens the capture file given by --record or --replay, setting
+    options.recorder to a CaptureWriter or options.replayer to a Replay.
+    Both are None otherwise.
+    '''
+    options.recorder = None
+    options.replayer = None
+    try:
+        if options.record is not None:
+            options.recorder = CaptureWriter(options.record)
+        elif options.replay is not None:
+            options.replayer = Replay(options.replay, options.replay_speed)
+    except IOError, e:
+        print 'Failed to open capture: %s' % str(e)
+        sys.exit(1)
+
+
+def open_alerts(options):
+    '''
+    Loads the rules given by --rules and starts delivering their alerts,
+    setting options.alert_rules and options.dispatcher. Both are None
+    without --rules.
+    '''
+    options.alert_rules = None
+    options.dispatcher = None
+    if options.rules is None:
+        return
+    try:
+        options.alert_rules = load_rules(options.rules)
+    except AlertError, e:
+        print 'Failed to load alert rules: %s' % str(e)
+        sys.exit(1)
+    options.dispatcher = AlertDispatcher()
+    options.dispatcher.start()
+
+
+def start(zc, options):
+    # A replay reads nothing from Zookeeper.
+    if options.replayer is None:
+        zc.start()
+
+
+def stop(zc, options):
+    if options.replayer is None:
+        zc.stop()
+    if options.recorder is not None:
+        options.recorder.close()
+    if options.dispatcher is not None:
+        options.dispatcher.stop()
+
+
+def make_stats(options):
+    return Stats(true_or_false_option(options.stats) or options.stats_file is not None)
+
+
+def make_pool(options):
+    return BrokerPool(timeout=options.broker_timeout, resolver=AddressCache(options.dns_ttl).resolve)
+
+
+def make_registry(zc, options):
+    '''
+    Returns a BrokerRegistry to validate partitions against if --validate
+    was given, or None.
+    '''
+    if true_or_false_option(options.validate):
+        return BrokerRegistry(zc, options.brokerroot)
+    return None
+
+
+def make_fetcher(pool, options, stats):
+    if options.replayer is not None:
+        return options.replayer.fetcher
+    return OffsetFetcher(pool, options.batch_size, options.max_inflight, options.broker_timeout, stats,
+                         options.broker_retries, breaker=CircuitBreaker(options.breaker_threshold,
+                                                                        options.breaker_cooldown))
+
+
+def make_aggregator_factory(options):
+    '''
+    Returns a function making the SummaryAggregator of a topology, backed
+    by a HistoryStore if --history_dir was given, and evaluating alert
+    rules if --rules was.
+    '''
+    def factory(topology, zookeeper):
+        history = None
+        if options.history_dir is not None:
+            history = HistoryStore(HistoryStore.directory_for(options.history_dir, topology),
+                                   options.history_resolution)
+        alerts = None
+        if options.alert_rules is not None:
+            alerts = AlertEngine(options.alert_rules, topology, options.dispatcher)
+        return SummaryAggregator(topology, zookeeper, history, options.eta_window, alerts)
+    return factory
+
+
+def make_estimator_factory(options, stores=None):
+    '''
+    Returns a function making the HistoryEstimator of a topology if
+    --history_dir was given, or returning None. If stores, a dict, is
+    given, the read-only HistoryStore of each directory is kept in it and
+    reused, for the caller to close.
+    '''
+    if options.history_dir is None:
+        return lambda topology: None
+
+    def factory(topology):
+        directory = HistoryStore.directory_for(options.history_dir, topology)
+        history = stores.get(directory) if stores is not None else None
+        if history is None:
+            history = HistoryStore(directory, options.history_resolution, writable=False)
+            if stores is not None:
+                stores[directory] = history
+        return HistoryEstimator(history, options.eta_window)
+    return factory
+
+
+def shard_fetches(fetcher, zc, options):
+    '''
+    Wraps fetcher to fetch only this instance's slice of the partitions if
+    --shard_path was given.
+    '''
+    if options.shard_path is not None and options.replayer is None:
+        return ShardedFetcher(fetcher, ShardCoordinator(zc, options.shard_path), options.shard_max_age)
+    return fetcher
+
+
+def record_fetches(fetcher, options):
+    '''
+    Wraps fetcher to record what it returns if --record was given.
+    '''
+    if options.recorder is not None:
+        return RecordingFetcher(fetcher, options.recorder)
+    return fetcher
+
+
+def make_spout_source(zc, options):
+    '''
+    Returns a function returning the current Spouts of the selected
+    topologies, from the watch-driven cache if --zk_watch was given, or
+    from the capture being replayed. Spouts read are recorded if --record
+    was given.
+    '''
+    if options.replayer is not None:
+        return options.replayer.get_spouts
+
+    if true_or_false_option(options.zk_watch):
+        cache = SpoutCache(zc, options.spoutroot)
+        get_spouts = lambda: cache.snapshot(options.topologies)
+    else:
+        pipelined = true_or_false_option(options.zk_pipelined)
+        get_spouts = lambda: zc.spouts(options.spoutroot, options.topologies, pipelined)
+
+    if options.recorder is not None:
+        return recording_source(get_spouts, options.recorder)
+    return get_spouts
+
+
+def refresh_clock(options):
+    '''
+    Returns the clock that refreshes are timed by: the recorded one during
+    a replay, so that rates come out as they were recorded.
+    '''
+    if options.replayer is not None:
+        return options.replayer.clock
+    return monotonic
+
+
+# Options that decide what a refresh reads, which an skq query must share
+# with skexport for its snapshot to answer it.
+QUERY_MATCHED = ['zserver', 'zport', 'spoutroot', 'brokerroot', 'validate']
+# Options whose effects only skmon itself has.
+QUERY_DIRECT = ['stats', 'stats_file', 'record', 'replay']
+
+
+def answer_query(refresher, options, stores):
+    '''
+    Returns a function answering the command line of an skq query with the
+    output skmon would print for it, rendered from the refresher's latest
+    snapshot, and the status skmon would exit with. Queries it cannot answer as skmon would, or from a snapshot
+    older than their --max_age, are declined.
+
+    Outputs are kept until the next snapshot, so repeated queries cost
+    only a lookup. The history of each topology is opened once, into
+    stores, a dict the caller closes them from.
+    '''
+    lock = threading.Lock()
+    history_lock = threading.Lock()     # Held over reading stores, which are not thread-safe
+    rendered = {}                   # Snapshot, then output options -> (output, exit status)
+
+    def answer(args):
+        if options.replay is not None:
+            raise QueryDeclined('skexport is replaying a capture')
+        query = read_args(args, QueryArgumentParser)
+        for name in QUERY_MATCHED:
+            if getattr(query, name) != getattr(options, name):
+                raise QueryDeclined('--%s differs' % name)
+        for name in QUERY_DIRECT:
+            if getattr(query, name) is not None:
+                raise QueryDeclined('--%s given' % name)
+
+        # Any topologies skexport monitors can be asked for by name.
+        topologies = query.topologies
+        if str(topologies) != str(options.topologies) and \
+                (topologies.all or topologies.pattern is not None or not all(map(options.topologies, topologies.names))):
+            raise QueryDeclined('topologies differ')
+
+        snapshot = refresher.snapshot
+        if snapshot is None:
+            raise QueryDeclined('no snapshot taken yet')
+        if monotonic() - snapshot.taken > query.max_age:
+            raise QueryDeclined('snapshot is %.1f seconds old' % (monotonic() - snapshot.taken))
+
+        friendly = true_or_false_option(query.friendly)
+        key = (str(topologies), query.format, friendly, query.rollup_top, query.history_dir,
+               query.history_resolution, query.eta_window)
+        with lock:
+            if rendered.get(None) is not snapshot:
+                rendered.clear()
+                rendered[None] = snapshot
+            reply = rendered.get(key)
+        if reply is not None:
+            return reply
+
+        totals = Totals()
+        partitions = []
+        for p in snapshot.summary.partitions:
+            if topologies(p.topology):
+                totals.add(p)
+                partitions.append(p)
+
+        out = StringIO()
+        if query.format != 'table':
+            display_stream(partitions, query.format, out, query.rollup_top)
+        else:
+            with history_lock:
+                display_topologies(totals.summary(partitions), topologies, friendly, query.rollup_top,
+                                   make_estimator_factory(query, stores), out)
+        reply = (out.getvalue(), unknown_status(totals.num_unknown))
+        with lock:
+            if rendered.get(None) is snapshot:
+                rendered[key] = reply
+        return reply
+    return answer
 
 
 def main():
     options = read_args()
+    stats = make_stats(options)
 
-    zc = ZkClient(options.zserver, options.zport)
-    zc.start()
+    open_capture(options)
+    open_alerts(options)
+    zc = ZkClient(options.zserver, options.zport, stats)
+    start(zc, options)
+    pool = make_pool(options)
+    registry = make_registry(zc, options)
 
     try:
         try:
-            display(process(zc.spouts(options.spoutroot, options.topology)),
-                    true_or_false_option(options.friendly))
+            fetcher = record_fetches(shard_fetches(make_fetcher(pool, options, stats), zc, options), options)
+            if options.format != 'table':
+                # Spouts are streamed straight from Zookeeper unless they
+                # come from, or go to, a capture.
+                if options.replayer is None and options.recorder is None:
+                    spouts = zc.iter_spouts(options.spoutroot, options.topologies)
+                else:
+                    spouts = make_spout_source(zc, options)()
+                phases = ['stream']
+                with stats.phase('stream'):
+                    unknown = display_stream(process_iter(spouts, fetcher, registry=registry), options.format,
+                                             top=options.rollup_top).num_unknown
+            else:
+                phases = ['zk', 'offsets', 'draw']
+                with stats.phase('zk'):
+                    spouts = make_spout_source(zc, options)()
+                with stats.phase('offsets'):
+                    summary = process(spouts, fetcher, registry)
+                with stats.phase('draw'):
+                    display_topologies(summary, options.topologies, true_or_false_option(options.friendly),
+                                       options.rollup_top, make_estimator_factory(options))
+                unknown = summary.num_unknown
+
+            if options.stats_file is not None:
+                dump_stats(stats, options.stats_file)
+            if true_or_false_option(options.stats):
+                # Keep streamed output parseable.
+                out = sys.stdout if options.format == 'table' else sys.stderr
+                print >>out
+                print >>out, stats.get_header_line(phases)
         except ZkError, e:
             print 'Failed to access Zookeeper: %s' % str(e)
             return 1
         except ProcessorError, e:
             print 'Failed to process: %s' % str(e)
             return 1
+        except CaptureError, e:
+            print 'Failed to replay: %s' % str(e)
+            return 1
     finally:
-        zc.stop()
+        pool.close()
+        stop(zc, options)
 
-    return 0
+    # Partitions whose broker offsets could not be read leave the totals
+    # short, so this is a failure too.
+    return unknown_status(unknown)
+
+
+def unknown_status(num_unknown):
+    '''
+    Returns the exit status of skmon for output with num_unknown
+    partitions of unknown offsets.
+    '''
+    return 1 if num_unknown else 0
 
 
-def get_delta(prev_time):
-    delta = 0.0
-    now = datetime.datetime.utcnow()
+def wait_for_keys(window, seconds):
+    '''
+    Waits up to seconds for keyboard input, and returns the keys pressed.
+    Returns as soon as a key is pressed, so the caller can act on it.
+    '''
+    if window is None:
+        if seconds > 0.0:
+            time.sleep(seconds)
+        return []
 
-    if prev_time is not None:
-        date_diff = (now - prev_time)
-        delta = ((date_diff.seconds * 1000000) + date_diff.microseconds) / 1000000.0
+    window.timeout(max(0, int(seconds * 1000)))
+    keys = []
+    key = window.getch()
+    while key != -1:
+        keys.append(key)
+        window.timeout(0)
+        key = window.getch()
+    return keys
 
-    return delta
+
+STATS_PHASES = ['zk', 'offsets', 'aggregate', 'draw']
 
 
 def curses_main(window, args):
     zc = args[0]
     options = args[1]
-    aggregator = SummaryAggregator(options.topology, options.zserver + ':' + str(options.zport))
+    registry = args[3]
+    stats = zc.stats
+    fetcher = shard_fetches(make_fetcher(args[2], options, stats), zc, options)
+    clock = refresh_clock(options)
+    # A replay is paced by the capture itself.
+    interval = options.update_interval if options.replayer is None else 0.0
+
+    # One aggregator per topology, all fed from the same refresh.
+    zookeeper = options.zserver + ':' + str(options.zport)
+    make_aggregator = make_aggregator_factory(options)
+    aggregators = dict((t, make_aggregator(t, zookeeper)) for t in options.topologies.named())
+    empty = Totals().summary(())
+
+    if true_or_false_option(options.adaptive):
+        fetcher = ScheduledFetcher(fetcher, PollScheduler(options.min_interval, options.max_interval), clock)
+    fetcher = record_fetches(fetcher, options)
+
+    get_spouts = make_spout_source(zc, options)
+
+    view = None
+    views = None                # Partitions, then grouped by each rollup dimension
+    shown = None                # Topology in view
+    screen = Screen(window) if window is not None else None
+    next_update = monotonic()
+    failure = None              # Why the last refresh failed, if it did
 
     while True:
-        last_update = datetime.datetime.utcnow()
-        spouts = zc.spouts(options.spoutroot, options.topology)
-        summary = process(spouts)
-        aggregator.add_summary(summary, datetime.datetime.utcnow())
-
-        header_lines = aggregator.get_header_lines()
-        partition_data_lines = aggregator.get_partition_data_lines()
-
-        if window is not None:
-            window.erase()
-            curses_display(window, header_lines, 0, 0)
-            curses_display(window, partition_data_lines, 0, len(header_lines) + 1)
-            window.refresh()
-        else:
-            print '\r\n'.join(header_lines)
-            print
-            print '\r\n'.join(partition_data_lines)
-
-        delta = get_delta(last_update)
-        sleep_time = options.update_interval - delta
-
-        if sleep_time > 0.0:
-            time.sleep(sleep_time)
+        now = monotonic()
+        if now >= next_update:
+            # Deadlines advance by whole intervals from the previous one, so
+            # the time taken by a refresh does not push the schedule back.
+            next_update = max(next_update + interval, now)
+            try:
+                with stats.phase('zk'):
+                    spouts = get_spouts()
+                with stats.phase('offsets'):
+                    summary = process(spouts, fetcher, registry)
+            except (ZkError, KazooException, ProcessorError), e:
+                # The last refresh stays on screen, and the next deadline
+                # tries again, reading Zookeeper afresh if the session was
+                # lost.
+                logger.warning('Refresh failed: %s', e)
+                failure = 'Refresh failed at %s: %s' % (time.strftime('%H:%M:%S'), e)
+            else:
+                failure = None
+                with stats.phase('aggregate'):
+                    summaries = split_summary(summary, options.topologies)
+                    taken = clock()
+                    for t in summaries:
+                        if t not in aggregators:
+                            aggregators[t] = make_aggregator(t, zookeeper)
+                    for t, aggregator in aggregators.items():
+                        aggregator.add_summary(summaries.get(t, empty), taken)
+
+            if options.stats_file is not None:
+                dump_stats(stats, options.stats_file)
+
+        with stats.phase('draw'):
+            names = sorted(aggregators)
+            if shown not in aggregators:
+                shown = names[0] if names else None
+            if shown is None:
+                header_lines = ['No partitions found for topology %s' % options.topologies]
+            else:
+                aggregator = aggregators[shown]
+                if view is None:
+                    views = [PartitionView(aggregator)] + [RollupView(aggregator, d, options.rollup_top)
+                                                           for d in ROLLUP_DIMENSIONS]
+                    view = views[0]
+                view.aggregator = aggregator
+                header_lines = aggregator.get_header_lines()
+                if len(names) > 1:
+                    header_lines = ["Topology %d of %d ('t' for next)" % (names.index(shown) + 1, len(names))] + header_lines
+            if failure is not None:
+                header_lines = [failure] + header_lines
+            if stats.enabled:
+                header_lines = [stats.get_header_line(STATS_PHASES)] + header_lines
+
+            if view is None:
+                lines = header_lines
+            elif screen is not None:
+                height, width = screen.size()
+                view.height = max(1, height - len(header_lines) - 3)
+                lines = header_lines + [''] + view.get_lines()
+            else:
+                lines = header_lines + [''] + aggregator.get_partition_data_lines()
+
+            if screen is not None:
+                screen.draw(lines)
+            else:
+                print '\r\n'.join(lines)
+
+        for key in wait_for_keys(window, next_update - monotonic()):
+            if key == ord('s'):
+                stats.enabled = not stats.enabled
+            elif key == ord('t') and shown is not None:
+                names = sorted(aggregators)
+                shown = names[(names.index(shown) + 1) % len(names)]
+                view.offset = 0
+            elif key == ord('v') and view is not None:
+                view = views[(views.index(view) + 1) % len(views)]
+            elif key == curses.KEY_RESIZE:
+                screen.invalidate()
+            elif view is not None:
+                view.handle_key(key)
 
 
 def top():
     options = read_args()
 
-    zc = ZkClient(options.zserver, options.zport)
-    zc.start()
+    open_capture(options)
+    open_alerts(options)
+    zc = ZkClient(options.zserver, options.zport, make_stats(options))
+    start(zc, options)
+    pool = make_pool(options)
+    registry = make_registry(zc, options)
 
     try:
-        curses.wrapper(curses_main, [zc, options])
-        #curses_main(None, [zc, options])
+        curses.wrapper(curses_main, [zc, options, pool, registry])
+        #curses_main(None, [zc, options, pool, registry])
 
     except KeyboardInterrupt:
 
         pass
 
+    except CaptureError, e:
+        print 'Replay finished: %s' % str(e)
+
     finally:
-        zc.stop()
+        pool.close()
+        stop(zc, options)
+
+
+def daemon():
+    options = read_args()
+    logging.basicConfig(stream=sys.stderr, level=getattr(logging, options.log_level.upper()),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    stats = make_stats(options)
+
+    open_capture(options)
+    open_alerts(options)
+    zc = ZkClient(options.zserver, options.zport, stats)
+    start(zc, options)
+    pool = make_pool(options)
+    registry = make_registry(zc, options)
+
+    refresher = SnapshotRefresher(make_spout_source(zc, options),
+                                  record_fetches(shard_fetches(make_fetcher(pool, options, stats), zc, options),
+                                                 options),
+                                  options.topologies, options.zserver + ':' + str(options.zport),
+                                  options.update_interval if options.replayer is None else 0.0,
+                                  stats, options.stats_file, registry,
+                                  make_aggregator_factory(options), refresh_clock(options))
+    server = ExporterServer((options.listen, options.http_port), refresher)
+    resident = None
+    stores = {}                 # Read-only histories opened by queries
+    if options.socket is not None:
+        try:
+            resident = ResidentServer(options.socket, answer_query(refresher, options, stores))
+        except (ResidentError, IOError, OSError), e:
+            print 'Failed to listen on %s: %s' % (options.socket, str(e))
+            server.server_close()
+            pool.close()
+            stop(zc, options)
+            return 1
+        listener = threading.Thread(target=resident.serve_forever)
+        listener.daemon = True
+        listener.start()
+    refresher.start()
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+
+        pass
+
+    finally:
+        refresher.stop()
+        refresher.join()
+        server.server_close()
+        if resident is not None:
+            resident.shutdown()
+            resident.server_close()
+        for history in stores.values():
+            history.close()
+        pool.close()
+        stop(zc, options)
+
+    return 0
 
 if __name__ == '__main__':
     sys.exit(main())
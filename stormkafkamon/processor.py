@@ -7,13 +7,18 @@ class NullHandler(logging.Handler):
     def emit(self, record):
         pass
 
-logger = logging.getLogger('kafka.codec').addHandler(NullHandler())
+logging.getLogger('kafka.codec').addHandler(NullHandler())
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
 
+import sys
 import struct
-import socket
+from array import array
+from itertools import imap
 from collections import namedtuple
-from kafka.client import KafkaClient
-from kafka.common import OffsetRequest
+
+from brokerpool import BrokerPool
+from fetcher import OffsetFetcher
 
 class ProcessorError(Exception):
     def __init__(self, msg):
@@ -32,59 +37,284 @@ PartitionState = namedtuple('PartitionState',
         'depth',            # Depth of partition on broker.
         'spout',            # The Spout consuming this partition
         'current',          # Current offset for Spout
-        'delta'             # Difference between latest and current
+        'delta',            # Difference between latest and current
+        'status',           # STATUS_OK, STATUS_STALE, STATUS_UNKNOWN or STATUS_INVALID
+        'topology'          # The Storm Topology the Spout belongs to
     ])
 PartitionsSummary = namedtuple('PartitionsSummary',
     [
-        'total_depth',      # Total queue depth.
-        'total_delta',      # Total delta across all spout tasks.
+        'total_depth',      # Total queue depth, of partitions not unknown.
+        'total_delta',      # Total delta across all spout tasks, of partitions not unknown.
         'num_partitions',   # Number of partitions.
         'num_brokers',      # Number of Kafka Brokers.
-        'partitions'        # Tuple of PartitionStates
+        'num_stale',        # Partitions showing offsets from an earlier refresh.
+        'num_unknown',      # Partitions whose broker offsets were never read, or
+                            # that Kafka does not have.
+        'partitions',       # Tuple of PartitionStates
+        'columns'           # SummaryColumns of the partitions, or None
     ])
 
-def process(spouts):
+# Broker offsets of a partition are either from this refresh, the last ones
+# read before its broker failed to answer, or have never been read. In the
+# last case earliest and latest are shown as the Spout's offset, so depth
+# and delta are zero. So they are for a partition that --validate finds
+# Kafka does not have, which is never asked for. Either way the partition
+# is left out of the totals and rates, as its offsets are not known.
+STATUS_OK = 'ok'
+STATUS_STALE = 'stale'
+STATUS_UNKNOWN = 'unknown'
+STATUS_INVALID = 'unknown partition'
+
+class SummaryColumns(object):
     '''
-    Returns a named tuple of type PartitionsSummary.
+    The offsets of the partitions of a summary as one array per column, in
+    the order the partitions were processed, filled in as their
+    PartitionStates are made. SummaryAggregator takes the arrays as they
+    are, rather than unpacking every PartitionState again. Not modified
+    once the summary is made.
+    '''
+    def __init__(self):
+        self.keys = []              # (broker, topic, partition)
+        self.earliest = array('l')
+        self.latest = array('l')
+        self.current = array('l')
+        self.depth = array('l')
+        self.delta = array('l')
+        self.spout = []
+        self.topology = []
+        self.status = {}            # Index -> status, for partitions not STATUS_OK
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, earliest, latest, current, spout, status, topology):
+        if status != STATUS_OK:
+            self.status[len(self.keys)] = status
+        self.keys.append(key)
+        self.earliest.append(earliest)
+        self.latest.append(latest)
+        self.current.append(current)
+        self.depth.append(latest - earliest)
+        self.delta.append(latest - current)
+        self.spout.append(spout)
+        self.topology.append(topology)
+
+    def select(self, indices):
+        '''
+        Returns a SummaryColumns of the partitions at indices, in that
+        order.
+        '''
+        c = SummaryColumns()
+        c.keys = map(self.keys.__getitem__, indices)
+        for name in ('earliest', 'latest', 'current', 'depth', 'delta'):
+            setattr(c, name, array('l', imap(getattr(self, name).__getitem__, indices)))
+        c.spout = map(self.spout.__getitem__, indices)
+        c.topology = map(self.topology.__getitem__, indices)
+        status = self.status
+        if status:
+            c.status = dict((j, status[i]) for j, i in enumerate(indices) if i in status)
+        return c
+
+class Totals(object):
+    '''
+    Running totals over a stream of PartitionStates.
+    '''
+    def __init__(self):
+        self.total_depth = 0
+        self.total_delta = 0
+        self.num_partitions = 0
+        self.num_stale = 0
+        self.num_unknown = 0
+        self.brokers = set()
+
+    def add(self, p):
+        self.num_partitions += 1
+        if p.status == STATUS_UNKNOWN or p.status == STATUS_INVALID:
+            # Its depth and delta are not known, not zero.
+            self.num_unknown += 1
+        else:
+            self.total_depth += p.depth
+            self.total_delta += p.delta
+            if p.status == STATUS_STALE:
+                self.num_stale += 1
+        self.brokers.add(p.broker)
+
+    def summary(self, partitions, columns=None):
+        return PartitionsSummary(total_depth=self.total_depth,
+                                 total_delta=self.total_delta,
+                                 num_partitions=self.num_partitions,
+                                 num_brokers=len(self.brokers),
+                                 num_stale=self.num_stale,
+                                 num_unknown=self.num_unknown,
+                                 partitions=partitions,
+                                 columns=columns)
+
+def by_topology(summary, names=()):
+    '''
+    Splits a PartitionsSummary into one per topology, and returns a dict
+    of topology name -> PartitionsSummary. Topologies in names are
+    included even if they have no partitions.
+    '''
+    totals = dict((t, Totals()) for t in names)
+    partitions = dict((t, []) for t in names)
+    for p in summary.partitions:
+        t = totals.get(p.topology)
+        if t is None:
+            t = totals[p.topology] = Totals()
+            partitions[p.topology] = []
+        t.add(p)
+        partitions[p.topology].append(p)
+
+    columns = dict((t, None) for t in totals)
+    if summary.columns is not None:
+        indices = dict((t, []) for t in totals)
+        for i, t in enumerate(summary.columns.topology):
+            indices[t].append(i)
+        for t in totals:
+            columns[t] = summary.columns.select(indices[t])
+
+    return dict((t, totals[t].summary(tuple(partitions[t]), columns[t])) for t in totals)
+
+def split_summary(summary, topologies):
+    '''
+    Returns by_topology(summary) for the topologies selected by a
+    TopologyFilter, without copying the summary if it selects just one.
+    '''
+    single = topologies.single()
+    if single is not None:
+        return {single: summary}
+    return by_topology(summary, topologies.named())
+
+def _log_errors(errors):
+    '''
+    Logs why partitions are shown stale or unknown, one line for each
+    distinct error of a fetch.
     '''
+    if not errors:
+        return
+    by_error = {}
+    for key, error in errors.iteritems():
+        by_error.setdefault(error, []).append(key)
+    for error, keys in sorted(by_error.iteritems()):
+        logger.warning('No offsets for %d partition(s), including %s:%s %s/%s: %s',
+                       len(keys), keys[0][0], keys[0][1], keys[0][2], keys[0][3], error)
+
+def _resolve(pending, fetcher, registry=None, columns=None):
+    '''
+    Fetches offsets for a list of (spout id, partition JSON) pairs and
+    returns their PartitionStates, in the same order, marking those whose
+    offsets could not be fetched as stale or unknown. If a BrokerRegistry
+    is given, every partition is first checked against the topic layout
+    registered by the brokers, and those Kafka does not have are marked
+    invalid rather than fetched. If columns, a SummaryColumns, is given,
+    the partitions are also added to it.
+
+    Offsets of a partition consumed by several topologies are fetched
+    once and shared by all of them.
+    '''
+    work = {}
+    positions = {}
+    invalid = set()
+    for spout, p in pending:
+        broker = (p['broker']['host'], int(p['broker']['port']))
+        key = broker + (p['topic'], p['partition'])
+        if registry is not None and \
+                registry.validate(broker[0], broker[1], p['topic'], p['partition']) is not None:
+            invalid.add(key)
+            continue
+        work.setdefault(broker, set()).add((p['topic'], p['partition']))
+        positions[key] = p['offset']
+
+    # Partitions the brokers failed to answer for fall back to the offsets
+    # last read for them, so one bad broker does not hold up the rest.
+    offsets, errors = fetcher.fetch(work, positions)
+    _log_errors(errors)
+
     results = []
-    total_depth = 0
-    total_delta = 0
-    brokers = []
+    for spout, p in pending:
+        key = (p['broker']['host'], int(p['broker']['port']), p['topic'], p['partition'])
+        current = p['offset']
+        status = STATUS_OK
+
+        if key in invalid:
+            o = None
+            status = STATUS_INVALID
+        else:
+            o = offsets.get(key)
+            if o is None:
+                o = fetcher.last_known(key)
+                status = STATUS_STALE
+            if o is None:
+                status = STATUS_UNKNOWN
+        if o is None:
+            earliest = latest = current
+        else:
+            earliest = o.earliest
+            latest = o.latest
+
+        if columns is not None:
+            columns.add((key[0], key[2], key[3]), earliest, latest, current, spout, status,
+                        p['topology']['name'])
+        results.append(PartitionState._make([
+            p['broker']['host'],
+            p['topic'],
+            p['partition'],
+            earliest,
+            latest,
+            latest - earliest,
+            spout,
+            current,
+            latest - current,
+            status,
+            p['topology']['name']]))
+
+    return results
+
+def process_iter(spouts, fetcher, chunk_size=None, registry=None, columns=None):
+    '''
+    Generates a PartitionState for every partition of spouts, which may be
+    any iterable of ZkKafkaSpouts, including a generator. Offsets are
+    fetched for chunk_size partitions at a time, so only one chunk is held
+    in memory. chunk_size defaults to one full batch for every broker
+    queried in parallel. Partitions are validated against registry, if
+    given, and added to columns, a SummaryColumns, if given.
+    '''
+    if chunk_size is None:
+        chunk_size = fetcher.batch_size * fetcher.max_inflight
+
+    pending = []
     for s in spouts:
         for p in s.partitions:
-            try:
-                k = KafkaClient(p['broker']['host'] + ':' + str(p['broker']['port']))
-            except socket.gaierror, e:
-                raise ProcessorError('Failed to contact Kafka broker %s (%s)' %
-                                     (p['broker']['host'], str(e)))
-            earliest_off = OffsetRequest(p['topic'], p['partition'], -2, 1)
-            latest_off = OffsetRequest(p['topic'], p['partition'], -1, 1)
-
-            earliest_resps = k.send_offset_request([earliest_off])
-            latest_resps = k.send_offset_request([latest_off])
-
-            earliest = earliest_resps[0].offsets[0]
-            latest = latest_resps[0].offsets[0]
-            current = p['offset']
-
-            brokers.append(p['broker']['host'])
-            total_depth = total_depth + (latest - earliest)
-            total_delta = total_delta + (latest - current)
-
-            results.append(PartitionState._make([
-                p['broker']['host'],
-                p['topic'],
-                p['partition'],
-                earliest,
-                latest,
-                latest - earliest,
-                s.id,
-                current,
-                latest - current]))
-
-    return PartitionsSummary(total_depth=total_depth,
-                             total_delta=total_delta,
-                             num_partitions=len(results),
-                             num_brokers=len(set(brokers)),
-                             partitions=tuple(sorted(results, key=lambda x: x.partition)))
+            pending.append((s.id, p))
+            if len(pending) >= chunk_size:
+                for result in _resolve(pending, fetcher, registry, columns):
+                    yield result
+                pending = []
+
+    if pending:
+        for result in _resolve(pending, fetcher, registry, columns):
+            yield result
+
+def process(spouts, fetcher=None, registry=None):
+    '''
+    Returns a named tuple of type PartitionsSummary.
+
+    Offsets are requested through fetcher, if one is given, so that broker
+    connections can be kept open between calls. Otherwise a private
+    OffsetFetcher is used and its connections closed before returning.
+    '''
+    if fetcher is None:
+        pool = BrokerPool()
+        try:
+            return process(spouts, OffsetFetcher(pool), registry)
+        finally:
+            pool.close()
+
+    totals = Totals()
+    columns = SummaryColumns()
+    results = []
+    for p in process_iter(spouts, fetcher, chunk_size=sys.maxint, registry=registry, columns=columns):
+        totals.add(p)
+        results.append(p)
+
+    return totals.summary(tuple(sorted(results, key=lambda x: x.partition)), columns)
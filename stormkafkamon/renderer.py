@@ -0,0 +1,236 @@
+# Draws sktop's partition list one screenful at a time. Only the rows in
+# view are formatted, and only the parts of the screen that changed since
+# the previous frame are written to the terminal.
+
+import curses
+import heapq
+
+from rollups import ROLLUP_HEADER, DEFAULT_TOP
+
+class PartitionView(object):
+    '''
+    The window onto the partition rows of a SummaryAggregator: which rows
+    are in view, in what order, given the scroll position and sort key.
+    '''
+    SORT_KEYS = {
+        ord('p'): 'partition',
+        ord('l'): 'lag',
+        ord('r'): 'rate',
+        ord('d'): 'depth',
+    }
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.sort = 'partition'
+        self.offset = 0
+        self.height = 0
+
+    def _sort_key(self):
+        a = self.aggregator
+        if self.sort == 'lag':
+            return a.partitions.delta.__getitem__
+        if self.sort == 'depth':
+            return a.partitions.depth.__getitem__
+        if self.sort == 'rate':
+            return a.partitions.net_at
+        return None
+
+    def num_rows(self):
+        return len(self.aggregator.partitions.rows())
+
+    def visible_rows(self):
+        '''
+        Returns the rows in view. Only the first offset + height rows of
+        the sort order are ever picked out, never the whole order.
+        '''
+        rows = self.aggregator.partitions.rows()
+        self.offset = max(0, min(self.offset, len(rows) - self.height))
+
+        key = self._sort_key()
+        if key is None:
+            return rows[self.offset:self.offset + self.height]
+        return heapq.nlargest(self.offset + self.height, rows, key=key)[self.offset:]
+
+    def get_lines(self):
+        a = self.aggregator
+        rows = self.visible_rows()
+        total = self.num_rows()
+
+        status = 'Partitions %d-%d of %d, sorted by %s' % (min(total, self.offset + 1),
+                                                          self.offset + len(rows), total, self.sort)
+        return [status, a.PARTITION_HEADER] + [a.get_partition_line(row) for row in rows]
+
+    def handle_key(self, key):
+        '''
+        Scrolls or re-sorts the view for key. Returns True if the key was
+        one of the view's.
+        '''
+        page = max(1, self.height - 1)
+
+        if key in (curses.KEY_UP, ord('k')):
+            self.offset -= 1
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.offset += 1
+        elif key in (curses.KEY_PPAGE, ord('b')):
+            self.offset -= page
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.offset += page
+        elif key in (curses.KEY_HOME, ord('g')):
+            self.offset = 0
+        elif key in (curses.KEY_END, ord('G')):
+            self.offset = self.num_rows()
+        elif key in PartitionView.SORT_KEYS:
+            self.sort = PartitionView.SORT_KEYS[key]
+            self.offset = 0
+        else:
+            return False
+
+        self.offset = max(0, min(self.offset, self.num_rows() - self.height))
+        return True
+
+class RollupView(object):
+    '''
+    The window onto the groups of one rollup dimension of a
+    SummaryAggregator. The group under the cursor can be expanded to show
+    its top laggiest partitions beneath it.
+    '''
+    SORT_KEYS = PartitionView.SORT_KEYS
+    ENTER_KEYS = (curses.KEY_ENTER, ord('\n'), ord('\r'), ord('e'))
+
+    def __init__(self, aggregator, dimension, top=DEFAULT_TOP):
+        self.aggregator = aggregator
+        self.dimension = dimension
+        self.top = top
+        self.sort = 'partition'
+        self.offset = 0
+        self.cursor = 0
+        self.height = 0
+        self.expanded = set()       # Names of expanded groups
+
+    def _groups(self):
+        groups = self.aggregator.rollups.groups[self.dimension]
+        if self.sort == 'lag':
+            return sorted(groups.values(), key=lambda g: g.delta, reverse=True)
+        if self.sort == 'depth':
+            return sorted(groups.values(), key=lambda g: g.depth, reverse=True)
+        if self.sort == 'rate':
+            return sorted(groups.values(), key=lambda g: g.rates()[0] - g.rates()[1], reverse=True)
+        return [groups[name] for name in sorted(groups)]
+
+    def _entries(self):
+        '''
+        Returns the (group, row) of each line, with row None for the line
+        of the group itself.
+        '''
+        columns = self.aggregator.partitions
+        entries = []
+        for g in self._groups():
+            entries.append((g, None))
+            if g.name in self.expanded:
+                entries.extend((g, row) for row in g.laggiest(columns, self.top))
+        return entries
+
+    def num_rows(self):
+        return len(self._entries())
+
+    def get_lines(self):
+        a = self.aggregator
+        entries = self._entries()
+        self.cursor = max(0, min(self.cursor, len(entries) - 1))
+        # Scroll just far enough to keep the cursor in view.
+        self.offset = max(self.cursor - self.height + 1, min(self.offset, self.cursor))
+
+        lines = []
+        for i, (g, row) in enumerate(entries[self.offset:self.offset + self.height], self.offset):
+            mark = '>' if i == self.cursor else ' '
+            if row is None:
+                lines.append(mark + ('-' if g.name in self.expanded else '+') +
+                             g.get_line(a.estimator.estimate_group(self.dimension, g)))
+            else:
+                lines.append(mark + '    ' + a.get_partition_line(row))
+
+        groups = len(a.rollups.groups[self.dimension])
+        status = 'Grouped by %s: %d groups, sorted by %s (Enter expands)' % (self.dimension, groups, self.sort)
+        return [status, '  ' + ROLLUP_HEADER] + lines
+
+    def handle_key(self, key):
+        '''
+        Moves the cursor, re-sorts, or expands or collapses the group under
+        the cursor for key. Returns True if the key was one of the view's.
+        '''
+        page = max(1, self.height - 1)
+
+        if key in (curses.KEY_UP, ord('k')):
+            self.cursor -= 1
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.cursor += 1
+        elif key in (curses.KEY_PPAGE, ord('b')):
+            self.cursor -= page
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.cursor += page
+        elif key in (curses.KEY_HOME, ord('g')):
+            self.cursor = 0
+        elif key in (curses.KEY_END, ord('G')):
+            self.cursor = self.num_rows()
+        elif key in RollupView.SORT_KEYS:
+            self.sort = RollupView.SORT_KEYS[key]
+            self.cursor = 0
+        elif key in RollupView.ENTER_KEYS:
+            entries = self._entries()
+            if 0 <= self.cursor < len(entries):
+                name = entries[self.cursor][0].name
+                if name in self.expanded:
+                    self.expanded.discard(name)
+                    # Back onto the group's own line.
+                    self.cursor = [e[0].name for e in entries].index(name)
+                else:
+                    self.expanded.add(name)
+        else:
+            return False
+
+        self.cursor = max(0, min(self.cursor, self.num_rows() - 1))
+        return True
+
+class Screen(object):
+    '''
+    Remembers what is on each line of a curses window, so a new frame only
+    writes from the first character that differs on each changed line.
+    '''
+    def __init__(self, window):
+        self.window = window
+        self.lines = []
+
+    def invalidate(self):
+        self.lines = []
+        self.window.erase()
+
+    def size(self):
+        return self.window.getmaxyx()
+
+    def draw(self, lines):
+        height, width = self.window.getmaxyx()
+        lines = [line[:(width - 1)] for line in lines[:height]]
+        lines.extend([''] * (height - len(lines)))
+
+        if len(self.lines) != height:
+            self.invalidate()
+            self.lines = [''] * height
+
+        for y, line in enumerate(lines):
+            old = self.lines[y]
+            if old == line:
+                continue
+
+            x = 0
+            for a, b in zip(old, line):
+                if a != b:
+                    break
+                x += 1
+
+            self.window.move(y, x)
+            if x < len(line):
+                self.window.addstr(line[x:])
+            self.window.clrtoeol()
+            self.lines[y] = line
+
+        self.window.refresh()
@@ -0,0 +1,85 @@
+# Serves skq queries on a UNIX socket for a resident skexport. Each
+# connection sends an skmon command line and is answered with what skmon
+# would print for it, rendered from the latest snapshot, or is declined so
+# that skq runs skmon itself.
+
+import os
+import socket
+import logging
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+from client import ANSWERED, DECLINED, decode_args
+
+logger = logging.getLogger(__name__)
+
+class ResidentError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+class QueryDeclined(Exception):
+    '''
+    Raised by a query's answer function when the snapshot cannot answer
+    it the way skmon would.
+    '''
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        args = decode_args(self.rfile.read())
+        try:
+            output, status = self.server.answer(args)
+            reply = '%s %d\n%s' % (ANSWERED, status, output)
+        except QueryDeclined, e:
+            reply = '%s %s\n' % (DECLINED, e)
+        except Exception, e:
+            logger.warning('Answering %s failed: %s', ' '.join(args), e)
+            reply = '%s %s\n' % (DECLINED, e)
+        self.wfile.write(reply)
+
+class ResidentServer(ThreadingMixIn, UnixStreamServer):
+    '''
+    Answers each query with answer(args), given the query's command line
+    as a list of arguments, which returns the output and the exit status
+    of skq, or raises QueryDeclined.
+
+    A socket left behind by a daemon that died is replaced, but one that
+    another daemon is still listening on, or that another user owns, is
+    not. The socket is created accessible to its owner only.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, answer):
+        self.answer = answer
+        if os.path.exists(path):
+            if os.stat(path).st_uid != os.getuid():
+                raise ResidentError('%s belongs to another user' % path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise ResidentError('Another daemon is listening on %s' % path)
+            finally:
+                probe.close()
+        # Bound under a umask, not chmodded afterwards, so the socket is
+        # never open to others.
+        umask = os.umask(077)
+        try:
+            UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -0,0 +1,210 @@
+# Sums partition depth, delta and rates per topic, per Spout task and per
+# broker. sktop keeps the sums up to date from just the partitions that
+# changed in each refresh; skmon adds them up as partitions go past.
+
+import heapq
+from collections import deque
+from itertools import izip
+
+from processor import Totals
+from estimator import NO_ESTIMATE, format_duration, format_eta
+
+DIMENSIONS = ['topic', 'spout', 'broker']
+DEFAULT_TOP = 5
+
+ROLLUP_HEADER = "            Name           | Parts |     Depth    |     Delta    |    Added/s   |   Removed/s  |  Time Lag | Catch-up |"
+
+class Group(object):
+    '''
+    Sums over the partitions of one topic, Spout or broker, and the
+    messages added to and consumed from them over the last RATE_INTERVAL
+    seconds.
+    '''
+    RATE_INTERVAL = 60
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = set()
+        self.depth = 0
+        self.delta = 0
+        self.added = 0              # Since the last call to close()
+        self.removed = 0
+        self.produced = 0           # Added over all closed refreshes
+        self.samples = deque()      # (time, added, removed)
+        self.total_added = 0        # Over samples
+        self.total_removed = 0
+
+    def close(self, time):
+        '''
+        Ends a refresh, taken at time, adding what was added and removed
+        during it to the rates.
+        '''
+        self.samples.append((time, self.added, self.removed))
+        self.total_added += self.added
+        self.total_removed += self.removed
+        self.produced += self.added
+        self.added = 0
+        self.removed = 0
+        while self.samples and time - self.samples[0][0] >= Group.RATE_INTERVAL:
+            _, added, removed = self.samples.popleft()
+            self.total_added -= added
+            self.total_removed -= removed
+
+    def rates(self):
+        '''
+        Returns the messages added and removed per second, as MovingAverage
+        computes them, or -1s until there are two samples.
+        '''
+        if len(self.samples) < 2:
+            return -1, -1
+        seconds = self.samples[-1][0] - self.samples[0][0]
+        if seconds <= 0:
+            return -1, -1
+        return self.total_added / seconds, self.total_removed / seconds
+
+    def laggiest(self, columns, n=DEFAULT_TOP):
+        '''
+        Returns the n rows of columns with the largest delta, largest first.
+        '''
+        return heapq.nlargest(n, self.rows, key=columns.delta.__getitem__)
+
+    def get_line(self, estimate=NO_ESTIMATE):
+        added, removed = self.rates()
+        return "%-26.26s | %5d |% 13d |% 13d |% 13d |% 13d |%10s |%9s |" % (self.name, len(self.rows), self.depth,
+                                                                         self.delta, added, removed,
+                                                                         format_duration(estimate.time_lag),
+                                                                         format_eta(estimate))
+
+class Rollups(object):
+    '''
+    Groups of the rows of a PartitionColumns by each of DIMENSIONS. After
+    the columns are updated, update() moves only the rows that changed
+    between groups or within them. Whenever the set of rows present
+    changes, which is rare, every group is summed again instead.
+    '''
+    def __init__(self, columns):
+        self.columns = columns
+        self.groups = dict((d, {}) for d in DIMENSIONS)
+        self.memberships = {}       # Row -> tuple of its Groups, in DIMENSIONS order
+        self.present = None         # The columns' present array last seen
+        self.changed = 0            # Rows applied by the last update
+
+    def _names(self, row):
+        broker, topic, partition = self.columns.keys[row]
+        return (topic, self.columns.spout[row], broker)
+
+    def _groups_of(self, names):
+        groups = []
+        for d, name in izip(DIMENSIONS, names):
+            g = self.groups[d].get(name)
+            if g is None:
+                g = self.groups[d][name] = Group(name)
+            groups.append(g)
+        return tuple(groups)
+
+    def _rebuild(self):
+        c = self.columns
+        for groups in self.groups.values():
+            for g in groups.values():
+                g.rows.clear()
+                g.depth = 0
+                g.delta = 0
+
+        self.memberships = {}
+        rows = c.rows()
+        for row in rows:
+            groups = self.memberships[row] = self._groups_of(self._names(row))
+            for g in groups:
+                g.rows.add(row)
+                g.depth += c.depth[row]
+                g.delta += c.delta[row]
+                g.added += c.added_at(row)
+                g.removed += c.removed_at(row)
+
+        # Groups left with no partitions are gone.
+        for d in DIMENSIONS:
+            self.groups[d] = dict((name, g) for name, g in self.groups[d].iteritems() if g.rows)
+        self.changed = len(rows)
+
+    def _apply(self, rows):
+        c = self.columns
+        for row in rows:
+            old = self.memberships[row]
+            names = self._names(row)
+            if c.spout[row] != c.prev_spout[row]:
+                # Taken over by another Spout task.
+                new = self._groups_of(names)
+                for g in old:
+                    g.rows.discard(row)
+                    g.depth -= c.prev_depth[row]
+                    g.delta -= c.prev_delta[row]
+                for g in new:
+                    g.rows.add(row)
+                    g.depth += c.depth[row]
+                    g.delta += c.delta[row]
+                for g in old:
+                    if not g.rows:
+                        del self.groups[DIMENSIONS[old.index(g)]][g.name]
+                self.memberships[row] = old = new
+            else:
+                depth = c.depth[row] - c.prev_depth[row]
+                delta = c.delta[row] - c.prev_delta[row]
+                for g in old:
+                    g.depth += depth
+                    g.delta += delta
+
+            added = c.added_at(row)
+            removed = c.removed_at(row)
+            for g in old:
+                g.added += added
+                g.removed += removed
+        self.changed = len(rows)
+
+    def update(self, time):
+        '''
+        Brings the groups up to date with the columns, as of time in
+        seconds.
+        '''
+        if self.columns.present is not self.present:
+            self.present = self.columns.present
+            self._rebuild()
+        else:
+            self._apply(self.columns.changed_rows())
+
+        for groups in self.groups.values():
+            for g in groups.itervalues():
+                g.close(time)
+
+class RunningRollups(object):
+    '''
+    Totals per topic, Spout and broker over a stream of PartitionStates,
+    each with a bounded heap of its top laggiest partitions, so memory
+    grows with the number of groups rather than of partitions.
+    '''
+    def __init__(self, top=DEFAULT_TOP):
+        self.top = top
+        self.groups = dict((d, {}) for d in DIMENSIONS)     # Name -> (Totals, heap of (delta, PartitionState))
+
+    def add(self, p):
+        for d, name in izip(DIMENSIONS, (p.topic, p.spout, p.broker)):
+            g = self.groups[d].get(name)
+            if g is None:
+                g = self.groups[d][name] = (Totals(), [])
+            g[0].add(p)
+            if len(g[1]) < self.top:
+                heapq.heappush(g[1], (p.delta, p))
+            elif self.top:
+                heapq.heappushpop(g[1], (p.delta, p))
+
+    def names(self, dimension):
+        return sorted(self.groups[dimension])
+
+    def totals(self, dimension, name):
+        return self.groups[dimension][name][0]
+
+    def laggiest(self, dimension, name):
+        '''
+        Returns the top laggiest PartitionStates of a group, largest delta
+        first.
+        '''
+        return [p for delta, p in sorted(self.groups[dimension][name][1], reverse=True)]
@@ -0,0 +1,140 @@
+# Polls each partition's broker offsets at its own rate: quickly while its
+# lag is changing, and less and less often while it is not.
+
+import heapq
+
+from clock import monotonic
+
+class PollScheduler(object):
+    '''
+    Keeps a poll interval and a deadline per key. After each poll the
+    interval is halved if the partition's delta changed since the
+    previous poll, and doubled if it did not, within [min_interval,
+    max_interval]. Deadlines are kept in a heap, so finding the keys that
+    are due costs O(k log n) for k due keys.
+    '''
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max(min_interval, max_interval))
+        self.entries = {}           # Key -> [deadline, interval, delta]
+        self.deadlines = []         # Heap of (deadline, key)
+
+    def _schedule(self, key, entry, now):
+        entry[0] = now + entry[1]
+        heapq.heappush(self.deadlines, (entry[0], key))
+
+    def pop_due(self, now):
+        '''
+        Returns the set of keys whose deadline has passed. They are not
+        scheduled again until observed.
+        '''
+        due = set()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            entry = self.entries.get(key)
+            # Skip heap entries superseded by a later observation.
+            if entry is not None and entry[0] == deadline:
+                entry[0] = None
+                due.add(key)
+        return due
+
+    def observe(self, key, delta, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, self.min_interval, delta]
+        elif delta != entry[2]:
+            entry[1] = max(self.min_interval, entry[1] / 2)
+        else:
+            entry[1] = min(self.max_interval, entry[1] * 2)
+        entry[2] = delta
+        self._schedule(key, entry, now)
+
+    def retry(self, key, now):
+        '''
+        Schedules a key whose poll failed to be polled again soon.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [None, self.min_interval, None]
+        entry[1] = self.min_interval
+        self._schedule(key, entry, now)
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+
+    def next_deadline(self):
+        '''
+        Returns the earliest deadline, or None if nothing is scheduled.
+        '''
+        while self.deadlines:
+            deadline, key = self.deadlines[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+class ScheduledFetcher(object):
+    '''
+    Wraps an OffsetFetcher so that only partitions whose poll is due, or
+    which have never been polled, are fetched. The last offsets fetched
+    stand in for all other partitions.
+
+    The Spouts' offsets, read from Zookeeper on every refresh and passed
+    as positions, also make a partition due at once when its Spout's
+    offset passes the latest offset fetched, so offsets standing in never
+    show a negative delta. A Spout moving short of that waits for its
+    partition's poll. Poll intervals follow the volatility of the delta,
+    the lag between the latest offset and the Spout's.
+
+    Polls happen only as often as refreshes call fetch(), so an interval
+    shorter than the time between refreshes counts as that time.
+
+    Each refresh must ask for all its partitions in a single fetch(), as
+    process() does, since a due partition missing from that call is taken
+    to be no longer consumed.
+    '''
+    def __init__(self, fetcher, scheduler, clock=monotonic):
+        self.fetcher = fetcher
+        self.scheduler = scheduler
+        self.clock = clock
+        self.offsets = {}           # (host, port, topic, partition) -> PartitionOffsets
+        self.batch_size = fetcher.batch_size
+        self.max_inflight = fetcher.max_inflight
+
+    def fetch(self, work, positions=None):
+        now = self.clock()
+        due = self.scheduler.pop_due(now)
+        if positions is None:
+            positions = {}
+
+        results = {}
+        to_fetch = {}
+        for (host, port), topic_partitions in work.items():
+            for topic, partition in topic_partitions:
+                key = (host, port, topic, partition)
+                o = self.offsets.get(key)
+                current = positions.get(key)
+                if key in due or o is None or (current is not None and current > o.latest):
+                    to_fetch.setdefault((host, port), set()).add((topic, partition))
+                else:
+                    results[key] = o
+
+        fetched, errors = self.fetcher.fetch(to_fetch, positions)
+        for key, offsets in fetched.items():
+            self.offsets[key] = offsets
+            self.scheduler.observe(key, offsets.latest - positions.get(key, 0), now)
+        for key in errors:
+            self.scheduler.retry(key, now)
+        results.update(fetched)
+
+        # Partitions that were due but are no longer consumed.
+        for key in due:
+            if key not in fetched and key not in errors:
+                self.offsets.pop(key, None)
+                self.scheduler.forget(key)
+
+        return results, errors
+
+    def last_known(self, key):
+        return self.offsets.get(key)
@@ -0,0 +1,306 @@
+# Splits the work of fetching broker offsets between several monitor
+# instances. Each registers an ephemeral node under a coordination path in
+# Zookeeper, fetches only the partitions a consistent hash ring of the
+# registered instances gives it, and publishes the offsets it fetched as
+# the data of its node, for the other instances to read.
+
+import os
+import time
+import bisect
+import socket
+import struct
+import hashlib
+import logging
+import uuid
+
+from kazoo.exceptions import KazooException, NoNodeError
+
+from zkclient import ZkClient, ZkMirror
+from capture import encode_offsets, decode_offsets
+
+logger = logging.getLogger(__name__)
+
+class HashRing(object):
+    '''
+    Consistent hash ring of members, each placed at vnodes points, so that
+    a member joining or leaving moves only about 1/n of the keys.
+    '''
+    VNODES = 64
+
+    def __init__(self, members, vnodes=VNODES):
+        points = []
+        for m in members:
+            for i in xrange(vnodes):
+                points.append((HashRing._hash('%s#%d' % (m, i)), m))
+        points.sort()
+        self.hashes = [h for h, m in points]
+        self.members = [m for h, m in points]
+
+    @staticmethod
+    def _hash(s):
+        return struct.unpack('>Q', hashlib.md5(s).digest()[:8])[0]
+
+    def owner(self, key):
+        '''
+        Returns the member owning key, a string, or None if there are no
+        members.
+        '''
+        if not self.hashes:
+            return None
+        i = bisect.bisect(self.hashes, HashRing._hash(key))
+        return self.members[i % len(self.members)]
+
+# A published partial is PARTIAL followed by offsets encoded as in a
+# capture file. Offsets longer than MAX_PARTIAL, which leaves room under
+# Zookeeper's default 1MB limit on node data, are split into pieces of that
+# length, each published as PARTIAL followed by the piece in an ephemeral
+# node partials/<member>.<i>, as ephemeral nodes cannot have children. The
+# member's node then holds PARTIAL followed by CHUNKED. Readers only take
+# pieces published at the same time as the member's node.
+PARTIAL = struct.Struct('<d')          # time.time() when published
+CHUNKED = struct.Struct('<cI')         # CHUNK_MARK, number of pieces
+CHUNK_MARK = 'C'                        # Never the first byte of zlib data
+MAX_PARTIAL = 1000000
+
+class ShardCoordinator(ZkMirror):
+    '''
+    Membership of this instance under path/members, and the ring of all
+    members registered there. A watch on the members marks the ring stale
+    whenever one joins or leaves, and it is read again at the next use, so
+    ownership rebalances by itself.
+
+    The node is ephemeral, so an instance that dies leaves the ring when
+    its session expires. It is registered again after this instance's own
+    session is lost.
+
+    Zookeeper errors while publishing or reading partials are logged, not
+    raised, so the partitions of other members are then shown stale rather
+    than failing the refresh.
+    '''
+    DEFAULT_PATH = '/stormkafkamon/shards'
+
+    def __init__(self, zc, path=DEFAULT_PATH, member=None, max_partial=MAX_PARTIAL):
+        self.client = zc.client
+        self.stats = zc.stats
+        self.members_path = ZkClient._zjoin([path.rstrip('/'), 'members'])
+        self.partials_path = ZkClient._zjoin([path.rstrip('/'), 'partials'])
+        if member is None:
+            member = '%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.member = member
+        self.node = ZkClient._zjoin([self.members_path, member])
+        self.max_partial = max_partial
+        self.pieces = 0             # Pieces of the last partial published
+        self.registered = False
+        self.members = ()
+        self.ring = HashRing(())
+        self.owners = {}            # (host, topic, partition) -> member, for the current ring
+
+        self._follow_session(self.client)
+
+    def _session_lost(self):
+        self.registered = False
+        self.stale = True
+
+    def _watch(self, event):
+        self.stale = True
+
+    def current(self):
+        '''
+        Registers this instance if it is not, and reads the members again
+        if they changed.
+        '''
+        if not self.registered:
+            self.client.create(self.node, '', ephemeral=True, makepath=True)
+            self.registered = True
+            self.stale = True
+        if self.stale:
+            # Cleared before the read, so that a change during it is not
+            # missed.
+            self.stale = False
+            with self.reading():
+                members = tuple(sorted(self.client.get_children(self.members_path, watch=self._watch)))
+            self.stats.count('zk_reads')
+            if members != self.members:
+                self.members = members
+                self.ring = HashRing(members)
+                self.owners = {}
+
+    def owner(self, host, topic, partition):
+        key = (host, topic, partition)
+        member = self.owners.get(key)
+        if member is None:
+            member = self.owners[key] = self.ring.owner('%s/%s/%s' % key)
+        return member
+
+    def owns(self, host, topic, partition):
+        return self.owner(host, topic, partition) == self.member
+
+    def _piece(self, member, i):
+        return ZkClient._zjoin([self.partials_path, '%s.%d' % (member, i)])
+
+    def _set_piece(self, i, data):
+        path = self._piece(self.member, i)
+        try:
+            self.client.set(path, data)
+        except NoNodeError:
+            self.client.create(path, data, ephemeral=True, makepath=True)
+
+    def publish(self, results, errors):
+        header = PARTIAL.pack(time.time())
+        payload = encode_offsets(results, errors)
+        size = self.max_partial
+        try:
+            if len(payload) <= size:
+                pieces = 0
+                self.client.set(self.node, header + payload)
+            else:
+                pieces = (len(payload) + size - 1) // size
+                for i in xrange(pieces):
+                    self._set_piece(i, header + payload[i * size:(i + 1) * size])
+                self.client.set(self.node, header + CHUNKED.pack(CHUNK_MARK, pieces))
+            for i in xrange(pieces, self.pieces):
+                try:
+                    self.client.delete(self._piece(self.member, i))
+                except NoNodeError:
+                    pass
+            self.pieces = pieces
+        except NoNodeError:
+            # The session expired under us; register again next time.
+            self.registered = False
+        except KazooException, e:
+            logger.warning('Publishing offsets to %s failed: %s', self.node, e)
+
+    def _assemble(self, member, data):
+        '''
+        Returns the partial read from the node of member, with its pieces
+        joined if it was split, or None if it was published again while
+        its pieces were read.
+        '''
+        if len(data) < PARTIAL.size + CHUNKED.size or data[PARTIAL.size] != CHUNK_MARK:
+            return data
+        header = data[:PARTIAL.size]
+        n = CHUNKED.unpack_from(data, PARTIAL.size)[1]
+        pending = [self.client.get_async(self._piece(member, i)) for i in xrange(n)]
+        self.stats.count('zk_reads', n)
+        pieces = [header]
+        for result in pending:
+            piece = result.get()[0]
+            self.stats.count('zk_bytes', len(piece))
+            if piece[:PARTIAL.size] != header:
+                return None
+            pieces.append(piece[PARTIAL.size:])
+        return ''.join(pieces)
+
+    def read_partials(self, max_age):
+        '''
+        Returns a tuple of the offsets and of the errors published by
+        every other member, each merged into one dict. Partials older than
+        max_age seconds are left out, as their member has stopped
+        refreshing, and so are those that could not be read.
+        '''
+        try:
+            pending = [(m, self.client.get_async(ZkClient._zjoin([self.members_path, m])))
+                       for m in self.members if m != self.member]
+        except KazooException, e:
+            logger.warning('Reading published offsets failed: %s', e)
+            return {}, {}
+        self.stats.count('zk_reads', len(pending))
+
+        now = time.time()
+        offsets = {}
+        errors = {}
+        for m, result in pending:
+            try:
+                data = result.get()[0]
+                self.stats.count('zk_bytes', len(data))
+                data = self._assemble(m, data)
+            except NoNodeError:
+                continue            # Left since the members were read
+            except KazooException, e:
+                logger.warning('Reading the offsets published by %s failed: %s', m, e)
+                continue
+            if data is None or len(data) < PARTIAL.size:
+                continue            # Registered, but not yet published
+            if now - PARTIAL.unpack_from(data, 0)[0] > max_age:
+                continue
+            o, e = decode_offsets(data[PARTIAL.size:])
+            offsets.update(o)
+            errors.update(e)
+        return offsets, errors
+
+class ShardedFetcher(object):
+    '''
+    Wraps a fetcher so that only the partitions this instance owns are
+    fetched from the brokers, and the offsets of all others are taken from
+    what their owners published. Offsets their owner failed to fetch, or
+    has not published, as happens for a refresh or two after ownership
+    moves, are reported as errors, so they fall back to the last offsets
+    known.
+
+    Everything fetched since ownership last changed is published, along
+    with the latest error of each partition that failed, so callers
+    fetching a refresh in several chunks publish it all.
+    '''
+    DEFAULT_MAX_AGE = 30.0
+
+    def __init__(self, fetcher, coordinator, max_age=DEFAULT_MAX_AGE):
+        self.fetcher = fetcher
+        self.coordinator = coordinator
+        self.max_age = max_age
+        self.batch_size = fetcher.batch_size
+        self.max_inflight = fetcher.max_inflight
+        self.ring = None
+        self.mine = {}              # Offsets fetched by this instance
+        self.failed = {}            # Errors of those it failed to fetch
+        self.known = {}
+
+    def fetch(self, work, positions=None):
+        co = self.coordinator
+        try:
+            co.current()
+        except KazooException, e:
+            # Carry on with the ring as last read.
+            logger.warning('Reading shard members failed: %s', e)
+        if co.ring is not self.ring:
+            self.ring = co.ring
+            self.mine = {}
+            self.failed = {}
+
+        mine = {}
+        theirs = []
+        for (host, port), topic_partitions in work.items():
+            for topic, partition in topic_partitions:
+                if co.owns(host, topic, partition):
+                    mine.setdefault((host, port), set()).add((topic, partition))
+                else:
+                    theirs.append((host, port, topic, partition))
+
+        results, errors = self.fetcher.fetch(mine, positions)
+        self.mine.update(results)
+        for key in results:
+            self.failed.pop(key, None)
+        # Offsets that failed this time must not be passed off as fresh.
+        for key, error in errors.iteritems():
+            self.mine.pop(key, None)
+            self.failed[key] = error
+        co.publish(self.mine, self.failed)
+
+        if theirs:
+            published, failed = co.read_partials(self.max_age)
+            for key in theirs:
+                o = published.get(key)
+                if o is not None:
+                    results[key] = o
+                elif key in failed:
+                    errors[key] = failed[key]
+                else:
+                    errors[key] = 'not published by %s' % co.owner(key[0], key[2], key[3])
+
+        self.known.update(results)
+        return results, errors
+
+    def last_known(self, key):
+        o = self.known.get(key)
+        if o is None:
+            o = self.fetcher.last_known(key)
+        return o
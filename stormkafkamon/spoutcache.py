@@ -0,0 +1,191 @@
+# Keeps an in-memory copy of the Kafka Spout tree in Zookeeper, updated by
+# watches, so that repeated refreshes need no Zookeeper round trips.
+
+import threading
+import simplejson as json
+
+from kazoo.exceptions import NoNodeError
+
+from zkclient import ZkClient, ZkMirror, ZkKafkaSpout, ZkError, TopologyFilter
+
+class SpoutCache(ZkMirror):
+    '''
+    Mirrors spout_root/<spout>/<partition> in memory. Children watches on
+    spout_root and on each Spout task, and data watches on each partition
+    node, trigger asynchronous re-reads of whatever changed. A partition
+    node's JSON is only decoded again when its version changes.
+
+    The whole tree is read again on the first snapshot after the
+    Zookeeper session is lost, since the session's watches go with it.
+    '''
+    def __init__(self, zc, spout_root):
+        self.client = zc.client
+        self.stats = zc.stats
+        self.spout_root = spout_root
+        self.lock = threading.Lock()
+
+        self.spouts = {}            # Spout id -> {node: (version, JSON)}
+        self.snapshots = {}         # Topology -> tuple of ZkKafkaSpouts
+
+        self._follow_session(self.client)
+
+    def _spout_path(self, spout):
+        return ZkClient._zjoin([self.spout_root, spout])
+
+    def _changed(self):
+        self.snapshots = {}
+
+    def resync(self):
+        '''
+        Reads the whole Spout tree again and re-arms every watch. If any
+        read fails, it is all done again at the next snapshot.
+        '''
+        self.stale = False
+        with self.reading():
+            spouts = self._read_tree()
+
+        with self.lock:
+            self.spouts = spouts
+            self._changed()
+
+    def _read_tree(self):
+        spouts = {}
+        try:
+            children = self.client.get_children(self.spout_root, watch=self._root_watch)
+            self.stats.count('zk_reads', 1 + len(children))
+            pending = [(c, self.client.get_children_async(self._spout_path(c), watch=self._spout_watch))
+                       for c in children]
+
+            reads = []
+            for c, result in pending:
+                spouts[c] = {}
+                nodes = result.get()
+                self.stats.count('zk_reads', len(nodes))
+                for p in nodes:
+                    path = ZkClient._zjoin([self.spout_root, c, p])
+                    reads.append((c, p, self.client.get_async(path, watch=self._node_watch)))
+
+            for c, p, result in reads:
+                data, stat = result.get()
+                self.stats.count('zk_bytes', len(data))
+                spouts[c][p] = (stat.version, json.loads(data))
+        except NoNodeError:
+            raise ZkError('Kafka Spout nodes do not exist in Zookeeper')
+        return spouts
+
+    def snapshot(self, topology):
+        '''
+        Returns a tuple of ZkKafkaSpout tuples for topology, a name or a
+        TopologyFilter, in the same form as ZkClient.spouts().
+        '''
+        if self.stale:
+            self.resync()
+
+        with self.lock:
+            s = self.snapshots.get(topology)
+            if s is None:
+                wanted = TopologyFilter.of(topology)
+                s = []
+                for c in sorted(self.spouts):
+                    nodes = self.spouts[c]
+                    partitions = [nodes[p][1] for p in sorted(nodes)
+                                  if wanted(nodes[p][1]['topology']['name'])]
+                    s.append(ZkKafkaSpout._make([c, partitions]))
+                s = tuple(s)
+                self.snapshots[topology] = s
+        return s
+
+    # Watch callbacks run on kazoo's callback thread. Each one re-reads the
+    # node it was fired for, re-arming the watch, and applies the result
+    # when it arrives.
+
+    def _root_watch(self, event):
+        self.stats.count('zk_reads')
+        self.client.get_children_async(self.spout_root, watch=self._root_watch).rawlink(
+            self._root_children)
+
+    def _root_children(self, result):
+        try:
+            children = set(result.get())
+        except NoNodeError:
+            children = set()
+        except Exception:
+            self.stale = True
+            return
+
+        with self.lock:
+            for c in set(self.spouts) - children:
+                del self.spouts[c]
+                self._changed()
+
+        for c in children:
+            if c not in self.spouts:
+                self._spout_watch(None, c)
+
+    def _spout_watch(self, event, spout=None):
+        if spout is None:
+            spout = event.path.rsplit('/', 1)[1]
+        self.stats.count('zk_reads')
+        self.client.get_children_async(self._spout_path(spout), watch=self._spout_watch).rawlink(
+            lambda result: self._spout_children(spout, result))
+
+    def _spout_children(self, spout, result):
+        try:
+            children = set(result.get())
+        except NoNodeError:
+            with self.lock:
+                if self.spouts.pop(spout, None) is not None:
+                    self._changed()
+            return
+        except Exception:
+            self.stale = True
+            return
+
+        with self.lock:
+            nodes = self.spouts.setdefault(spout, {})
+            for p in set(nodes) - children:
+                del nodes[p]
+                self._changed()
+            added = children - set(nodes)
+
+        for p in added:
+            self._read_node(ZkClient._zjoin([self.spout_root, spout, p]))
+
+    def _node_watch(self, event):
+        self._read_node(event.path)
+
+    def _read_node(self, path):
+        self.stats.count('zk_reads')
+        self.client.get_async(path, watch=self._node_watch).rawlink(
+            lambda result: self._node_data(path, result))
+
+    def _node_data(self, path, result):
+        spout, p = path.rsplit('/', 2)[1:]
+        try:
+            data, stat = result.get()
+        except NoNodeError:
+            with self.lock:
+                nodes = self.spouts.get(spout)
+                if nodes is not None and nodes.pop(p, None) is not None:
+                    self._changed()
+            return
+        except Exception:
+            self.stale = True
+            return
+
+        with self.lock:
+            nodes = self.spouts.get(spout)
+            if nodes is None:
+                return
+            cached = nodes.get(p)
+            if cached is not None and cached[0] == stat.version:
+                return
+
+        self.stats.count('zk_bytes', len(data))
+        j = json.loads(data)
+
+        with self.lock:
+            nodes = self.spouts.get(spout)
+            if nodes is not None:
+                nodes[p] = (stat.version, j)
+                self._changed()
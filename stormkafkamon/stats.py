@@ -0,0 +1,181 @@
+# Timing and counters for the stages of a refresh. Everything is a no-op
+# while collection is disabled, so instrumented code pays one attribute
+# check per call.
+
+import os
+import math
+import time
+import threading
+import simplejson as json
+
+from clock import monotonic
+
+class LatencyHistogram(object):
+    '''
+    Counts latencies in exponentially sized buckets, from 100us up to about
+    two minutes, so recording is O(1) and memory is fixed. Percentiles are
+    the upper bound of the bucket they fall into.
+    '''
+    BASE = 0.0001
+    FACTOR = 1.25
+    BUCKETS = 64
+
+    def __init__(self):
+        self.counts = [0] * LatencyHistogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= LatencyHistogram.BASE:
+            i = 0
+        else:
+            i = int(math.log(seconds / LatencyHistogram.BASE) / math.log(LatencyHistogram.FACTOR)) + 1
+            i = min(i, LatencyHistogram.BUCKETS - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        wanted = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.max, LatencyHistogram.BASE * LatencyHistogram.FACTOR ** i)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record_phase(self.name, monotonic() - self.start)
+        return False
+
+class Stats(object):
+    '''
+    Collects the duration of each named phase of the last refresh, per
+    broker latency histograms of offset requests, and counters such as
+    Zookeeper reads. May be shared between threads.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}            # Name -> seconds taken last time
+            self.counters = {}          # Name -> count
+            self.brokers = {}           # 'host:port' -> LatencyHistogram
+
+    def phase(self, name):
+        '''
+        Returns a context manager that records how long its block took as
+        the latest duration of phase name.
+        '''
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def record_phase(self, name, seconds):
+        self.phases[name] = seconds
+
+    def record_rpc(self, broker, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.brokers.get(broker)
+            if histogram is None:
+                histogram = self.brokers[broker] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def rpc_totals(self):
+        '''
+        Returns a LatencyHistogram merging those of all brokers.
+        '''
+        total = LatencyHistogram()
+        with self.lock:
+            for histogram in self.brokers.values():
+                for i, n in enumerate(histogram.counts):
+                    total.counts[i] += n
+                total.count += histogram.count
+                total.total += histogram.total
+                total.max = max(total.max, histogram.max)
+        return total
+
+    def as_dict(self):
+        with self.lock:
+            brokers = dict((b, h.as_dict()) for b, h in self.brokers.items())
+            counters = dict(self.counters)
+        return {'enabled': self.enabled,
+                'phases': dict(self.phases),
+                'counters': counters,
+                'brokers': brokers,
+                'rpc': self.rpc_totals().as_dict()}
+
+    def get_header_line(self, phases):
+        '''
+        Returns a one line summary of the given phases and broker latencies.
+        '''
+        if not self.enabled:
+            return 'Stats off'
+
+        parts = ['%s %.1fms' % (name, self.phases.get(name, 0.0) * 1000) for name in phases]
+        parts.append('ZK reads %d (%dKB)' % (self.counters.get('zk_reads', 0),
+                                              self.counters.get('zk_bytes', 0) / 1024))
+
+        rpc = self.rpc_totals()
+        parts.append('RPC p50 %.1fms p99 %.1fms' % (rpc.percentile(50) * 1000, rpc.percentile(99) * 1000))
+
+        with self.lock:
+            slowest = sorted(self.brokers.items(), key=lambda b: b[1].percentile(99))
+        if slowest:
+            broker, histogram = slowest[-1]
+            parts.append('slowest %s p99 %.1fms' % (broker, histogram.percentile(99) * 1000))
+
+        return ' | '.join(parts)
+
+def dump(stats, path):
+    '''
+    Writes stats as JSON to path, replacing the file atomically so readers
+    never see a partial dump.
+    '''
+    d = stats.as_dict()
+    d['timestamp'] = time.time()
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(d, f)
+    os.rename(tmp, path)
@@ -1,92 +1,273 @@
+import calendar
+from time import time as wall_clock
+from array import array
+from collections import deque
+from itertools import izip, imap, compress, repeat
+from operator import ne, add
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from processor import STATUS_OK, STATUS_UNKNOWN, STATUS_INVALID
+from rollups import Rollups
+from estimator import LagEstimator, DEFAULT_WINDOW, format_duration, format_eta
+
+def to_seconds(t):
+    '''
+    Returns t as a float number of seconds. t is either a number of seconds,
+    such as a value of clock.monotonic(), or a datetime.
+    '''
+    if hasattr(t, 'timetuple'):
+        return calendar.timegm(t.timetuple()) + t.microsecond / 1000000.0
+    return float(t)
+
+def _vector(a):
+    '''
+    Returns a NumPy array sharing the memory of a, an array('l').
+    '''
+    if not a:
+        return numpy.zeros(0, numpy.int_)
+    return numpy.frombuffer(a, numpy.int_)
+
+def _sum(a):
+    if numpy is not None:
+        return int(_vector(a).sum())
+    return sum(a)
+
 class MovingAverage(object):
+    '''
+    Rate of a series of values over the last interval seconds. Samples are
+    kept in a deque along with their running sum, so adding, expiring and
+    reading are all amortized O(1).
+    '''
     def __init__(self, interval):
-        self.values = []
-        self.times = []
+        self.samples = deque()
+        self.total = 0
         self.interval = float(interval)
 
     def add_value(self, value, time):
-        self.values.append(value)
-        self.times.append(time)
+        time = to_seconds(time)
+        self.samples.append((time, value))
+        self.total += value
         self.update(time)
 
     def update(self, now):
-        for i, time in enumerate(self.times):
-            delta = now - time
-            microseconds = delta.seconds * 1000000 + delta.microseconds
-            seconds = microseconds / 1000000.0
-
-            if seconds < self.interval:
-                break
-
-        for j in range(i):
-            self.values.pop(0)
-            self.times.pop(0)
+        now = to_seconds(now)
+        samples = self.samples
+        while samples and now - samples[0][0] >= self.interval:
+            self.total -= samples.popleft()[1]
 
     def current_value(self):
-        num_times = len(self.times)
-        if num_times < 2:
+        if len(self.samples) < 2:
             return -1
         else:
-            delta = self.times[num_times - 1] - self.times[0]
-            microseconds = delta.seconds * 1000000 + delta.microseconds
-            seconds = microseconds / 1000000.0
+            seconds = self.samples[-1][0] - self.samples[0][0]
+            if seconds <= 0:
+                return -1
 
-            return sum(self.values) / seconds
+            return self.total / seconds
 
 
-class PartitionDelta(object):
-    def __init__(self):
-        self.broker = None
-        self.current = None
-        self.earliest = None
-        self.latest = None
-        self.depth = None
-        self.delta = None
+class PartitionColumns(object):
+    '''
+    Per-partition offsets for the current and previous summary, stored as
+    one array per column, and the Spout consuming each partition. Each
+    (broker, topic, partition) keeps the same row for the lifetime of the
+    table, so two brokers or two topics never share a row.
 
-        self.added = 0
+    Arrays are replaced on every update rather than modified, so a
+    reference to a column keeps the values it had.
+    '''
+    COLUMNS = ['earliest', 'latest', 'current', 'depth', 'delta']
+    PAIRED = ['latest', 'current', 'depth', 'delta']     # Columns with previous values
+
+    def __init__(self):
+        self.index = {}             # (broker, topic, partition) -> row
+        self.keys = []              # row -> (broker, topic, partition)
+        self.present = array('b')   # 1 if the row was in the last summary
+        self.order = None           # Present rows, sorted by key
+
+        for c in PartitionColumns.COLUMNS:
+            setattr(self, c, array('l'))
+        for c in PartitionColumns.PAIRED:
+            setattr(self, 'prev_' + c, array('l'))
+        self.spout = []
+        self.prev_spout = []
+        self.sums = (0, 0, 0)       # Sums of latest, current and delta
+        self.prev_sums = (0, 0, 0)
+
+        self.status = {}            # Row -> status, for rows not STATUS_OK
+        self.unknown = frozenset()  # Rows without broker offsets
+        self.uncounted = frozenset()    # Rows without broker offsets now or before
+        self.changed = None         # changed_rows(), once asked for
+
+        self.added = 0              # Totals over all rows for the last summary
         self.removed = 0
         self.net = 0
 
-    def update(self, partition_data):
-        if self.latest is not None:
-            self.added = partition_data.latest - self.latest
-            self.removed = partition_data.current - self.current
-            self.net = partition_data.delta - self.delta
-
-        self.broker = partition_data.broker
-        self.latest = partition_data.latest
-        self.earliest = partition_data.earliest
-        self.depth = partition_data.depth
-        self.current = partition_data.current
-        self.delta = partition_data.delta
-
-    def get_added(self):
-        return self.added
-
-    def get_removed(self):
-        return self.removed
-
-    def get_net(self):
-        return self.net
-
-    def get_earliest(self):
-        return self.earliest
-
-    def get_current(self):
-        return self.current
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, partitions, columns=None):
+        '''
+        Loads a summary's sequence of PartitionStates as the current
+        values, keeping the values they replace as the previous ones, and
+        recomputes the added, removed and net totals. Rows without broker
+        offsets, in this summary or the previous one, are left out of the
+        totals, so the backlog of a partition whose offsets are read at
+        last is not counted as added all at once. columns is the
+        summary's SummaryColumns, if it has them: when they hold the same
+        partitions as the rows, in the same order, which is the usual case,
+        their arrays become the current values as they are, and no
+        PartitionState is looked at.
+        '''
+        for c in PartitionColumns.PAIRED:
+            setattr(self, 'prev_' + c, getattr(self, c))
+        self.prev_spout = self.spout
+        self.prev_sums = self.sums
+        self.changed = None
+
+        if columns is not None and columns.keys == self.keys:
+            for c in PartitionColumns.COLUMNS:
+                setattr(self, c, getattr(columns, c))
+            self.spout = columns.spout
+            self.status = columns.status
+            if 0 in self.present:
+                self.present = array('b', [1]) * len(self.keys)
+                self.order = None
+        elif columns is not None:
+            self._load(izip(columns.keys, columns.earliest, columns.latest, columns.current,
+                            columns.depth, columns.delta, columns.spout,
+                            imap(columns.status.get, xrange(len(columns)), repeat(STATUS_OK))))
+        else:
+            self._load(((p.broker, p.topic, p.partition), p.earliest, p.latest, p.current,
+                        p.depth, p.delta, p.spout, p.status) for p in partitions)
+
+        prev_unknown = self.unknown
+        self.unknown = frozenset(row for row, status in self.status.iteritems()
+                                 if status == STATUS_UNKNOWN or status == STATUS_INVALID)
+        self.uncounted = self.unknown | prev_unknown
+
+        # The sums of the previous values were taken on the last update.
+        self.sums = (_sum(self.latest), _sum(self.current), _sum(self.delta))
+        self.added = self.sums[0] - self.prev_sums[0]
+        self.removed = self.sums[1] - self.prev_sums[1]
+        self.net = self.sums[2] - self.prev_sums[2]
+        for row in self.uncounted:
+            self.added -= self.latest[row] - self.prev_latest[row]
+            self.removed -= self.current[row] - self.prev_current[row]
+            self.net -= self.delta[row] - self.prev_delta[row]
+
+    def _load(self, rows):
+        '''
+        Writes each of rows, tuples of a key followed by the values of
+        COLUMNS, the Spout and the status, into the row of its key, adding
+        rows for new keys. Rows missing from rows keep their values, so
+        they count as unchanged, and so do new rows, whose previous values
+        are their current ones.
+        '''
+        # Copied, as the arrays may be those of a summary's SummaryColumns.
+        for c in PartitionColumns.PAIRED:
+            prev = array('l', getattr(self, 'prev_' + c))
+            setattr(self, 'prev_' + c, prev)
+            setattr(self, c, array('l', prev))
+        self.earliest = array('l', self.earliest)
+        self.prev_spout = list(self.prev_spout)
+        self.spout = list(self.prev_spout)
+
+        earliest, latest, current, depth, delta, spout = \
+            self.earliest, self.latest, self.current, self.depth, self.delta, self.spout
+        present = array('b', [0]) * len(self.keys)
+        status = {}
+        added = [0, 0, 0]
+        for key, e, l, c, dp, dl, s, st in rows:
+            row = self.index.get(key)
+            if row is None:
+                row = len(self.keys)
+                self.index[key] = row
+                self.keys.append(key)
+                present.append(0)
+                for a in (earliest, latest, current, depth, delta):
+                    a.append(0)
+                spout.append(None)
+                self.prev_latest.append(l)
+                self.prev_current.append(c)
+                self.prev_depth.append(dp)
+                self.prev_delta.append(dl)
+                self.prev_spout.append(s)
+                added[0] += l
+                added[1] += c
+                added[2] += dl
+            present[row] = 1
+            earliest[row] = e
+            latest[row] = l
+            current[row] = c
+            depth[row] = dp
+            delta[row] = dl
+            spout[row] = s
+            if st != STATUS_OK:
+                status[row] = st
+        self.status = status
+        self.prev_sums = tuple(imap(add, self.prev_sums, added))
+
+        if present != self.present:
+            self.present = present
+            self.order = None
+
+    def changed_rows(self):
+        '''
+        Returns the set of rows whose offsets or Spout differ from the
+        previous summary. The columns are compared without a Python loop,
+        in one vectorized pass if NumPy is installed, so the cost beyond
+        that is proportional to the rows changed. The set is shared by every
+        caller until the next update.
+        '''
+        if self.changed is None:
+            rows = xrange(len(self.keys))
+            if numpy is not None:
+                differ = _vector(self.latest) != _vector(self.prev_latest)
+                differ |= _vector(self.current) != _vector(self.prev_current)
+                differ |= _vector(self.depth) != _vector(self.prev_depth)
+                changed = set(numpy.flatnonzero(differ).tolist())
+            else:
+                changed = set(compress(rows, imap(ne, self.latest, self.prev_latest)))
+                changed.update(compress(rows, imap(ne, self.current, self.prev_current)))
+                changed.update(compress(rows, imap(ne, self.depth, self.prev_depth)))
+            if self.spout != self.prev_spout:
+                changed.update(compress(rows, imap(ne, self.spout, self.prev_spout)))
+            self.changed = changed
+        return self.changed
+
+    def added_at(self, row):
+        if row in self.uncounted:
+            return 0
+        return self.latest[row] - self.prev_latest[row]
 
-    def get_latest(self):
-        return self.latest
+    def removed_at(self, row):
+        if row in self.uncounted:
+            return 0
+        return self.current[row] - self.prev_current[row]
 
-    def get_depth(self):
-        return self.depth
+    def net_at(self, row):
+        if row in self.uncounted:
+            return 0
+        return self.delta[row] - self.prev_delta[row]
 
-    def get_delta(self):
-        return self.delta
+    def rows(self):
+        '''
+        Returns the rows present in the last summary, sorted by key.
+        '''
+        if self.order is None:
+            self.order = sorted([i for i in xrange(len(self.keys)) if self.present[i]],
+                                key=self.keys.__getitem__)
+        return self.order
 
 
 class SummaryAggregator(object):
     MOVING_AVG_INTERVALS = [30, 60, 300, 600]
+    HISTORY_INTERVALS = [3600, 86400]       # Only with a HistoryStore
 
     @staticmethod
     def get_moving_average_counts(self):
@@ -101,12 +282,14 @@ class SummaryAggregator(object):
         if now is None or prev_time is None or now == prev_time:
             return 0
 
-        delta = now - prev_time
-        microseconds = delta.seconds * 1000000 + delta.microseconds
-        return microseconds / 1000000.0
+        return to_seconds(now) - to_seconds(prev_time)
 
-    def __init__(self, topology, zookeeper):
-        self.partitions = {}
+    def __init__(self, topology, zookeeper, history=None, eta_window=DEFAULT_WINDOW, alerts=None):
+        self.partitions = PartitionColumns()
+        self.rollups = Rollups(self.partitions)
+        self.estimator = LagEstimator(self.partitions, eta_window)
+        self.alerts = alerts
+        self.history = history
         self.total_added = 0
         self.total_removed = 0
         self.summaries_added = 0
@@ -129,19 +312,38 @@ class SummaryAggregator(object):
             self.removed_averages[interval] = MovingAverage(interval)
             self.added_averages[interval] = MovingAverage(interval)
 
-    def add_summary(self, summary, time):
-        self.added = 0
-        self.removed = 0
-        for partition in summary.partitions:
-            partition_number = partition.partition
-
-            if partition_number not in self.partitions:
-                self.partitions[partition_number] = PartitionDelta()
-
-            self.partitions[partition_number].update(partition)
+    def _warm_start(self, time):
+        '''
+        Replays the intervals recorded in the history over the longest
+        moving average interval into the moving averages, moved onto the
+        clock of time. Returns the last record, or None if it is older than
+        that.
+        '''
+        now = wall_clock()
+        offset = to_seconds(time) - now
+        prev = None
+        for r in self.history.totals_since(now - max(SummaryAggregator.MOVING_AVG_INTERVALS)):
+            # The first interval began before the window.
+            if prev is not None:
+                for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
+                    self.added_averages[interval].add_value(r[1], r[0] + offset)
+                    self.removed_averages[interval].add_value(r[2], r[0] + offset)
+            prev = r
+        return prev
 
-            self.added += self.partitions[partition_number].get_added()
-            self.removed += self.partitions[partition_number].get_removed()
+    def add_summary(self, summary, time):
+        last = None
+        if self.history is not None and self.prev_summary is None:
+            last = self._warm_start(time)
+
+        self.partitions.update(summary.partitions, summary.columns)
+        self.rollups.update(to_seconds(time))
+        self.estimator.update(to_seconds(time), self.rollups)
+        self.added = self.partitions.added
+        self.removed = self.partitions.removed
+        if last is not None:
+            # What happened since the last record before a restart.
+            self.added, self.removed = self.history.since_last(self.partitions)
 
         for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
             self.removed_averages[interval].add_value(self.removed, time)
@@ -161,6 +363,33 @@ class SummaryAggregator(object):
         else:
             self.seconds_running = SummaryAggregator.seconds_delta(time, self.start_time)
 
+        if self.history is not None:
+            self.history.record(self.partitions, self.added, self.removed, wall_clock())
+
+        if self.alerts is not None:
+            self.alerts.evaluate(self, to_seconds(time))
+
+    def get_history_rates(self, interval):
+        '''
+        Returns the rates messages were added and removed at over the last
+        interval seconds, from the history, or -1s if not known.
+        '''
+        rates = None
+        if self.history is not None:
+            rates = self.history.rate(interval, wall_clock())
+        return rates if rates is not None else (-1, -1)
+
+    def window_rates(self):
+        '''
+        Returns a list of (interval, added/sec, removed/sec) for every
+        window known, -1 where there is not enough data yet.
+        '''
+        rates = [(i, self.added_averages[i].current_value(), self.removed_averages[i].current_value())
+                 for i in SummaryAggregator.MOVING_AVG_INTERVALS]
+        if self.history is not None:
+            rates.extend((i,) + self.get_history_rates(i) for i in SummaryAggregator.HISTORY_INTERVALS)
+        return rates
+
     def get_added_moving_average(self, interval):
         return self.added_averages[interval]
 
@@ -179,7 +408,17 @@ class SummaryAggregator(object):
         lines.append("Zookeeper: %s Topology: %s" % (self.zookeeper, self.topology))
         lines.append("")
 
-        lines.append("Total Depth: %18d     Total Delta: %18d" % (self.prev_summary.total_depth, self.prev_summary.total_delta))
+        line = "Total Depth: %18d     Total Delta: %18d" % (self.prev_summary.total_depth, self.prev_summary.total_delta)
+        if self.prev_summary.num_stale or self.prev_summary.num_unknown:
+            line += "     Stale: %d Unknown: %d" % (self.prev_summary.num_stale, self.prev_summary.num_unknown)
+        lines.append(line)
+        estimate = self.estimator.estimate_totals()
+        lines.append("Time Lag:    %18s     Catch-up ETA:%18s     (%s)" % (format_duration(estimate.time_lag),
+                                                                        format_eta(estimate), estimate.state))
+        if self.alerts is not None:
+            firing = self.alerts.firing()
+            if firing:
+                lines.append("Alerts firing: " + ", ".join("%s (%d)" % f for f in firing))
         lines.append("")
 
         display_delta = self.seconds_between_updates if self.seconds_between_updates != None else 0.0
@@ -205,22 +444,46 @@ class SummaryAggregator(object):
                                                               self.added_averages[300].current_value() - self.removed_averages[300].current_value(),
                                                               self.added_averages[600].current_value() - self.removed_averages[600].current_value()))
 
+        if self.history is not None:
+            hour = self.get_history_rates(3600)
+            day = self.get_history_rates(86400)
+            lines[-4] += " |  last hour  |   last day"
+            lines[-3] += "|% 13d|% 13d" % (hour[0], day[0])
+            lines[-2] += "|% 13d|% 13d" % (hour[1], day[1])
+            lines[-1] += "|% 13d|% 13d" % (hour[0] - hour[1], day[0] - day[1])
+
         return lines
 
+    PARTITION_HEADER = "    Broker    |    Topic     |  #  |   Earliest   |    Current   |    Latest    |     Depth    |     Delta    | Delta Delta/s|  Time Lag | Catch-up |"
+
+    def get_net_per_second(self, row):
+        if not self.seconds_between_updates:
+            return 0
+        return self.partitions.net_at(row) / self.seconds_between_updates
+
+    def get_partition_line(self, row):
+        p = self.partitions
+        broker, topic, partition = p.keys[row]
+        estimate = self.estimator.estimate_row(row)
+
+        return "%-13.13s |%-13.13s | % 3d |% 13d |% 13d |% 13d |% 13d |% 13d |% 13d |%10s |%9s | %s" % (broker,
+                                                                                  topic,
+                                                                                  partition,
+                                                                                  p.earliest[row],
+                                                                                  p.current[row],
+                                                                                  p.latest[row],
+                                                                                  p.depth[row],
+                                                                                  p.delta[row],
+                                                                                  self.get_net_per_second(row),
+                                                                                  format_duration(estimate.time_lag),
+                                                                                  format_eta(estimate),
+                                                                                  p.status.get(row, ''))
+
     def get_partition_data_lines(self):
         lines = list()
-        lines.append("  #  |   Earliest   |    Current   |    Latest    |     Depth    |     Delta    | Delta Delta/s|")
-
-        for i in range(len(self.partitions)):
-            partition = self.partitions[i]
-            net_per_second = partition.get_net() / self.seconds_between_updates if self.seconds_between_updates is not None else 0
-
-            lines.append(" % 3d |% 13d |% 13d |% 13d |% 13d |% 13d |% 13d |" % (i,
-                                                                         partition.get_earliest(),
-                                                                         partition.get_current(),
-                                                                         partition.get_latest(),
-                                                                         partition.get_depth(),
-                                                                         partition.get_delta(),
-                                                                         net_per_second ))
+        lines.append(SummaryAggregator.PARTITION_HEADER)
+
+        for i in self.partitions.rows():
+            lines.append(self.get_partition_line(i))
 
         return lines
@@ -1,9 +1,13 @@
+import re
 import simplejson as json
 from collections import namedtuple
+from contextlib import contextmanager
 
-from kazoo.client import KazooClient
+from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NoNodeError
 
+from stats import Stats
+
 ZkKafkaBroker = namedtuple('ZkKafkaBroker', ['id', 'host', 'port'])
 ZkKafkaSpout = namedtuple('ZkKafkaSpout', ['id', 'partitions'])
 ZkKafkaTopic = namedtuple('ZkKafkaTopic', ['topic', 'broker', 'num_partitions'])
@@ -15,11 +19,95 @@ class ZkError(Exception):
     def __str__(self):
         return self.msg
 
+class TopologyFilter(object):
+    '''
+    Selects the topologies to monitor: those named, those whose name
+    matches pattern, or, if names includes ALL, every topology. Called with
+    a topology name, returns whether it is selected.
+    '''
+    ALL = 'all'
+
+    def __init__(self, names=(), pattern=None):
+        self.names = frozenset(names)
+        self.all = TopologyFilter.ALL in self.names
+        self.pattern = re.compile(pattern) if pattern is not None else None
+
+    @classmethod
+    def of(cls, topology):
+        '''
+        Returns topology if it is already a TopologyFilter, or otherwise a
+        TopologyFilter selecting just the topology of that name.
+        '''
+        if isinstance(topology, TopologyFilter):
+            return topology
+        return cls([topology])
+
+    def named(self):
+        '''
+        Returns the sorted names of the topologies selected by name.
+        '''
+        return sorted(self.names - set([TopologyFilter.ALL]))
+
+    def single(self):
+        '''
+        Returns the only topology selected, if just one is named, or None.
+        '''
+        if len(self.names) == 1 and not self.all and self.pattern is None:
+            return iter(self.names).next()
+        return None
+
+    def __call__(self, name):
+        return self.all or name in self.names or \
+            (self.pattern is not None and self.pattern.search(name) is not None)
+
+    def __str__(self):
+        if self.all:
+            return TopologyFilter.ALL
+        parts = sorted(self.names)
+        if self.pattern is not None:
+            parts.append('/%s/' % self.pattern.pattern)
+        return ','.join(parts)
+
+class ZkMirror(object):
+    '''
+    Base of the objects keeping a copy of state read from Zookeeper. stale
+    is set whenever the Zookeeper session is lost, since the session's
+    watches and ephemeral nodes go with it, and whenever a read done
+    within reading() fails, so that everything is read again at the next
+    use.
+    '''
+    def _follow_session(self, client):
+        self.stale = True
+        client.add_listener(self._state_listener)
+
+    def _state_listener(self, state):
+        # Runs on the connection thread, so must not block.
+        if state == KazooState.LOST:
+            self._session_lost()
+
+    def _session_lost(self):
+        self.stale = True
+
+    @contextmanager
+    def reading(self):
+        try:
+            yield
+        except:
+            # ConnectionLoss or SessionExpiredError, after a reconnect for
+            # instance, as well as a node that vanished mid-read.
+            self.stale = True
+            raise
+
 class ZkClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, stats=None):
         self.host = host
         self.port = port
         self.client = KazooClient(hosts=':'.join([host, str(port)]))
+        self.stats = stats if stats is not None else Stats()
+
+    def _decode(self, data):
+        self.stats.count('zk_bytes', len(data))
+        return json.loads(data)
 
     def start(self):
         self.client.start()
@@ -64,18 +152,64 @@ class ZkClient:
             raise ZkError('Topic nodes do not exist in Zookeeper')
         return topics
 
-    def spouts(self, spout_root, topology):
+    def spouts(self, spout_root, topology, pipelined=False):
         '''
         Returns a list of ZkKafkaSpout tuples, where each tuple represents
-        a Storm Kafka Spout.
+        a Storm Kafka Spout. topology is either the name of a topology or a
+        TopologyFilter, in which case the partitions of all the topologies
+        it selects are returned from a single walk of the tree.
+
+        If pipelined is True, each level of the tree is requested with
+        asynchronous reads that are all in flight at once, rather than one
+        znode at a time.
+        '''
+        if pipelined:
+            return self._spouts_pipelined(spout_root, topology)
+
+        return tuple(self.iter_spouts(spout_root, topology))
+
+    def iter_spouts(self, spout_root, topology):
+        '''
+        Generates the same ZkKafkaSpout tuples as spouts(), each one as soon
+        as its partitions have been read.
         '''
+        wanted = TopologyFilter.of(topology)
+        try:
+            children = self.client.get_children(spout_root)
+            self.stats.count('zk_reads')
+            for c in children:
+                partitions = []
+                nodes = self.client.get_children(self._zjoin([spout_root, c]))
+                self.stats.count('zk_reads', 1 + len(nodes))
+                for p in nodes:
+                    j = self._decode(self.client.get(self._zjoin([spout_root, c, p]))[0])
+                    if wanted(j['topology']['name']):
+                        partitions.append(j)
+                yield ZkKafkaSpout._make([c, partitions])
+        except NoNodeError:
+            raise ZkError('Kafka Spout nodes do not exist in Zookeeper')
+
+    def _spouts_pipelined(self, spout_root, topology):
+        wanted = TopologyFilter.of(topology)
         s = []
         try:
-            for c in self.client.get_children(spout_root):
+            children = self.client.get_children(spout_root)
+            self.stats.count('zk_reads', 1 + len(children))
+            pending_children = [(c, self.client.get_children_async(self._zjoin([spout_root, c])))
+                                for c in children]
+
+            pending_data = []
+            for c, result in pending_children:
+                nodes = result.get()
+                self.stats.count('zk_reads', len(nodes))
+                pending_data.append((c, [self.client.get_async(self._zjoin([spout_root, c, p]))
+                                         for p in nodes]))
+
+            for c, results in pending_data:
                 partitions = []
-                for p in self.client.get_children(self._zjoin([spout_root, c])):
-                    j = json.loads(self.client.get(self._zjoin([spout_root, c, p]))[0])
-                    if j['topology']['name'] == topology:
+                for result in results:
+                    j = self._decode(result.get()[0])
+                    if wanted(j['topology']['name']):
                         partitions.append(j)
                 s.append(ZkKafkaSpout._make([c, partitions]))
         except NoNodeError:
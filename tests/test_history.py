@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Checks that rates from a HistoryStore count only what partitions present
+# at both ends of an interval produced, so that one appearing with a large
+# offset is not taken for a burst of production, that the messages
+# produced over a restart are counted once, and that a read-only store
+# creates nothing and follows a writer that starts after it.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from stormkafkamon.history import HistoryStore
+from stormkafkamon.processor import SummaryColumns
+from stormkafkamon.summary_aggregator import PartitionColumns
+
+
+def make_columns(offsets):
+    columns = SummaryColumns()
+    for key, offset in sorted(offsets.items()):
+        columns.add(key, 0, offset, offset, 'spout', 'ok', 'topology')
+    return columns
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_ticks(self, history, table, offsets, start, ticks):
+        for tick in xrange(ticks):
+            for key in offsets:
+                offsets[key] += 20
+            if tick == ticks // 2:
+                offsets[('b', 't', 99)] = 10 ** 9
+            table.update((), make_columns(offsets))
+            history.record(table, table.added, table.removed, start + 10 * tick)
+
+    def test_new_partition_adds_nothing(self):
+        history = HistoryStore(self.directory)
+        offsets = dict((('b', 't', p), 1000 * p) for p in xrange(3))
+        self.run_ticks(history, PartitionColumns(), offsets, 1000.0, 400)
+
+        added, removed = history.rate(3600, 1000.0 + 10 * 399)
+        self.assertTrue(5.9 < added < 8.1, added)
+        self.assertEqual(added, removed)
+        history.close()
+
+    def test_restart_counts_gap_once(self):
+        history = HistoryStore(self.directory)
+        offsets = dict((('b', 't', p), 0) for p in xrange(3))
+        self.run_ticks(history, PartitionColumns(), offsets, 1000.0, 10)
+        history.close()
+
+        for key in offsets:
+            offsets[key] += 500
+        offsets[('b', 't', 7)] = 10 ** 9
+        history = HistoryStore(self.directory)
+        table = PartitionColumns()
+        table.update((), make_columns(offsets))
+        self.assertEqual(history.since_last(table), (2000, 2000))
+        history.close()
+
+    def test_reader_creates_nothing(self):
+        directory = os.path.join(self.directory, 'topology')
+        reader = HistoryStore(directory, writable=False)
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(reader.last_totals(), None)
+        self.assertEqual(reader.rate(3600, 1000.0), None)
+        self.assertEqual(list(reader.partition_records(('b', 't', 0))), [])
+
+        writer = HistoryStore(directory)
+        offsets = {('b', 't', 0): 0}
+        self.run_ticks(writer, PartitionColumns(), offsets, 1000.0, 4)
+        self.assertEqual(reader.last_totals()[0], 1030.0)
+        self.assertEqual(len(list(reader.partition_records(('b', 't', 0)))), 4)
+        writer.close()
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Checks that PartitionColumns gives the same rows and totals whether a
+# summary's SummaryColumns are taken as they are or its PartitionStates
+# are loaded one by one, as partitions come, go and move between brokers.
+
+import random
+import unittest
+
+from stormkafkamon.processor import PartitionState, SummaryColumns, STATUS_OK, STATUS_STALE
+from stormkafkamon.summary_aggregator import PartitionColumns
+
+
+def make_summary(rng, offsets):
+    partitions = []
+    columns = SummaryColumns()
+    for (broker, topic, partition), (latest, current) in sorted(offsets.items()):
+        status = STATUS_STALE if rng.random() < 0.1 else STATUS_OK
+        spout = 'spout%d' % (partition % 3)
+        partitions.append(PartitionState(broker, topic, partition, 10, latest, latest - 10, spout,
+                                         current, latest - current, status, 'topology'))
+        columns.add((broker, topic, partition), 10, latest, current, spout, status, 'topology')
+    return partitions, columns
+
+
+class PartitionColumnsTest(unittest.TestCase):
+    def assertSameTable(self, a, b):
+        self.assertEqual((a.added, a.removed, a.net), (b.added, b.removed, b.net))
+        self.assertEqual([a.keys[r] for r in a.rows()], [b.keys[r] for r in b.rows()])
+        self.assertEqual(set(a.keys[r] for r in a.changed_rows()),
+                         set(b.keys[r] for r in b.changed_rows()))
+        rows = dict((k, r) for r, k in enumerate(b.keys))
+        for r, key in enumerate(a.keys):
+            s = rows[key]
+            for c in PartitionColumns.COLUMNS + ['prev_' + c for c in PartitionColumns.PAIRED]:
+                self.assertEqual(getattr(a, c)[r], getattr(b, c)[s], '%s of %s' % (c, key))
+            self.assertEqual(a.spout[r], b.spout[s])
+            self.assertEqual(a.status.get(r), b.status.get(s))
+
+    def test_columns_match_partition_states(self):
+        rng = random.Random(7)
+        offsets = {}
+        for p in range(40):
+            offsets[('broker%d' % (p % 3), 'topic%d' % (p % 2), p // 6)] = (1000, 900)
+
+        by_columns = PartitionColumns()
+        by_states = PartitionColumns()
+        for tick in range(30):
+            for key, (latest, current) in offsets.items():
+                latest += rng.randint(0, 20)
+                offsets[key] = (latest, min(latest, current + rng.randint(0, 20)))
+            if tick % 7 == 3:
+                offsets[('broker9', 'topic0', tick)] = (500, 400)
+            if tick % 5 == 4:
+                del offsets[rng.choice(sorted(offsets))]
+
+            partitions, columns = make_summary(rng, offsets)
+            by_columns.update(partitions, columns)
+            by_states.update(partitions)
+            self.assertSameTable(by_columns, by_states)
+
+    def test_columns_are_not_modified(self):
+        rng = random.Random(3)
+        offsets = {('broker0', 'topic', 0): (100, 50)}
+        table = PartitionColumns()
+        partitions, columns = make_summary(rng, offsets)
+        table.update(partitions, columns)
+        latest = table.latest
+
+        offsets[('broker1', 'topic', 0)] = (200, 150)
+        table.update(*make_summary(rng, offsets))
+        self.assertEqual(list(latest), [100])
+        self.assertEqual(list(columns.latest), [100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# Checks that a SpoutCache whose resync fails, as when the Zookeeper
+# connection is lost mid-read after a session loss, raises from that
+# snapshot and reads the whole tree again on the next one.
+
+import unittest
+
+import simplejson as json
+from kazoo.client import KazooState
+from kazoo.exceptions import ConnectionLoss
+
+from stormkafkamon.spoutcache import SpoutCache
+from stormkafkamon.stats import Stats
+
+
+class Result(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+class Stat(object):
+    version = 0
+
+
+class FailingClient(object):
+    '''
+    A Zookeeper tree of one Spout with one partition, whose reads of the
+    Spout's children fail while failing is set.
+    '''
+    def __init__(self):
+        self.failing = False
+        self.listeners = []
+        self.partition = {'topology': {'id': 'topology-1', 'name': 'topology'}, 'offset': 10,
+                          'partition': 0, 'broker': {'host': 'broker', 'port': 9092}, 'topic': 'topic'}
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_children(self, path, watch=None):
+        return ['spout']
+
+    def get_children_async(self, path, watch=None):
+        return Result(ConnectionLoss() if self.failing else ['partition_0'])
+
+    def get_async(self, path, watch=None):
+        return Result((json.dumps(self.partition), Stat()))
+
+
+class ZkStub(object):
+    def __init__(self, client):
+        self.client = client
+        self.stats = Stats()
+
+
+class SpoutCacheTest(unittest.TestCase):
+    def test_failed_resync_is_retried(self):
+        client = FailingClient()
+        cache = SpoutCache(ZkStub(client), '/kafkastorm')
+        self.assertEqual(cache.snapshot('topology')[0].partitions[0]['offset'], 10)
+
+        for listener in client.listeners:
+            listener(KazooState.LOST)
+        client.failing = True
+        client.partition['offset'] = 20
+        self.assertRaises(ConnectionLoss, cache.snapshot, 'topology')
+        self.assertTrue(cache.stale)
+
+        client.failing = False
+        self.assertEqual(cache.snapshot('topology')[0].partitions[0]['offset'], 20)
+        self.assertFalse(cache.stale)
+
+if __name__ == '__main__':
+    unittest.main()
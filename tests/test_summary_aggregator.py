@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Checks that MovingAverage, which keeps its samples in a deque with a
+# running sum, gives the same rates as the list-based version it replaced,
+# including as samples roll out of the window.
+
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from stormkafkamon.summary_aggregator import MovingAverage, SummaryAggregator
+
+
+class ListMovingAverage(object):
+    '''
+    MovingAverage as it was before its samples were kept in a deque.
+    '''
+    def __init__(self, interval):
+        self.values = []
+        self.times = []
+        self.interval = float(interval)
+
+    def add_value(self, value, time):
+        self.values.append(value)
+        self.times.append(time)
+        self.update(time)
+
+    def update(self, now):
+        for i, time in enumerate(self.times):
+            delta = now - time
+            microseconds = delta.seconds * 1000000 + delta.microseconds
+            seconds = microseconds / 1000000.0
+
+            if seconds < self.interval:
+                break
+
+        for j in range(i):
+            self.values.pop(0)
+            self.times.pop(0)
+
+    def current_value(self):
+        num_times = len(self.times)
+        if num_times < 2:
+            return -1
+        else:
+            delta = self.times[num_times - 1] - self.times[0]
+            microseconds = delta.seconds * 1000000 + delta.microseconds
+            seconds = microseconds / 1000000.0
+
+            return sum(self.values) / seconds
+
+
+START = datetime(2013, 6, 1, 12, 0, 0)
+
+
+class MovingAverageTest(unittest.TestCase):
+    def assertSameSeries(self, interval, samples):
+        '''
+        Feeds samples, a list of (value, seconds after START), to both
+        versions and checks they agree after every one.
+        '''
+        new = MovingAverage(interval)
+        old = ListMovingAverage(interval)
+        for value, seconds in samples:
+            t = START + timedelta(seconds=seconds)
+            new.add_value(value, t)
+            old.add_value(value, t)
+            self.assertAlmostEqual(new.current_value(), old.current_value(), places=9,
+                                   msg='interval %s after sample at %ss' % (interval, seconds))
+            self.assertEqual(len(new.samples), len(old.times))
+
+    def test_matches_list_version(self):
+        rng = random.Random(42)
+        for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
+            seconds = 0.0
+            samples = []
+            for i in range(3000):
+                seconds += rng.choice([0.5, 1.0, 3.0, 3.0, 3.0, 7.25, 29.0])
+                samples.append((rng.randint(0, 100000), seconds))
+            self.assertSameSeries(interval, samples)
+
+    def test_rollover_on_window_boundary(self):
+        # Samples land exactly one interval after earlier ones, which
+        # both versions drop.
+        for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
+            step = interval / 3.0
+            self.assertSameSeries(interval, [(i * 10, i * step) for i in range(1, 40)])
+
+    def test_gap_longer_than_window(self):
+        for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
+            samples = [(5, s) for s in range(1, 20)]
+            samples += [(7, 20 + 2 * interval), (9, 21 + 2 * interval), (11, 22 + 2 * interval)]
+            self.assertSameSeries(interval, samples)
+
+    def test_update_expires_without_adding(self):
+        # Only up to the expiry of the last sample: past it, the list
+        # version kept that one expired sample, but add_value(), the only
+        # caller of update(), always adds a newer one first.
+        for interval in SummaryAggregator.MOVING_AVG_INTERVALS:
+            new = MovingAverage(interval)
+            old = ListMovingAverage(interval)
+            last = 3 * interval - 3
+            for s in range(0, last + 1, 3):
+                t = START + timedelta(seconds=s)
+                new.add_value(s, t)
+                old.add_value(s, t)
+            for s in range(last, last + interval, 7):
+                t = START + timedelta(seconds=s)
+                new.update(t)
+                old.update(t)
+                self.assertAlmostEqual(new.current_value(), old.current_value(), places=9)
+                self.assertEqual(len(new.samples), len(old.times))
+
+
+if __name__ == '__main__':
+    unittest.main()